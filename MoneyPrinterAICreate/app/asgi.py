@@ -10,6 +10,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.config import config
+from app.config.database import init_db
 from app.models.exception import HttpException
 from app.router import root_api_router
 from app.utils import utils
@@ -19,6 +20,7 @@ def exception_handler(request: Request, e: HttpException):
     return JSONResponse(
         status_code=e.status_code,
         content=utils.get_response(e.status_code, e.data, e.message),
+        headers=e.headers,
     )
 
 
@@ -88,3 +90,7 @@ def shutdown_event():
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    # 只在 API 进程中初始化数据库，渲染和任务工作进程导入 app 时不连接 MySQL
+    logger.info("开始初始化数据库...")
+    init_db()
+    logger.info("数据库初始化完成")
@@ -3,6 +3,7 @@ from uuid import uuid4
 from fastapi import Request
 
 from app.config import config
+from app.models import const
 from app.models.exception import HttpException
 
 
@@ -18,6 +19,37 @@ def get_api_key(request: Request):
     return api_key
 
 
+def get_tenant(request: Request):
+    # 按 API Key 区分租户，没有 API Key 时按请求来源地址区分
+    api_key = get_api_key(request)
+    if api_key:
+        return api_key
+    return request.client.host if request.client else ""
+
+
+# 各接口的默认优先级
+_default_priorities = {
+    "audio": "high",
+    "subtitle": "high",
+    "video": "normal",
+    "resume": "normal",
+    "batch": "low",
+}
+
+
+def get_priority(request: Request, endpoint: str):
+    # 请求头 x-task-priority 可以覆盖接口的默认优先级：high、normal 或 low
+    priorities = {**_default_priorities, **config.app.get("task_priorities", {})}
+    name = request.headers.get("x-task-priority") or priorities.get(endpoint, "normal")
+    if name not in const.TASK_PRIORITIES:
+        raise HttpException(
+            task_id=get_task_id(request),
+            status_code=400,
+            message=f"invalid priority: {name}, one of {', '.join(const.TASK_PRIORITIES)}",
+        )
+    return const.TASK_PRIORITIES[name]
+
+
 def verify_token(request: Request):
     token = get_api_key(request)
     if token != config.app.get("api_key", ""):
@@ -1,29 +1,127 @@
+import math
 import threading
-from typing import Callable, Any, Dict
+import time
+from collections import deque
+from typing import Callable, Any, Dict, List, Optional
+
+from app.models import const
+
+
+class QueueFull(Exception):
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"the task queue is full: {depth} tasks")
+        self.depth = depth
+        # 预计多少秒后队列中会空出位置
+        self.retry_after = retry_after
+
+
+def get_task_id(kwargs: Dict) -> str:
+    return kwargs.get("task_id") or kwargs.get("batch_id") or ""
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)], 3)
 
 
 class TaskManager:
-    def __init__(self, max_concurrent_tasks: int):
+    # number of recent task starts and ends the wait times and the service rate are measured from
+    history_size = 200
+
+    def __init__(
+        self,
+        max_concurrent_tasks: int,
+        executor=None,
+        max_queue_depth: int = 0,
+        budget=None,
+    ):
         self.max_concurrent_tasks = max_concurrent_tasks
+        # 任务的执行器，例如 ProcessTaskExecutor，为空时在线程中直接运行
+        self.executor = executor
+        # 按 CPU 和内存占用接纳任务的 ResourceBudget，为空时只按任务数接纳
+        self.budget = budget
+        # how long the first task in the queue may be passed by smaller tasks
+        # that fit in the free resources, before they wait for it
+        self.backfill_timeout = 300
+        # 排队任务数的上限，0 表示不限制
+        self.max_queue_depth = max_queue_depth
         self.current_tasks = 0
         self.lock = threading.Lock()
         self.queue = self.create_queue()
+        # start time of the running tasks, by task id
+        self.running_tasks: Dict[str, float] = {}
+        self.waits = deque(maxlen=self.history_size)
+        self.finishes = deque(maxlen=self.history_size)
 
     def create_queue(self):
         raise NotImplementedError()
 
-    def add_task(self, func: Callable, *args: Any, **kwargs: Any):
+    def add_task(
+        self,
+        func: Callable,
+        *args: Any,
+        priority: int = const.TASK_PRIORITY_NORMAL,
+        tenant: str = "",
+        cost: float = 1.0,
+        resources: Optional[Dict[str, float]] = None,
+        **kwargs: Any,
+    ):
+        """
+        priority, tenant and cost, the estimated seconds of work, decide the
+        order of the queued tasks; resources, the cores and memory_mb the task
+        needs at most, decide when it can start. They are not passed to func.
+
+        Raises QueueFull when the task would have to wait in a queue that
+        already holds max_queue_depth tasks.
+        """
         with self.lock:
-            if self.current_tasks < self.max_concurrent_tasks:
+            if self.is_queue_empty() and self.can_start(resources):
                 print(f"add task: {func.__name__}, current_tasks: {self.current_tasks}")
-                self.execute_task(func, *args, **kwargs)
+                self.waits.append(0)
+                self.execute_task(func, *args, resources=resources, **kwargs)
             else:
+                depth = self.queue_depth()
+                if self.max_queue_depth and depth >= self.max_queue_depth:
+                    raise QueueFull(depth, self.retry_after())
                 print(
                     f"enqueue task: {func.__name__}, current_tasks: {self.current_tasks}"
                 )
-                self.enqueue({"func": func, "args": args, "kwargs": kwargs})
+                self.enqueue(
+                    {
+                        "func": func,
+                        "args": args,
+                        "kwargs": kwargs,
+                        "priority": priority,
+                        "tenant": tenant,
+                        "cost": cost,
+                        "resources": resources,
+                        "enqueued_at": time.time(),
+                    }
+                )
+                # the task may fit next to the ones the queue is waiting for
+                self.start_queued()
+
+    def can_start(self, resources: Optional[Dict[str, float]] = None) -> bool:
+        if self.current_tasks >= self.max_concurrent_tasks:
+            return False
+        return self.budget is None or self.budget.fits(resources)
 
-    def execute_task(self, func: Callable, *args: Any, **kwargs: Any):
+    def execute_task(
+        self,
+        func: Callable,
+        *args: Any,
+        resources: Optional[Dict[str, float]] = None,
+        **kwargs: Any,
+    ):
+        # counted here, under the lock, so that tasks added at the same time
+        # cannot all see a free slot
+        task_id = get_task_id(kwargs)
+        self.current_tasks += 1
+        self.running_tasks[task_id] = time.time()
+        if self.budget is not None:
+            self.budget.reserve(task_id, resources)
         thread = threading.Thread(
             target=self.run_task, args=(func, *args), kwargs=kwargs
         )
@@ -31,29 +129,179 @@ class TaskManager:
 
     def run_task(self, func: Callable, *args: Any, **kwargs: Any):
         try:
-            with self.lock:
-                self.current_tasks += 1
-            func(*args, **kwargs)  # 在这里调用函数，传递*args和**kwargs
+            if self.executor:
+                self.executor.run(func, *args, **kwargs)
+            else:
+                func(*args, **kwargs)  # 在这里调用函数，传递*args和**kwargs
         finally:
+            with self.lock:
+                self.running_tasks.pop(get_task_id(kwargs), None)
+                if self.budget is not None:
+                    self.budget.release(get_task_id(kwargs))
             self.task_done()
 
+    def next_task(self) -> Optional[Dict]:
+        """
+        Take the first queued task that can start. Smaller tasks may pass a
+        task that does not fit in the free resources, until it has waited
+        backfill_timeout seconds; then they wait for it.
+        """
+        if self.is_queue_empty():
+            return None
+        if self.budget is None:
+            return self.dequeue() if self.can_start() else None
+
+        now = time.time()
+        for task_info in self.queued_tasks():
+            if self.can_start(task_info.get("resources")):
+                return self.take(task_info)
+            if now - task_info.get("enqueued_at", now) > self.backfill_timeout:
+                return None
+        return None
+
+    def start_queued(self):
+        # called with the lock held, a finished task may free room for
+        # several smaller ones
+        while True:
+            task_info = self.next_task()
+            if not task_info:
+                return
+            if "enqueued_at" in task_info:
+                self.waits.append(time.time() - task_info["enqueued_at"])
+            func = task_info["func"]
+            args = task_info.get("args", ())
+            kwargs = task_info.get("kwargs", {})
+            self.execute_task(
+                func, *args, resources=task_info.get("resources"), **kwargs
+            )
+
     def check_queue(self):
         with self.lock:
-            if (
-                self.current_tasks < self.max_concurrent_tasks
-                and not self.is_queue_empty()
-            ):
-                task_info = self.dequeue()
-                func = task_info["func"]
-                args = task_info.get("args", ())
-                kwargs = task_info.get("kwargs", {})
-                self.execute_task(func, *args, **kwargs)
+            self.start_queued()
 
     def task_done(self):
         with self.lock:
             self.current_tasks -= 1
+            self.finishes.append(time.time())
         self.check_queue()
 
+    def recent_waits(self) -> List[float]:
+        return list(self.waits)
+
+    def recent_finishes(self) -> List[float]:
+        return list(self.finishes)
+
+    def running_count(self) -> int:
+        return self.current_tasks
+
+    def task_started_at(self, task_id: str) -> Optional[float]:
+        return self.running_tasks.get(task_id)
+
+    def has_task(self, task_id: str) -> bool:
+        """
+        Whether task_id is queued or running.
+        """
+        if self.task_started_at(task_id) is not None:
+            return True
+        return any(
+            get_task_id(t.get("kwargs", {})) == task_id for t in self.queued_tasks()
+        )
+
+    def slots(self) -> int:
+        """
+        Tasks that can run at the same time.
+        """
+        return self.max_concurrent_tasks
+
+    def service_rate(self) -> Optional[float]:
+        """
+        Tasks finished per second, measured over the recent finishes.
+        """
+        finishes = sorted(self.recent_finishes())
+        if len(finishes) < 2 or finishes[-1] <= finishes[0]:
+            return None
+        return (len(finishes) - 1) / (finishes[-1] - finishes[0])
+
+    def _estimate_wait(self, position: int, costs_ahead: float) -> float:
+        # seconds until the task at position in the queue starts: every
+        # finished task lets one queued task start
+        rate = self.service_rate()
+        if rate:
+            return (position + 1) / rate
+        # nothing measured yet: the estimated work up to and including the
+        # task, shared by the slots
+        return costs_ahead / max(self.slots(), 1)
+
+    def retry_after(self) -> int:
+        """
+        Seconds until a place in a full queue is expected to free up.
+        """
+        queued = self.queued_tasks()
+        cost = sum(t.get("cost", 1) for t in queued) / len(queued) if queued else 1
+        wait = self._estimate_wait(0, cost)
+        return min(max(math.ceil(wait), 1), 3600)
+
+    def stats(self, task_id: str = "") -> Dict:
+        """
+        Queue depth, running tasks and wait times, with the position and the
+        estimated start of task_id when given.
+        """
+        waits = self.recent_waits()
+        rate = self.service_rate()
+        data = {
+            "depth": self.queue_depth(),
+            "max_depth": self.max_queue_depth,
+            "running": self.running_count(),
+            "max_running": self.slots(),
+            "wait_p50": _percentile(waits, 0.5),
+            "wait_p95": _percentile(waits, 0.95),
+            "tasks_per_minute": round(rate * 60, 3) if rate else None,
+        }
+        if self.budget is not None:
+            data["resources"] = {
+                "capacity": self.budget.capacity(),
+                "reserved": self.budget.reserved(),
+            }
+        if not task_id:
+            return data
+
+        task = {"task_id": task_id, "state": "unknown"}
+        started = self.task_started_at(task_id)
+        if started is not None:
+            task.update(state="running", estimated_start=round(started, 1))
+        else:
+            costs_ahead = 0
+            for position, queued in enumerate(self.queued_tasks()):
+                if get_task_id(queued.get("kwargs", {})) == task_id:
+                    wait = self._estimate_wait(
+                        position, costs_ahead + queued.get("cost", 1)
+                    )
+                    task.update(
+                        state="queued",
+                        position=position,
+                        estimated_wait=round(wait, 1),
+                        estimated_start=round(time.time() + wait, 1),
+                    )
+                    break
+                costs_ahead += queued.get("cost", 1)
+        data["task"] = task
+        return data
+
+    def queue_depth(self) -> int:
+        raise NotImplementedError()
+
+    def queued_tasks(self) -> List[Dict]:
+        """
+        The queued tasks, in the order they are expected to run.
+        """
+        raise NotImplementedError()
+
+    def take(self, task: Dict) -> Dict:
+        """
+        Remove a task returned by queued_tasks from the queue.
+        """
+        raise NotImplementedError()
+
     def enqueue(self, task: Dict):
         raise NotImplementedError()
 
@@ -1,12 +1,17 @@
-from queue import Queue
-from typing import Dict
+from typing import Dict, List
 
+from app.config import config
 from app.controllers.manager.base_manager import TaskManager
+from app.controllers.manager.scheduler import FairQueue
 
 
 class InMemoryTaskManager(TaskManager):
     def create_queue(self):
-        return Queue()
+        return FairQueue(
+            quantum=config.app.get("task_quantum", 60),
+            aging=config.app.get("task_priority_aging", 300),
+            weights=config.app.get("tenant_weights", {}),
+        )
 
     def enqueue(self, task: Dict):
         self.queue.put(task)
@@ -16,3 +21,13 @@ class InMemoryTaskManager(TaskManager):
 
     def is_queue_empty(self):
         return self.queue.empty()
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def queued_tasks(self) -> List[Dict]:
+        return self.queue.order()
+
+    def take(self, task: Dict) -> Dict:
+        self.queue.remove(task)
+        return task
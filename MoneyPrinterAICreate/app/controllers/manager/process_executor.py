@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+from loguru import logger
+
+from app.config import config
+from app.models import const
+from app.services import state as sm
+
+
+class RelayState(sm.BaseState):
+    """
+    Task state of a worker process. The updates are kept locally, so the
+    task can read its own state back, and sent to the parent process, which
+    applies them to the state the API serves.
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+        self._local = sm.MemoryState()
+
+    def update_task(
+        self,
+        task_id: str,
+        state: int = const.TASK_STATE_PROCESSING,
+        progress: int = 0,
+        **kwargs,
+    ):
+        self._local.update_task(task_id, state=state, progress=progress, **kwargs)
+        self._queue.put(("update", task_id, state, progress, kwargs))
+
+    def get_task(self, task_id: str):
+        return self._local.get_task(task_id)
+
+    def delete_task(self, task_id: str):
+        self._local.delete_task(task_id)
+        self._queue.put(("delete", task_id, None, None, None))
+
+
+def _init_worker(state_queue):
+    # 每个工作进程只加载一次重量级依赖（moviepy、faster_whisper 等）
+    if state_queue is not None:
+        sm.state = RelayState(state_queue)
+
+    from app.services import task  # noqa: F401
+
+    logger.info("task worker ready")
+
+
+def _warm_up():
+    return True
+
+
+class ProcessTaskExecutor:
+    """
+    Runs the tasks in long-lived worker processes, so that the CPU-bound
+    rendering of concurrent tasks is not serialized by the GIL. The workers
+    are started and import the services once, up front.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        # 工作进程由 spawn 启动，不继承 API 进程中的线程和锁
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        # Redis 状态由各进程直接读写，内存状态需要转发到 API 进程
+        self._state_queue = None
+        if not config.app.get("enable_redis", False):
+            self._state_queue = self._context.Queue()
+            threading.Thread(target=self._relay_state, daemon=True).start()
+        self._pool = self._create_pool()
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self._state_queue,),
+        )
+        # 预热：提交空任务让所有工作进程立即启动并完成初始化
+        for _ in range(self.max_workers):
+            pool.submit(_warm_up)
+        return pool
+
+    def _relay_state(self):
+        while True:
+            try:
+                action, task_id, state, progress, kwargs = self._state_queue.get()
+                if action == "update":
+                    sm.state.update_task(task_id, state=state, progress=progress, **kwargs)
+                elif action == "delete":
+                    sm.state.delete_task(task_id)
+            except (EOFError, OSError):
+                return
+            except Exception as e:
+                logger.error(f"failed to relay task state: {str(e)}")
+
+    def run(self, func: Callable, *args: Any, **kwargs: Any):
+        """
+        Run func in a worker process and wait for its result.
+        """
+        with self._lock:
+            pool = self._pool
+        try:
+            return pool.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            logger.error(f"task worker died while running {func.__name__}, restarting the workers")
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = self._create_pool()
+            task_id = kwargs.get("task_id") or kwargs.get("batch_id")
+            if task_id:
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+            raise
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,56 +1,306 @@
 import json
-from typing import Dict
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import redis
+from loguru import logger
+from pydantic import BaseModel
 
-from app.controllers.manager.base_manager import TaskManager
-from app.models.schema import VideoParams
+from app.controllers.manager.base_manager import QueueFull, TaskManager, get_task_id
+from app.models import const, schema
+from app.services import state as sm
 from app.services import task as tm
+from app.utils import utils
 
 FUNC_MAP = {
     "start": tm.start,
+    "resume": tm.resume,
+    "start_batch": tm.start_batch,
     # 'start_test': tm.start_test
 }
 
 
 class RedisTaskManager(TaskManager):
-    def __init__(self, max_concurrent_tasks: int, redis_url: str):
-        self.redis_client = redis.Redis.from_url(redis_url)
-        super().__init__(max_concurrent_tasks)
+    """
+    Tasks queued in a Redis list. By default the API process that accepted a
+    task also runs it, and Redis only holds the tasks over the concurrency
+    limit. With standalone_workers the API only enqueues, and the tasks are
+    run by any number of `python -m app.worker` processes.
+
+    A worker moves a task atomically from the queue to the processing list
+    and holds a lease on it, renewed while the task runs. The task is
+    acknowledged, removed from the processing list, when it ends. Tasks whose
+    lease expired, because their worker died, are put back on the queue.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_tasks: int,
+        redis_url: str,
+        executor=None,
+        standalone_workers: bool = False,
+        visibility_timeout: int = 60,
+        max_attempts: int = 3,
+        redis_client=None,
+        max_queue_depth: int = 0,
+        budget=None,
+    ):
+        self.redis_client = redis_client or redis.Redis.from_url(redis_url)
+        self.standalone_workers = standalone_workers
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        super().__init__(
+            max_concurrent_tasks,
+            executor=executor,
+            max_queue_depth=max_queue_depth,
+            budget=budget,
+        )
+        self.processing_queue = f"{self.queue}:processing"
+        self.leases = f"{self.queue}:leases"
+        # start time of the tasks run by the workers, by task id
+        self.started = f"{self.queue}:started"
+        # recent wait times and finish times of the tasks run by the workers
+        self.wait_history = f"{self.queue}:waits"
+        self.finish_history = f"{self.queue}:finishes"
+        # concurrency and last heartbeat of the running workers, by worker id
+        self.workers = f"{self.queue}:workers"
 
     def create_queue(self):
         return "task_queue"
 
-    def enqueue(self, task: Dict):
-        task_with_serializable_params = task.copy()
+    def add_task(self, func: Callable, *args: Any, **kwargs: Any):
+        if self.standalone_workers:
+            # the redis queue is first in, first out: priority, tenant and cost are not used
+            for key in ("priority", "tenant"):
+                kwargs.pop(key, None)
+            cost = kwargs.pop("cost", 1.0)
+            resources = kwargs.pop("resources", None)
+            depth = self.queue_depth()
+            if self.max_queue_depth and depth >= self.max_queue_depth:
+                raise QueueFull(depth, self.retry_after())
+            logger.info(f"enqueue task for the workers: {func.__name__}")
+            self.enqueue(
+                {
+                    "func": func,
+                    "args": args,
+                    "kwargs": kwargs,
+                    "cost": cost,
+                    "resources": resources,
+                    "enqueued_at": time.time(),
+                }
+            )
+            return
+        super().add_task(func, *args, **kwargs)
 
-        if "params" in task["kwargs"] and isinstance(
-            task["kwargs"]["params"], VideoParams
-        ):
-            task_with_serializable_params["kwargs"]["params"] = task["kwargs"][
-                "params"
-            ].dict()
-
-        # 将函数对象转换为其名称
-        task_with_serializable_params["func"] = task["func"].__name__
-        self.redis_client.rpush(self.queue, json.dumps(task_with_serializable_params))
+    def enqueue(self, task: Dict):
+        self.redis_client.rpush(self.queue, _dumps(task))
 
     def dequeue(self):
         task_json = self.redis_client.lpop(self.queue)
         if task_json:
-            task_info = json.loads(task_json)
-            # 将函数名称转换回函数对象
-            task_info["func"] = FUNC_MAP[task_info["func"]]
-
-            if "params" in task_info["kwargs"] and isinstance(
-                task_info["kwargs"]["params"], dict
-            ):
-                task_info["kwargs"]["params"] = VideoParams(
-                    **task_info["kwargs"]["params"]
-                )
-
-            return task_info
+            return _loads(task_json)
         return None
 
     def is_queue_empty(self):
         return self.redis_client.llen(self.queue) == 0
+
+    def queue_depth(self) -> int:
+        return self.redis_client.llen(self.queue)
+
+    def next_task(self) -> Optional[Dict]:
+        # first in, first out: only the first task can start
+        message = self.redis_client.lindex(self.queue, 0)
+        if not message or not self.can_start(json.loads(message).get("resources")):
+            return None
+        return self.dequeue()
+
+    def queued_tasks(self) -> List[Dict]:
+        return [json.loads(m) for m in self.redis_client.lrange(self.queue, 0, -1)]
+
+    def running_count(self) -> int:
+        if self.standalone_workers:
+            return self.redis_client.llen(self.processing_queue)
+        return super().running_count()
+
+    def slots(self) -> int:
+        if self.standalone_workers:
+            return self.worker_capacity()
+        return super().slots()
+
+    def register_worker(self, worker_id: str, concurrency: int):
+        """
+        Announce a worker and its concurrency, repeated as its heartbeat.
+        """
+        self.redis_client.hset(
+            self.workers,
+            worker_id,
+            json.dumps({"concurrency": concurrency, "seen": time.time()}),
+        )
+
+    def unregister_worker(self, worker_id: str):
+        self.redis_client.hdel(self.workers, worker_id)
+
+    def worker_capacity(self) -> int:
+        """
+        Tasks the workers with a recent heartbeat run at the same time. The
+        workers that missed their heartbeats for visibility_timeout seconds
+        are dropped.
+        """
+        capacity = 0
+        now = time.time()
+        for worker_id, value in self.redis_client.hgetall(self.workers).items():
+            worker = json.loads(value)
+            if now - worker.get("seen", 0) > self.visibility_timeout:
+                self.redis_client.hdel(self.workers, worker_id)
+                continue
+            capacity += worker.get("concurrency", 0)
+        return capacity
+
+    def recent_waits(self) -> List[float]:
+        if self.standalone_workers:
+            return [float(v) for v in self.redis_client.lrange(self.wait_history, 0, -1)]
+        return super().recent_waits()
+
+    def recent_finishes(self) -> List[float]:
+        if self.standalone_workers:
+            return [float(v) for v in self.redis_client.lrange(self.finish_history, 0, -1)]
+        return super().recent_finishes()
+
+    def task_started_at(self, task_id: str) -> Optional[float]:
+        if self.standalone_workers:
+            started = self.redis_client.hget(self.started, task_id)
+            return float(started) if started else None
+        return super().task_started_at(task_id)
+
+    def _record(self, pipe, key: str, value: float):
+        pipe.rpush(key, value)
+        pipe.ltrim(key, -self.history_size, -1)
+
+    def reserve(self, timeout: int = 5) -> Optional[Tuple[bytes, Dict]]:
+        """
+        Wait up to timeout seconds for a task and lease it. Returns the raw
+        message, needed to acknowledge it, and the task.
+        """
+        message = self.redis_client.blmove(
+            self.queue, self.processing_queue, timeout, "LEFT", "RIGHT"
+        )
+        if not message:
+            return None
+        task_info = _loads(message)
+        self.extend(task_info)
+        now = time.time()
+        pipe = self.redis_client.pipeline()
+        pipe.hset(self.started, get_task_id(task_info["kwargs"]), now)
+        self._record(pipe, self.wait_history, now - task_info.get("enqueued_at", now))
+        pipe.execute()
+        return message, task_info
+
+    def release(self, message: bytes, task_info: Dict):
+        """
+        Give a reserved task back, at the front of the queue, without
+        running it.
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.lrem(self.processing_queue, 1, message)
+        pipe.hdel(self.leases, task_info["id"])
+        pipe.hdel(self.started, get_task_id(task_info["kwargs"]))
+        pipe.lpush(self.queue, message)
+        pipe.execute()
+
+    def extend(self, task_info: Dict):
+        self.redis_client.hset(
+            self.leases, task_info["id"], time.time() + self.visibility_timeout
+        )
+
+    def ack(self, message: bytes, task_info: Dict):
+        pipe = self.redis_client.pipeline()
+        pipe.lrem(self.processing_queue, 1, message)
+        pipe.hdel(self.leases, task_info["id"])
+        pipe.hdel(self.started, get_task_id(task_info["kwargs"]))
+        self._record(pipe, self.finish_history, time.time())
+        pipe.execute()
+
+    def requeue_expired(self) -> int:
+        """
+        Put the tasks whose lease expired back on the queue, or fail them
+        after max_attempts. Returns the number of tasks handled.
+        """
+        count = 0
+        now = time.time()
+        for message in self.redis_client.lrange(self.processing_queue, 0, -1):
+            task_info = _loads(message)
+            deadline = self.redis_client.hget(self.leases, task_info["id"])
+            if deadline is None:
+                # moved by a worker that has not taken the lease yet, or that
+                # died right after: give it a full lease from now
+                self.redis_client.hsetnx(
+                    self.leases, task_info["id"], now + self.visibility_timeout
+                )
+                continue
+            if float(deadline) > now:
+                continue
+
+            attempts = task_info.get("attempts", 0) + 1
+            with self.redis_client.pipeline() as pipe:
+                try:
+                    pipe.watch(self.processing_queue, self.leases)
+                    if pipe.hget(self.leases, task_info["id"]) != deadline:
+                        continue
+                    pipe.multi()
+                    pipe.lrem(self.processing_queue, 1, message)
+                    pipe.hdel(self.leases, task_info["id"])
+                    pipe.hdel(self.started, get_task_id(task_info["kwargs"]))
+                    if attempts < self.max_attempts:
+                        pipe.rpush(self.queue, _dumps(task_info, attempts=attempts))
+                    pipe.execute()
+                except redis.WatchError:
+                    continue
+
+            count += 1
+            task_id = get_task_id(task_info.get("kwargs", {}))
+            if attempts < self.max_attempts:
+                logger.warning(
+                    f"task lease expired, requeued: {task_id}, attempts: {attempts}"
+                )
+            else:
+                logger.error(f"task lease expired too many times, failed: {task_id}")
+                if task_id:
+                    sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return count
+
+
+def _dumps(task: Dict, attempts: int = 0) -> str:
+    kwargs = dict(task.get("kwargs", {}))
+    params = kwargs.get("params")
+    params_model = task.get("params_model", "")
+    if isinstance(params, BaseModel):
+        params_model = type(params).__name__
+        kwargs["params"] = params.model_dump()
+
+    return json.dumps(
+        {
+            # 相同的任务重复入队时以 id 区分
+            "id": task.get("id") or utils.get_uuid(),
+            # 将函数对象转换为其名称
+            "func": task["func"] if isinstance(task["func"], str) else task["func"].__name__,
+            "args": list(task.get("args", ())),
+            "kwargs": kwargs,
+            "params_model": params_model,
+            "attempts": attempts,
+            "cost": task.get("cost", 1.0),
+            "resources": task.get("resources"),
+            "enqueued_at": task.get("enqueued_at") or time.time(),
+        }
+    )
+
+
+def _loads(task_json) -> Dict:
+    task_info = json.loads(task_json)
+    # 将函数名称转换回函数对象
+    task_info["func"] = FUNC_MAP[task_info["func"]]
+
+    kwargs = task_info.get("kwargs", {})
+    if "params" in kwargs and isinstance(kwargs["params"], dict):
+        model = getattr(schema, task_info.get("params_model") or "VideoParams")
+        kwargs["params"] = model(**kwargs["params"])
+    return task_info
@@ -0,0 +1,89 @@
+import threading
+from typing import Dict, Optional
+
+from loguru import logger
+
+from app.utils import utils
+
+
+class ResourceBudget:
+    """
+    Admits tasks by the cores and memory they declare instead of by count.
+
+    A task is admitted while the cores reserved by the running tasks, its
+    own included, stay within the machine's cores times cpu_overcommit, and
+    while its memory fits both in what the running tasks have not reserved
+    and in what the machine has actually available, less reserve_mb kept
+    for the API process. The capacity is read from /proc and the cgroup
+    limits of a container.
+
+    A task larger than the whole budget is still admitted when nothing else
+    runs, so that it fails or succeeds instead of waiting forever.
+    """
+
+    def __init__(self, cpu_overcommit: float = 1.0, reserve_mb: float = 1024):
+        self.cpu_overcommit = cpu_overcommit
+        self.reserve_mb = reserve_mb
+        self._lock = threading.Condition()
+        # resources of the running tasks, by task id
+        self._reserved: Dict[str, Dict[str, float]] = {}
+
+    def capacity(self) -> Dict[str, Optional[float]]:
+        memory = utils.memory_info()
+        total_mb, available_mb = (None, None)
+        if memory:
+            total_mb, available_mb = (m / 1024 / 1024 - self.reserve_mb for m in memory)
+        return {
+            "cpu": utils.cpu_capacity() * self.cpu_overcommit,
+            "memory_mb": total_mb,
+            "available_memory_mb": available_mb,
+        }
+
+    def reserved(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "cpu": sum(r.get("cpu", 0) for r in self._reserved.values()),
+                "memory_mb": sum(r.get("memory_mb", 0) for r in self._reserved.values()),
+            }
+
+    def fits(self, resources: Optional[Dict[str, float]]) -> bool:
+        resources = resources or {}
+        with self._lock:
+            if not self._reserved:
+                return True
+            capacity = self.capacity()
+            reserved = self.reserved()
+            cpu = resources.get("cpu", 0)
+            memory_mb = resources.get("memory_mb", 0)
+            if reserved["cpu"] + cpu > capacity["cpu"]:
+                return False
+            if capacity["memory_mb"] is None:
+                # no /proc: only the cores are accounted
+                return True
+            return (
+                reserved["memory_mb"] + memory_mb <= capacity["memory_mb"]
+                and memory_mb <= capacity["available_memory_mb"]
+            )
+
+    def reserve(self, task_id: str, resources: Optional[Dict[str, float]]):
+        with self._lock:
+            self._reserved[task_id] = dict(resources or {})
+
+    def release(self, task_id: str):
+        with self._lock:
+            self._reserved.pop(task_id, None)
+            self._lock.notify_all()
+
+    def acquire(self, task_id: str, resources: Optional[Dict[str, float]], stopping=None):
+        """
+        Wait until the task fits and reserve its resources.
+        """
+        with self._lock:
+            while not self.fits(resources):
+                if stopping is not None and stopping.is_set():
+                    return False
+                logger.debug(f"waiting for resources: {task_id}, {resources}")
+                # the available memory also changes outside of the budget
+                self._lock.wait(5)
+            self._reserved[task_id] = dict(resources or {})
+            return True
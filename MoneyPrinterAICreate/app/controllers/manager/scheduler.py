@@ -0,0 +1,185 @@
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from app.models import const
+
+
+def _cost(task: Dict) -> float:
+    # every task costs something, so that a tenant's turn always ends
+    return max(task.get("cost", 1), 0.001)
+
+
+class FairQueue:
+    """
+    Queued tasks ordered by priority class, then shared fairly between the
+    tenants of a class.
+
+    The class with the smallest priority value goes first. A class is
+    promoted by one level for every aging seconds its oldest task has
+    waited, so low priority tasks are delayed but never starved.
+
+    Within a class the tenants take turns (deficit round robin). On its turn
+    a tenant gets quantum * weight seconds of estimated work, and runs tasks
+    while their cost fits in what it has saved up. A tenant with short tasks
+    therefore runs several of them in the time another tenant runs one long
+    render, and a tenant queuing many tasks does not delay the others.
+    """
+
+    def __init__(
+        self,
+        quantum: float = 60,
+        aging: float = 300,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.quantum = quantum
+        self.aging = aging
+        self.weights = weights or {}
+        self._lock = threading.Lock()
+        # priority -> tenant -> queued (enqueued_at, task), tenants in turn order
+        self._classes: Dict[int, OrderedDict] = {}
+        # work saved up by every tenant of a class, by (priority, tenant)
+        self._deficits: Dict[tuple, float] = {}
+        self._size = 0
+        # changed by every put, get and remove, order is cached until then
+        self._version = 0
+        self._order = None
+
+    def put(self, task: Dict):
+        priority = task.get("priority", const.TASK_PRIORITY_NORMAL)
+        tenant = task.get("tenant", "")
+        with self._lock:
+            tenants = self._classes.setdefault(priority, OrderedDict())
+            tenants.setdefault(tenant, deque()).append((time.time(), task))
+            self._size += 1
+            self._version += 1
+
+    def get(self) -> Dict:
+        with self._lock:
+            if not self._size:
+                raise IndexError("the queue is empty")
+            priority = self._next_class()
+            tenants = self._classes[priority]
+            names = list(tenants)
+
+            # the tenants take turns in order, each turn adds its share to the
+            # tenant that cannot afford its next task yet. instead of taking
+            # the turns one by one, count the rounds every tenant needs
+            rounds = [self._rounds(priority, tenant) for tenant in names]
+            position = min(range(len(names)), key=lambda p: (rounds[p], p))
+            for p, tenant in enumerate(names):
+                # the tenants ahead of the winner had one more turn in its round
+                turns = rounds[position] + (1 if p < position else 0)
+                if turns:
+                    key = (priority, tenant)
+                    self._deficits[key] = self._deficits.get(key, 0) + turns * self._share(tenant)
+            # every tenant that had its turn moved to the back
+            for tenant in names[:position]:
+                tenants.move_to_end(tenant)
+
+            tenant = names[position]
+            tasks = tenants[tenant]
+            key = (priority, tenant)
+            task = tasks.popleft()[1]
+            self._deficits[key] -= _cost(task)
+            if not tasks:
+                # an idle tenant does not save up work for later
+                del tenants[tenant]
+                del self._deficits[key]
+            if not tenants:
+                del self._classes[priority]
+            self._size -= 1
+            self._version += 1
+            return task
+
+    def _share(self, tenant: str) -> float:
+        return max(self.quantum * self.weights.get(tenant, 1), 0.001)
+
+    def _rounds(self, priority: int, tenant: str) -> int:
+        # turns the tenant needs until its next task fits in what it saved up
+        deficit = self._deficits.get((priority, tenant), 0)
+        cost = _cost(self._classes[priority][tenant][0][1])
+        if deficit >= cost:
+            return 0
+        share = self._share(tenant)
+        rounds = math.ceil((cost - deficit) / share)
+        if deficit + rounds * share < cost:
+            # rounding of the division
+            rounds += 1
+        return rounds
+
+    def remove(self, task: Dict):
+        """
+        Remove a task ahead of its turn, its cost is still charged to its
+        tenant.
+        """
+        with self._lock:
+            priority = task.get("priority", const.TASK_PRIORITY_NORMAL)
+            tenant = task.get("tenant", "")
+            tenants = self._classes.get(priority, {})
+            tasks = tenants.get(tenant, ())
+            for entry in tasks:
+                if entry[1] is task:
+                    break
+            else:
+                raise ValueError("the task is not queued")
+            tasks.remove(entry)
+            key = (priority, tenant)
+            self._deficits[key] = self._deficits.get(key, 0) - _cost(task)
+            if not tasks:
+                del tenants[tenant]
+                self._deficits.pop(key, None)
+            if not tenants:
+                del self._classes[priority]
+            self._size -= 1
+            self._version += 1
+
+    def order(self) -> List[Dict]:
+        """
+        The queued tasks in the order get would return them now. The order
+        is simulated once per change of the queue, or of the promotions of
+        the classes by aging.
+        """
+        with self._lock:
+            state = (self._version, self._promotions(time.time()))
+            if self._order is not None and self._order[0] == state:
+                return list(self._order[1])
+            other = FairQueue(self.quantum, self.aging, self.weights)
+            other._classes = {
+                priority: OrderedDict((t, deque(tasks)) for t, tasks in tenants.items())
+                for priority, tenants in self._classes.items()
+            }
+            other._deficits = dict(self._deficits)
+            other._size = self._size
+        order = [other.get() for _ in range(other.qsize())]
+        with self._lock:
+            if self._version == state[0]:
+                self._order = (state, order)
+        return list(order)
+
+    def _promotions(self, now: float) -> tuple:
+        # the levels every class is promoted by, the order changes with them
+        return tuple(
+            (priority, self._promoted(priority, now)) for priority in sorted(self._classes)
+        )
+
+    def _promoted(self, priority: int, now: float) -> int:
+        if self.aging <= 0:
+            return 0
+        oldest = min(tasks[0][0] for tasks in self._classes[priority].values())
+        return int((now - oldest) / self.aging)
+
+    def _next_class(self) -> int:
+        now = time.time()
+        return min(
+            self._classes,
+            key=lambda priority: (priority - self._promoted(priority, now), priority),
+        )
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def qsize(self) -> int:
+        return self._size
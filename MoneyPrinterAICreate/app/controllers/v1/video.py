@@ -1,17 +1,20 @@
-import glob
 import os
 import pathlib
 import shutil
+import threading
 from typing import Union
 
-from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
+from fastapi import BackgroundTasks, Depends, Path, Query, Request, UploadFile
 from fastapi.params import File
 from fastapi.responses import FileResponse, StreamingResponse
 from loguru import logger
 
 from app.config import config
 from app.controllers import base
+from app.controllers.manager.base_manager import QueueFull
 from app.controllers.manager.memory_manager import InMemoryTaskManager
+from app.controllers.manager.process_executor import ProcessTaskExecutor
+from app.controllers.manager.resources import ResourceBudget
 from app.controllers.manager.redis_manager import RedisTaskManager
 from app.controllers.v1.base import new_router
 from app.models.exception import HttpException
@@ -19,13 +22,18 @@ from app.models.schema import (
     AudioRequest,
     BgmRetrieveResponse,
     BgmUploadResponse,
+    CacheStatsResponse,
+    QueueStatsResponse,
     SubtitleRequest,
+    TaskBatchResponse,
     TaskDeletionResponse,
     TaskQueryRequest,
     TaskQueryResponse,
     TaskResponse,
+    TaskVideoBatchRequest,
     TaskVideoRequest,
 )
+from app.services import bgm
 from app.services import state as sm
 from app.services import task as tm
 from app.utils import utils
@@ -40,15 +48,56 @@ _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
 _max_concurrent_tasks = config.app.get("max_concurrent_tasks", 5)
+_task_executor = config.app.get("task_executor", "thread")
+_max_queue_depth = config.app.get("max_queue_depth", 0)
+
+# 按任务各阶段声明的 CPU 和内存占用接纳任务，max_concurrent_tasks 仍是任务数的上限
+budget = None
+if config.app.get("resource_scheduling", False):
+    budget = ResourceBudget(
+        cpu_overcommit=config.app.get("cpu_overcommit", 1.0),
+        reserve_mb=config.app.get("memory_reserve_mb", 1024),
+    )
+
+# 任务在常驻的工作进程中执行，或者在 API 进程的线程中执行
+executor = None
+if _task_executor == "process":
+    executor = ProcessTaskExecutor(max_workers=_max_concurrent_tasks)
 
 redis_url = f"redis://:{_redis_password}@{_redis_host}:{_redis_port}/{_redis_db}"
 # 根据配置选择合适的任务管理器
 if _enable_redis:
     task_manager = RedisTaskManager(
-        max_concurrent_tasks=_max_concurrent_tasks, redis_url=redis_url
+        max_concurrent_tasks=_max_concurrent_tasks,
+        redis_url=redis_url,
+        executor=executor,
+        standalone_workers=config.app.get("standalone_workers", False),
+        visibility_timeout=config.app.get("task_visibility_timeout", 60),
+        max_attempts=config.app.get("task_max_attempts", 3),
+        max_queue_depth=_max_queue_depth,
+        budget=budget,
     )
 else:
-    task_manager = InMemoryTaskManager(max_concurrent_tasks=_max_concurrent_tasks)
+    task_manager = InMemoryTaskManager(
+        max_concurrent_tasks=_max_concurrent_tasks,
+        executor=executor,
+        max_queue_depth=_max_queue_depth,
+        budget=budget,
+    )
+
+# 检查任务是否已在执行和标记为执行中之间，不能有第二个恢复请求
+_resume_lock = threading.Lock()
+
+
+def _queue_full(task_id: str, request_id: str, e: QueueFull):
+    # 队列已满：拒绝任务，并告知客户端多久之后重试
+    return HttpException(
+        task_id=task_id,
+        status_code=429,
+        message=f"{request_id}: {str(e)}, retry after {e.retry_after} seconds",
+        data={"depth": e.depth, "retry_after": e.retry_after},
+        headers={"Retry-After": str(e.retry_after)},
+    )
 
 
 @router.post("/videos", response_model=TaskResponse, summary="Generate a short video")
@@ -72,6 +121,69 @@ def create_audio(
     return create_task(request, body, stop_at="audio")
 
 
+@router.post(
+    "/videos/batch",
+    response_model=TaskBatchResponse,
+    summary="Generate short videos in a batch, sharing the common stages",
+)
+def create_video_batch(request: Request, body: TaskVideoBatchRequest):
+    batch_id = utils.get_uuid()
+    request_id = base.get_task_id(request)
+    priority = base.get_priority(request, "batch")
+    if not body.items:
+        raise HttpException(
+            task_id=batch_id, status_code=400, message=f"{request_id}: no items"
+        )
+
+    tasks = [{"task_id": utils.get_uuid(), "params": item} for item in body.items]
+    task_ids = [task["task_id"] for task in tasks]
+    try:
+        # planned before any task state is created, so that an invalid batch
+        # leaves nothing behind
+        runs = tm.plan_batch(body.items)
+        cost = sum(tm.estimate_cost(item) for item in body.items)
+        resources = tm.estimate_batch_resources(body.items)
+    except ValueError as e:
+        raise HttpException(
+            task_id=batch_id, status_code=400, message=f"{request_id}: {str(e)}"
+        )
+
+    for task_id in task_ids:
+        sm.state.update_task(task_id)
+    sm.state.update_task(batch_id, tasks=task_ids)
+    batch = {
+        "batch_id": batch_id,
+        "request_id": request_id,
+        "task_ids": task_ids,
+        "runs": runs,
+    }
+    # the params are sent as dicts so that the redis queue can serialize them
+    for task in tasks:
+        task["params"] = task["params"].model_dump()
+    try:
+        task_manager.add_task(
+            tm.start_batch,
+            batch_id=batch_id,
+            tasks=tasks,
+            priority=priority,
+            tenant=base.get_tenant(request),
+            cost=cost,
+            resources=resources,
+        )
+    except QueueFull as e:
+        for task_id in task_ids + [batch_id]:
+            sm.state.delete_task(task_id)
+        raise _queue_full(batch_id, request_id, e)
+    except ValueError as e:
+        for task_id in task_ids + [batch_id]:
+            sm.state.delete_task(task_id)
+        raise HttpException(
+            task_id=batch_id, status_code=400, message=f"{request_id}: {str(e)}"
+        )
+    logger.success(f"Batch created: {utils.to_json(batch)}")
+    return utils.get_response(200, batch)
+
+
 def create_task(
     request: Request,
     body: Union[TaskVideoRequest, SubtitleRequest, AudioRequest],
@@ -79,6 +191,7 @@ def create_task(
 ):
     task_id = utils.get_uuid()
     request_id = base.get_task_id(request)
+    priority = base.get_priority(request, stop_at)
     try:
         task = {
             "task_id": task_id,
@@ -86,15 +199,70 @@ def create_task(
             "params": body.model_dump(),
         }
         sm.state.update_task(task_id)
-        task_manager.add_task(tm.start, task_id=task_id, params=body, stop_at=stop_at)
+        task_manager.add_task(
+            tm.start,
+            task_id=task_id,
+            params=body,
+            stop_at=stop_at,
+            priority=priority,
+            tenant=base.get_tenant(request),
+            cost=tm.estimate_cost(body, stop_at),
+            resources=tm.estimate_resources(body, stop_at),
+        )
         logger.success(f"Task created: {utils.to_json(task)}")
         return utils.get_response(200, task)
+    except QueueFull as e:
+        sm.state.delete_task(task_id)
+        raise _queue_full(task_id, request_id, e)
     except ValueError as e:
         raise HttpException(
             task_id=task_id, status_code=400, message=f"{request_id}: {str(e)}"
         )
 
 
+@router.post(
+    "/tasks/{task_id}/resume",
+    response_model=TaskResponse,
+    summary="Resume a task from its last valid checkpoint",
+)
+def resume_task(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    priority = base.get_priority(request, "resume")
+    with _resume_lock:
+        if tm.is_active(task_id, task_manager):
+            raise HttpException(
+                task_id=task_id,
+                status_code=409,
+                message=f"{request_id}: the task is already queued or running",
+            )
+        if not tm.can_resume(task_id, task_manager):
+            raise HttpException(
+                task_id=task_id,
+                status_code=404,
+                message=f"{request_id}: no checkpoint found for the task",
+            )
+
+        previous = sm.state.get_task(task_id)
+        sm.state.update_task(task_id)
+    try:
+        task_manager.add_task(
+            tm.resume,
+            task_id=task_id,
+            priority=priority,
+            tenant=base.get_tenant(request),
+            cost=tm.resume_cost(task_id),
+            resources=tm.resume_resources(task_id),
+        )
+    except QueueFull as e:
+        if previous:
+            sm.state.update_task(task_id, **previous)
+        else:
+            sm.state.delete_task(task_id)
+        raise _queue_full(task_id, request_id, e)
+    logger.success(f"Task resumed: {task_id}")
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
+
+
 @router.get(
     "/tasks/{task_id}", response_model=TaskQueryResponse, summary="Query task status"
 )
@@ -167,16 +335,15 @@ def delete_video(request: Request, task_id: str = Path(..., description="Task ID
     "/musics", response_model=BgmRetrieveResponse, summary="Retrieve local BGM files"
 )
 def get_bgm_list(request: Request):
-    suffix = "*.mp3"
-    song_dir = utils.song_dir()
-    files = glob.glob(os.path.join(song_dir, suffix))
     bgm_list = []
-    for file in files:
+    for track in bgm.list_tracks():
         bgm_list.append(
             {
-                "name": os.path.basename(file),
-                "size": os.path.getsize(file),
-                "file": file,
+                "name": track["name"],
+                "size": track["size"],
+                "file": track["file"],
+                "duration": track["duration"],
+                "loudness": track["loudness"],
             }
         )
     response = {"files": bgm_list}
@@ -199,6 +366,8 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
             # If the file already exists, it will be overwritten
             file.file.seek(0)
             buffer.write(file.file.read())
+        # an overwritten file doesn't change the directory mtime
+        bgm.get_index(force=True)
         response = {"file": save_path}
         return utils.get_response(200, response)
 
@@ -207,6 +376,25 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
     )
 
 
+@router.get(
+    "/caches", response_model=CacheStatsResponse, summary="Retrieve media cache statistics"
+)
+def get_cache_stats(request: Request):
+    # the hits and misses of all processes are kept in the storage directory
+    response = {"caches": [c.stats() for c in tm.get_caches()]}
+    return utils.get_response(200, response)
+
+
+@router.get(
+    "/queue", response_model=QueueStatsResponse, summary="Retrieve task queue statistics"
+)
+def get_queue_stats(
+    request: Request,
+    task_id: str = Query("", description="Task ID to estimate the start time of"),
+):
+    return utils.get_response(200, task_manager.stats(task_id))
+
+
 @router.get("/stream/{file_path:path}")
 async def stream_video(request: Request, file_path: str):
     tasks_dir = utils.task_dir()
@@ -21,5 +21,18 @@ TASK_STATE_FAILED = -1
 TASK_STATE_COMPLETE = 1
 TASK_STATE_PROCESSING = 4
 
+# 排队任务的优先级，数值越小越先执行
+TASK_PRIORITY_HIGH = 0
+TASK_PRIORITY_NORMAL = 1
+TASK_PRIORITY_LOW = 2
+TASK_PRIORITIES = {
+    "high": TASK_PRIORITY_HIGH,
+    "normal": TASK_PRIORITY_NORMAL,
+    "low": TASK_PRIORITY_LOW,
+}
+
 FILE_TYPE_VIDEOS = ["mp4", "mov", "mkv", "webm"]
 FILE_TYPE_IMAGES = ["jpg", "jpeg", "png", "bmp"]
+
+VIDEO_BACKEND_MOVIEPY = "moviepy"
+VIDEO_BACKEND_FFMPEG = "ffmpeg"
@@ -1,16 +1,22 @@
 import traceback
-from typing import Any
+from typing import Any, Dict, Optional
 
 from loguru import logger
 
 
 class HttpException(Exception):
     def __init__(
-        self, task_id: str, status_code: int, message: str = "", data: Any = None
+        self,
+        task_id: str,
+        status_code: int,
+        message: str = "",
+        data: Any = None,
+        headers: Optional[Dict[str, str]] = None,
     ):
         self.message = message
         self.status_code = status_code
         self.data = data
+        self.headers = headers
         # 获取异常堆栈信息
         tb_str = traceback.format_exc().strip()
         if not tb_str or tb_str == "NoneType: None":
@@ -18,7 +24,7 @@ class HttpException(Exception):
         else:
             msg = f"HttpException: {status_code}, {task_id}, {message}\n{tb_str}"
 
-        if status_code == 400:
+        if status_code in (400, 429):
             logger.warning(msg)
         else:
             logger.error(msg)
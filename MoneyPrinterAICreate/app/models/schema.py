@@ -5,6 +5,8 @@ from typing import Any, List, Optional
 import pydantic
 from pydantic import BaseModel
 
+from app.models import const
+
 # 忽略 Pydantic 的特定警告
 warnings.filterwarnings(
     "ignore",
@@ -18,6 +20,11 @@ class VideoConcatMode(str, Enum):
     sequential = "sequential"
 
 
+class VideoBackend(str, Enum):
+    moviepy = const.VIDEO_BACKEND_MOVIEPY
+    ffmpeg = const.VIDEO_BACKEND_FFMPEG
+
+
 class VideoAspect(str, Enum):
     landscape = "16:9"
     portrait = "9:16"
@@ -105,6 +112,12 @@ class VideoParams(BaseModel):
     video_concat_mode: Optional[VideoConcatMode] = VideoConcatMode.random.value
     video_clip_duration: Optional[int] = 5
     video_count: Optional[int] = 1
+    # 单次编码：拼接、字幕和配音一次合成输出，不再先写 combined 视频
+    video_single_pass: Optional[bool] = False
+    # 单次编码时是否仍然输出 combined 视频
+    video_save_combined: Optional[bool] = False
+    # 拼接视频的渲染方式：moviepy 或 ffmpeg（滤镜图，原生多核处理）
+    video_backend: Optional[VideoBackend] = VideoBackend.moviepy.value
 
     video_source: Optional[str] = "pexels"
     video_materials: Optional[List[MaterialInfo]] = None  # 用于生成视频的素材
@@ -204,6 +217,11 @@ class TaskVideoRequest(VideoParams, BaseModel):
     pass
 
 
+class TaskVideoBatchRequest(BaseModel):
+    # 批量生成的视频任务，相同的脚本、配音、字幕和素材只处理一次
+    items: List[TaskVideoRequest]
+
+
 class TaskQueryRequest(BaseModel):
     pass
 
@@ -236,6 +254,32 @@ class TaskResponse(BaseResponse):
         }
 
 
+class TaskBatchResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "batch_id": "1f3c9d2e-5b7a-4c1d-9e8f-2a6b4c8d0e1f",
+                    "task_ids": [
+                        "6c85c8cc-a77a-42b9-bc30-947815aa0558",
+                        "0b9d7f1e-3c2a-4e5b-8d6c-7a9f1e2b3c4d",
+                    ],
+                    "runs": {
+                        "script": 1,
+                        "audio": 1,
+                        "subtitle": 1,
+                        "materials": 1,
+                        "bgm": 2,
+                        "fonts": 1,
+                        "video": 2,
+                    },
+                },
+            },
+        }
+
+
 class TaskQueryResponse(BaseResponse):
     class Config:
         json_schema_extra = {
@@ -251,6 +295,32 @@ class TaskQueryResponse(BaseResponse):
                     "combined_videos": [
                         "http://127.0.0.1:8080/tasks/6c85c8cc-a77a-42b9-bc30-947815aa0558/combined-1.mp4"
                     ],
+                    "profile": {
+                        "wall_time": 61.2,
+                        "cpu_time": 97.5,
+                        "peak_rss_mb": 812.4,
+                        "read_bytes": 52428800,
+                        "write_bytes": 41943040,
+                        "stages": [
+                            {
+                                "stage": "audio",
+                                "wall_time": 3.1,
+                                "cpu_time": 0.4,
+                                "peak_rss_mb": 180.2,
+                                "read_bytes": 0,
+                                "write_bytes": 204800,
+                            },
+                            {
+                                "stage": "combine",
+                                "video": 1,
+                                "wall_time": 35.6,
+                                "cpu_time": 60.3,
+                                "peak_rss_mb": 812.4,
+                                "read_bytes": 31457280,
+                                "write_bytes": 20971520,
+                            },
+                        ],
+                    },
                 },
             },
         }
@@ -312,6 +382,8 @@ class BgmRetrieveResponse(BaseResponse):
                             "name": "output013.mp3",
                             "size": 1891269,
                             "file": "/MoneyPrinterTurbo/resource/songs/output013.mp3",
+                            "duration": 118.2,
+                            "loudness": -18.4,
                         }
                     ]
                 },
@@ -328,3 +400,52 @@ class BgmUploadResponse(BaseResponse):
                 "data": {"file": "/MoneyPrinterTurbo/resource/songs/example.mp3"},
             },
         }
+
+
+class CacheStatsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "caches": [
+                        {
+                            "name": "clips",
+                            "hits": 42,
+                            "misses": 8,
+                            "hit_rate": 0.84,
+                            "entries": 8,
+                            "size": 73400320,
+                            "max_size": 10737418240,
+                        }
+                    ]
+                },
+            },
+        }
+
+
+class QueueStatsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "depth": 12,
+                    "max_depth": 100,
+                    "running": 5,
+                    "max_running": 5,
+                    "wait_p50": 42.5,
+                    "wait_p95": 180.2,
+                    "tasks_per_minute": 2.4,
+                    "task": {
+                        "task_id": "6c85c8cc-a77a-42b9-bc30-947815aa0558",
+                        "state": "queued",
+                        "position": 3,
+                        "estimated_wait": 100.0,
+                        "estimated_start": 1718000000.0,
+                    },
+                },
+            },
+        }
@@ -0,0 +1,200 @@
+import json
+import os
+import random
+import threading
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.services import cache, ffmpeg
+from app.utils import utils
+
+# background music files
+_suffix = ".mp3"
+
+_lock = threading.Lock()
+_index = None
+# set when the running scan of the song directory is done
+_scan_done = None
+
+
+def _index_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "bgm_index.json")
+
+
+def _load_index() -> dict:
+    try:
+        with open(_index_file(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_index(index: dict):
+    index_file = _index_file()
+    temp_file = f"{index_file}.{utils.get_uuid(True)}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, index_file)
+
+
+def _analyze(file_path: str, stat: os.stat_result) -> dict:
+    info = ffmpeg.probe(file_path)
+    try:
+        loudness = ffmpeg.loudness(file_path)
+    except Exception as e:
+        logger.warning(f"failed to measure loudness: {file_path}, {str(e)}")
+        loudness = None
+    return {
+        "name": os.path.basename(file_path),
+        "file": file_path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "duration": info.duration,
+        "sample_rate": info.sample_rate,
+        "loudness": loudness,
+    }
+
+
+def _scan(song_dir: str, previous: dict) -> dict:
+    tracks = {}
+    known = previous.get("tracks", {}) if previous.get("song_dir") == song_dir else {}
+    for entry in sorted(os.scandir(song_dir), key=lambda e: e.name):
+        if not entry.is_file() or not entry.name.lower().endswith(_suffix):
+            continue
+        stat = entry.stat()
+        track = known.get(entry.name)
+        if (
+            not track
+            or track.get("size") != stat.st_size
+            or track.get("mtime_ns") != stat.st_mtime_ns
+        ):
+            try:
+                track = _analyze(entry.path, stat)
+            except Exception as e:
+                logger.warning(f"failed to index bgm: {entry.path}, {str(e)}")
+                continue
+        tracks[entry.name] = track
+    return tracks
+
+
+def get_index(force: bool = False) -> dict:
+    """
+    The BGM index, persisted in storage and rescanned only when the song
+    directory changes. Tracks that are already indexed are not analyzed
+    again unless their size or mtime changed.
+
+    The scan runs outside the lock, one at a time: meanwhile the previous
+    index is served, only callers without any index wait for the scan.
+    """
+    global _index, _scan_done
+    song_dir = utils.song_dir()
+    dir_mtime_ns = os.stat(song_dir).st_mtime_ns
+
+    with _lock:
+        if _index is None:
+            _index = _load_index()
+        if (
+            not force
+            and _index.get("song_dir") == song_dir
+            and _index.get("mtime_ns") == dir_mtime_ns
+        ):
+            return _index
+        scanning = _scan_done is not None and not force
+        if scanning:
+            scan_done = _scan_done
+        else:
+            scan_done = _scan_done = threading.Event()
+        previous = _index
+
+    if scanning:
+        if previous.get("song_dir") == song_dir:
+            return previous
+        scan_done.wait()
+        # rescanned here only if that scan failed
+        return get_index()
+
+    try:
+        tracks = _scan(song_dir, previous)
+        index = {"song_dir": song_dir, "mtime_ns": dir_mtime_ns, "tracks": tracks}
+        with _lock:
+            _index = index
+            try:
+                _save_index(index)
+            except OSError as e:
+                logger.warning(f"failed to save bgm index: {str(e)}")
+    finally:
+        with _lock:
+            if _scan_done is scan_done:
+                _scan_done = None
+        scan_done.set()
+    logger.info(f"bgm index refreshed, {len(tracks)} tracks")
+    return index
+
+
+def list_tracks() -> List[dict]:
+    return list(get_index()["tracks"].values())
+
+
+def get_track(file_path: str) -> dict:
+    track = get_index()["tracks"].get(os.path.basename(file_path))
+    if track and os.path.abspath(track["file"]) == os.path.abspath(file_path):
+        return track
+    return {}
+
+
+def random_track() -> str:
+    tracks = list(get_index()["tracks"].values())
+    if not tracks:
+        return ""
+    return random.choice(tracks)["file"]
+
+
+def get_cache() -> cache.FileCache:
+    return cache.get_cache(
+        "bgm", int(config.app.get("bgm_cache_size_mb", 1024) or 0) * 1024 * 1024
+    )
+
+
+def volume_for(file_path: str, volume: float) -> float:
+    """
+    volume with the track's loudness normalized to bgm_target_loudness (LUFS),
+    when that is set and the loudness of the track is known.
+    """
+    target = float(config.app.get("bgm_target_loudness", 0) or 0)
+    loudness = get_track(file_path).get("loudness")
+    if not target or loudness is None:
+        return volume
+    return volume * 10 ** ((target - loudness) / 20)
+
+
+def pcm_file(file_path: str) -> str:
+    """
+    The track decoded to 44.1 kHz stereo PCM, kept in the bgm cache so every
+    render after the first one skips the mp3 decode. The original file is
+    returned when the cache is disabled.
+    """
+    bgm_cache = get_cache()
+    if not bgm_cache.enabled:
+        return file_path
+
+    key = cache.make_key("pcm", cache.file_hash(file_path))
+    return bgm_cache.get_or_create(
+        key,
+        lambda temp_file: ffmpeg.run(
+            [
+                "-i",
+                file_path,
+                "-vn",
+                "-ar",
+                "44100",
+                "-ac",
+                "2",
+                "-c:a",
+                "pcm_s16le",
+                temp_file,
+            ]
+        ),
+        suffix=".wav",
+    )
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+from loguru import logger
+
+from app.utils import utils
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(file_path: str) -> str:
+    """
+    sha1 of the file content, memoized by (path, mtime, size) so that unchanged
+    files are only read once per process.
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = digest
+    return digest
+
+
+def make_key(*parts) -> str:
+    return utils.md5(json.dumps(parts, sort_keys=True, default=str))
+
+
+def link_file(src: str, dst: str):
+    """
+    Make dst a hard link of src, or a copy where links are not possible (other
+    file system, Windows without permission). An existing dst is replaced, never
+    written through, so files linked to it are left unchanged.
+    """
+    temp_path = f"{dst}.{utils.get_uuid(True)}.tmp"
+    try:
+        os.link(src, temp_path)
+    except OSError:
+        shutil.copyfile(src, temp_path)
+    os.replace(temp_path, dst)
+
+
+class FileCache:
+    """
+    A directory of generated files with LRU eviction by total size. Reading an
+    entry refreshes its mtime, which is the LRU order.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.cache_dir = utils.storage_dir(f"cache_{name}", create=True)
+        # hits and misses of this process
+        self.hits = 0
+        self.misses = 0
+        # hits and misses of all processes, the renders run in worker processes
+        self.stats_file = utils.storage_dir(f"cache_{name}.stats.json")
+        self._lock = threading.Lock()
+        # lock and number of users by key, removed when the last user is done
+        self._key_locks: Dict[str, List] = {}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{suffix}")
+
+    @contextmanager
+    def _key_lock(self, key: str):
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def get(self, key: str, suffix: str = "") -> str:
+        file_path = self._path(key, suffix)
+        if os.path.isfile(file_path):
+            try:
+                os.utime(file_path)
+            except OSError:
+                pass
+            self.hits += 1
+            self._count("hits")
+            return file_path
+        self.misses += 1
+        self._count("misses")
+        return ""
+
+    def _load_counts(self) -> dict:
+        try:
+            with open(self.stats_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _count(self, field: str):
+        # processes counting at the same moment may overwrite each other's
+        # increment, the counts are statistics and may fall slightly short
+        with self._lock:
+            counts = self._load_counts()
+            counts[field] = counts.get(field, 0) + 1
+            temp_path = f"{self.stats_file}.{utils.get_uuid(True)}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(counts, f)
+                os.replace(temp_path, self.stats_file)
+            except OSError as e:
+                logger.debug(f"failed to save the {self.name} cache stats: {str(e)}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def contains(self, key: str, suffix: str = "") -> bool:
+        """
+        Whether key is cached, without counting a hit or a miss.
+        """
+        return os.path.isfile(self._path(key, suffix))
+
+    def get_or_create(
+        self, key: str, create: Callable[[str], None], suffix: str = ""
+    ) -> str:
+        """
+        Return the cached file for key, calling create(file_path) to generate it on a miss.
+        """
+        with self._key_lock(key):
+            file_path = self.get(key, suffix)
+            if file_path:
+                return file_path
+
+            file_path = self._path(key, suffix)
+            # other processes may be writing the same entry, only complete files
+            # are moved into place
+            temp_path = self._path(f"{key}.{utils.get_uuid(True)}.tmp", suffix)
+            try:
+                create(temp_path)
+                os.replace(temp_path, file_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        self.evict()
+        return file_path
+
+    def put(self, key: str, file_path: str, suffix: str = "") -> str:
+        """
+        Add an existing file to the cache under key, linked when possible.
+        """
+        cached_file = self._path(key, suffix)
+        link_file(file_path, cached_file)
+        self.evict()
+        return cached_file
+
+    def evict(self):
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or ".tmp" in entry.name:
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        for _, size, file_path in sorted(entries):
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            total_bytes -= size
+            logger.debug(f"{self.name} cache evicted: {file_path}")
+            if total_bytes <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        entries = 0
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and ".tmp" not in entry.name:
+                entries += 1
+                total_bytes += entry.stat().st_size
+        counts = self._load_counts()
+        hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+        requests = hits + misses
+        return {
+            "name": self.name,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / requests, 4) if requests else 0,
+            "entries": entries,
+            "size": total_bytes,
+            "max_size": self.max_bytes,
+        }
+
+
+_caches: Dict[str, FileCache] = {}
+
+
+def get_cache(name: str, max_bytes: int) -> FileCache:
+    if name not in _caches:
+        _caches[name] = FileCache(name, max_bytes)
+    # the size limit follows the config
+    _caches[name].max_bytes = max_bytes
+    return _caches[name]
+
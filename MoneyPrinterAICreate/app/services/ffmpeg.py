@@ -0,0 +1,425 @@
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import List, Tuple
+
+import imageio_ffmpeg
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from app.models import const
+
+
+@dataclasses.dataclass
+class MediaInfo:
+    duration: float = 0.0
+    video_codec: str = ""
+    pix_fmt: str = ""
+    width: int = 0
+    height: int = 0
+    fps: float = 0.0
+    audio_codec: str = ""
+    sample_rate: int = 0
+    is_image: bool = False
+
+    @property
+    def has_video(self):
+        return bool(self.video_codec)
+
+    @property
+    def has_audio(self):
+        return bool(self.audio_codec)
+
+
+def get_ffmpeg_exe() -> str:
+    # honours IMAGEIO_FFMPEG_EXE, which app.config sets from `ffmpeg_path`
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def get_ffprobe_exe() -> str:
+    """
+    ffprobe is optional, the ffmpeg binary bundled with imageio-ffmpeg ships without it.
+    """
+    ffmpeg_exe = get_ffmpeg_exe()
+    name = "ffprobe.exe" if os.name == "nt" else "ffprobe"
+    sibling = os.path.join(os.path.dirname(ffmpeg_exe), name)
+    if os.path.isfile(sibling):
+        return sibling
+    return shutil.which("ffprobe") or ""
+
+
+def run(args: List[str], input_data: bytes = None) -> str:
+    cmd = [get_ffmpeg_exe(), "-hide_banner", "-nostdin", "-y", *args]
+    logger.debug(f"ffmpeg: {subprocess.list2cmdline(cmd)}")
+    result = subprocess.run(cmd, input=input_data, capture_output=True)
+    stderr = result.stderr.decode("utf-8", errors="ignore")
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({result.returncode}): {stderr[-2000:]}")
+    return stderr
+
+
+def _parse_rate(rate: str) -> float:
+    if not rate or rate == "0/0":
+        return 0.0
+    if "/" in rate:
+        num, den = rate.split("/", 1)
+        return float(num) / float(den) if float(den) else 0.0
+    return float(rate)
+
+
+def _probe_with_ffprobe(ffprobe_exe: str, file_path: str) -> MediaInfo:
+    cmd = [
+        ffprobe_exe,
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        file_path,
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"ffprobe failed: {result.stderr.decode('utf-8', errors='ignore')}"
+        )
+    data = json.loads(result.stdout.decode("utf-8", errors="ignore"))
+
+    info = MediaInfo(duration=float(data.get("format", {}).get("duration", 0) or 0))
+    for stream in data.get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type == "video" and not info.video_codec:
+            info.video_codec = stream.get("codec_name", "")
+            info.pix_fmt = stream.get("pix_fmt", "")
+            info.width = int(stream.get("width", 0))
+            info.height = int(stream.get("height", 0))
+            info.fps = _parse_rate(stream.get("avg_frame_rate")) or _parse_rate(
+                stream.get("r_frame_rate")
+            )
+        elif codec_type == "audio" and not info.audio_codec:
+            info.audio_codec = stream.get("codec_name", "")
+            info.sample_rate = int(stream.get("sample_rate", 0) or 0)
+    return info
+
+
+_duration_re = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+_video_re = re.compile(r"Stream #\S+.*?: Video: (\w+).*?, (\w+)(?:\(.*?\))?, (\d+)x(\d+)")
+_fps_re = re.compile(r"([\d.]+) (?:fps|tbr)")
+_audio_re = re.compile(r"Stream #\S+.*?: Audio: (\w+)(?:.*?, (\d+) Hz)?")
+
+
+def _probe_with_ffmpeg(file_path: str) -> MediaInfo:
+    cmd = [get_ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", file_path]
+    # ffmpeg exits with an error because no output is given, the stream infos are
+    # printed to stderr anyway
+    result = subprocess.run(cmd, capture_output=True)
+    stderr = result.stderr.decode("utf-8", errors="ignore")
+
+    info = MediaInfo()
+    match = _duration_re.search(stderr)
+    if match:
+        hours, minutes, seconds = match.groups()
+        info.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in stderr.splitlines():
+        if not info.video_codec:
+            match = _video_re.search(line)
+            if match:
+                info.video_codec = match.group(1)
+                info.pix_fmt = match.group(2)
+                info.width = int(match.group(3))
+                info.height = int(match.group(4))
+                fps_match = _fps_re.search(line)
+                if fps_match:
+                    info.fps = float(fps_match.group(1))
+                continue
+        if not info.audio_codec:
+            match = _audio_re.search(line)
+            if match:
+                info.audio_codec = match.group(1)
+                info.sample_rate = int(match.group(2) or 0)
+
+    if not info.duration and not info.has_video and not info.has_audio:
+        raise RuntimeError(f"failed to probe {file_path}: {stderr[-500:]}")
+    return info
+
+
+def _probe_image(file_path: str) -> MediaInfo:
+    # only the header is read, the pixels are decoded on first access
+    with Image.open(file_path) as img:
+        return MediaInfo(
+            video_codec=(img.format or "").lower(),
+            pix_fmt=img.mode,
+            width=img.width,
+            height=img.height,
+            is_image=True,
+        )
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe(file_path: str, mtime_ns: int, size: int) -> MediaInfo:
+    ext = os.path.splitext(file_path)[1].lstrip(".").lower()
+    if ext in const.FILE_TYPE_IMAGES:
+        return _probe_image(file_path)
+    ffprobe_exe = get_ffprobe_exe()
+    if ffprobe_exe:
+        return _probe_with_ffprobe(ffprobe_exe, file_path)
+    return _probe_with_ffmpeg(file_path)
+
+
+def probe(file_path: str) -> MediaInfo:
+    """
+    Stream infos without decoding anything. Results are cached by
+    (path, mtime, size), so a file is probed once until it changes.
+    """
+    stat = os.stat(file_path)
+    info = _probe(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    return dataclasses.replace(info)
+
+
+_pts_time_re = re.compile(r"pts_time:\s*([\d.]+)")
+
+
+def keyframes(file_path: str) -> List[float]:
+    """
+    Presentation timestamps (seconds) of all keyframes, only the keyframes are decoded.
+    """
+    stderr = run(
+        [
+            "-skip_frame",
+            "nokey",
+            "-i",
+            file_path,
+            "-map",
+            "0:v:0",
+            "-vf",
+            "showinfo",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+    return sorted({float(t) for t in _pts_time_re.findall(stderr)})
+
+
+_trace_field_re = re.compile(r"^\[trace_headers @ \S+\] \d+\s+(\S+)\s+[01]+ = (-?\d+)$")
+
+
+@dataclasses.dataclass
+class ParameterSets:
+    profile: int = 0
+    level: int = 0
+    # sha256 of the decoded fields of the extradata (the SPS / PPS of h264)
+    digest: str = ""
+
+
+@functools.lru_cache(maxsize=4096)
+def _parameter_sets(file_path: str, mtime_ns: int, size: int) -> ParameterSets:
+    stderr = run(
+        [
+            "-i",
+            file_path,
+            "-map",
+            "0:v:0",
+            "-c",
+            "copy",
+            "-bsf:v",
+            "trace_headers",
+            "-frames:v",
+            "1",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+    sets = ParameterSets()
+    fields = []
+    in_extradata = False
+    for line in stderr.splitlines():
+        if not line.startswith("[trace_headers"):
+            continue
+        if line.endswith("] Extradata"):
+            in_extradata = True
+            continue
+        if "] Packet:" in line:
+            # the headers of the first frame follow, they differ between clips
+            break
+        match = _trace_field_re.match(line)
+        if not in_extradata or not match:
+            continue
+        name, value = match.groups()
+        fields.append(f"{name}={value}")
+        if name in ("profile_idc", "general_profile_idc") and not sets.profile:
+            sets.profile = int(value)
+        elif name in ("level_idc", "general_level_idc") and not sets.level:
+            sets.level = int(value)
+    if fields:
+        sets.digest = hashlib.sha256("\n".join(fields).encode("utf-8")).hexdigest()
+    return sets
+
+
+def parameter_sets(file_path: str) -> ParameterSets:
+    """
+    Profile, level and extradata of the first video stream, read from the
+    headers without decoding. Streams can only be joined without
+    re-encoding when all three match. The digest is empty when the stream
+    has no extradata, its parameter sets are in the packets.
+    """
+    stat = os.stat(file_path)
+    sets = _parameter_sets(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    return dataclasses.replace(sets)
+
+
+def concat(
+    segments: List[Tuple[str, float]], output_file: str, audio_file: str = ""
+) -> str:
+    """
+    Join (file, outpoint) segments with the concat demuxer without re-encoding,
+    all files must share the same codec parameters. The audio track of
+    audio_file is muxed in as is.
+    """
+    list_file = f"{output_file}.concat.txt"
+    lines = []
+    for file_path, outpoint in segments:
+        escaped = os.path.abspath(file_path).replace("'", "'\\''")
+        lines.append(f"file '{escaped}'")
+        if outpoint:
+            lines.append(f"outpoint {outpoint:.6f}")
+
+    with open(list_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_file]
+    if audio_file:
+        args += ["-i", audio_file, "-map", "0:v:0", "-map", "1:a:0", "-shortest"]
+    else:
+        args += ["-map", "0:v:0", "-an"]
+    try:
+        run([*args, "-c", "copy", "-movflags", "+faststart", output_file])
+    finally:
+        os.remove(list_file)
+    return output_file
+
+
+class PipeWriter:
+    """
+    Encodes raw RGB frames written to ffmpeg's stdin. Every frame is copied
+    (and converted to uint8) into one preallocated buffer, which is handed to
+    the pipe without any further copy, so encoding doesn't allocate per frame.
+    """
+
+    def __init__(
+        self,
+        output_file: str,
+        width: int,
+        height: int,
+        fps: int = 30,
+        codec: str = "libx264",
+        preset: str = "medium",
+        crf: int = 23,
+        threads: int = 0,
+        audio_file: str = "",
+    ):
+        self.output_file = output_file
+        self.buffer = np.empty((height, width, 3), dtype=np.uint8)
+        self.frames = 0
+
+        cmd = [
+            get_ffmpeg_exe(),
+            "-hide_banner",
+            "-nostdin",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+        ]
+        if audio_file:
+            cmd += ["-i", audio_file, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "copy"]
+        else:
+            cmd += ["-an"]
+        if width % 2 or height % 2:
+            # yuv420p needs even dimensions
+            cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        cmd += ["-c:v", codec, "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p"]
+        if threads:
+            cmd += ["-threads", str(threads)]
+        cmd += ["-movflags", "+faststart", output_file]
+        logger.debug(f"ffmpeg: {subprocess.list2cmdline(cmd)}")
+
+        # stderr goes to a file, a full stderr pipe would block the encoder
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr
+        )
+        self._started = time.perf_counter()
+
+    def write_frame(self, frame: np.ndarray):
+        np.copyto(self.buffer, frame, casting="unsafe")
+        try:
+            self._proc.stdin.write(self.buffer.data)
+        except BrokenPipeError:
+            self.close()
+            raise
+        self.frames += 1
+
+    def close(self):
+        if self._proc.stdin and not self._proc.stdin.closed:
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self._proc.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode("utf-8", errors="ignore")
+        self._stderr.close()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed ({returncode}): {stderr[-2000:]}")
+
+        elapsed = time.perf_counter() - self._started
+        logger.info(
+            f"encoded {self.frames} frames in {elapsed:.2f}s "
+            f"({self.frames / elapsed if elapsed else 0:.1f} fps): {self.output_file}"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self._proc.kill()
+        self._proc.wait()
+        self._stderr.close()
+
+
+_loudness_re = re.compile(r"I:\s+(-?[\d.]+) LUFS")
+
+
+def loudness(file_path: str) -> float:
+    """
+    Integrated loudness (LUFS, EBU R128) of the first audio stream.
+    """
+    stderr = run(["-i", file_path, "-map", "0:a:0", "-af", "ebur128", "-f", "null", "-"])
+    # the per-frame log also prints I:, the summary comes last
+    values = _loudness_re.findall(stderr)
+    if not values:
+        raise RuntimeError(f"failed to measure loudness: {file_path}")
+    return float(values[-1])
@@ -5,10 +5,10 @@ from urllib.parse import urlencode
 import requests
 from typing import List
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import VideoAspect, VideoConcatMode, MaterialInfo
+from app.services import ffmpeg
 from app.utils import utils
 
 requested_count = 0
@@ -168,10 +168,9 @@ def save_video(video_url: str, save_dir: str = "") -> str:
 
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
+            info = ffmpeg.probe(video_path)
+            duration = info.duration
+            fps = info.fps
             if duration > 0 and fps > 0:
                 return video_path
         except Exception as e:
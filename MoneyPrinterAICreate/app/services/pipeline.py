@@ -0,0 +1,309 @@
+import dataclasses
+import json
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+
+from app.services import cache
+from app.utils import utils
+from app.utils.profiler import Profiler
+
+
+class StageFailed(Exception):
+    def __init__(self, stage: str, message: str = ""):
+        super().__init__(message or f"stage {stage} failed")
+        self.stage = stage
+
+
+@dataclasses.dataclass
+class Stage:
+    """
+    One step of a task. func is called with the inputs as keyword arguments
+    and returns a dict with the outputs. Stages that report partial progress
+    also get a progress(fraction) keyword argument.
+    """
+
+    name: str
+    func: Callable[..., dict]
+    inputs: Tuple[str, ...] = ()
+    outputs: Tuple[str, ...] = ()
+    cost: float = 1.0
+    reports_progress: bool = False
+    # stages that record their own parts in the profiler are not measured as a whole
+    profiled: bool = True
+    # stages with side effects only, such as warming a cache, are not checkpointed
+    checkpoint: bool = True
+    # convert the outputs to json and back for the checkpoint
+    dump: Optional[Callable[[dict], dict]] = None
+    load: Optional[Callable[[dict], dict]] = None
+
+
+def plan(stages: List[Stage], targets: Iterable[str], available: Iterable[str] = ()):
+    """
+    The stages needed to produce targets, in declaration order. Values in
+    available are given and need no stage.
+    """
+    available = set(available)
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage
+
+    needed = set()
+    missing = [t for t in targets if t not in available]
+    while missing:
+        key = missing.pop()
+        stage = producers.get(key)
+        if stage is None:
+            raise ValueError(f"no stage produces {key}")
+        if stage.name in needed:
+            continue
+        needed.add(stage.name)
+        missing.extend(k for k in stage.inputs if k not in available)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def run(
+    stages: List[Stage],
+    context: dict,
+    max_workers: int = 4,
+    on_progress: Optional[Callable[[float], None]] = None,
+    profiler: Optional[Profiler] = None,
+    checkpoint: Optional["Checkpoint"] = None,
+    keep_going: bool = False,
+) -> dict:
+    """
+    Run the stages as soon as their inputs are in context, independent ones
+    concurrently in threads. The outputs are added to context, which is
+    returned. StageFailed, or any other error of a stage, is raised once the
+    stages already running have finished; no new stage is started after a
+    failure. The outputs of every completed stage are saved to checkpoint.
+
+    With keep_going a failed stage only stops the stages that depend on it,
+    nothing is raised and the outputs that could be produced are returned.
+    """
+    profiler = profiler or Profiler()
+    context = dict(context)
+    pending = list(stages)
+    total_cost = sum(stage.cost for stage in stages) or 1
+    # completed fraction of every stage, by name
+    fractions: Dict[str, float] = {}
+    lock = threading.Lock()
+
+    def report(stage_name, fraction):
+        if not on_progress:
+            return
+        with lock:
+            fractions[stage_name] = min(max(fraction, 0), 1)
+            done = sum(
+                stage.cost * fractions.get(stage.name, 0) for stage in stages
+            )
+        on_progress(done / total_cost)
+
+    def call(stage: Stage):
+        kwargs = {key: context[key] for key in stage.inputs}
+        if stage.reports_progress:
+            kwargs["progress"] = lambda fraction: report(stage.name, fraction)
+        if stage.profiled:
+            with profiler.stage(stage.name):
+                outputs = stage.func(**kwargs) or {}
+        else:
+            outputs = stage.func(**kwargs) or {}
+        missing = [key for key in stage.outputs if key not in outputs]
+        if missing:
+            raise StageFailed(stage.name, f"stage {stage.name} did not produce {missing}")
+        return outputs
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        running = {}
+        while pending or running:
+            if error is None:
+                for stage in list(pending):
+                    if all(key in context for key in stage.inputs):
+                        pending.remove(stage)
+                        logger.debug(f"stage started: {stage.name}")
+                        running[executor.submit(call, stage)] = stage
+            if not running:
+                if error is None and pending and not keep_going:
+                    names = [stage.name for stage in pending]
+                    error = ValueError(f"stages with unresolvable inputs: {names}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    logger.error(f"stage failed: {stage.name}, {str(e)}")
+                    if not keep_going:
+                        error = error or e
+                    continue
+                context.update({key: outputs[key] for key in stage.outputs})
+                report(stage.name, 1)
+                if checkpoint is not None and stage.checkpoint:
+                    try:
+                        checkpoint.save_stage(stage, outputs)
+                    except (OSError, TypeError, ValueError) as e:
+                        logger.warning(f"failed to checkpoint stage {stage.name}: {str(e)}")
+
+    if error is not None:
+        raise error
+    return context
+
+
+def _output_files(value) -> List[str]:
+    # the files among the outputs, file paths are strings or lists of strings
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [v for v in values if isinstance(v, str) and v and os.path.isfile(v)]
+
+
+# checkpoint files are updated by every Checkpoint of a task, the stages of
+# a batch item finish in different threads
+_checkpoint_locks: Dict[str, threading.Lock] = {}
+_checkpoint_locks_lock = threading.Lock()
+
+
+def _checkpoint_lock(file_path: str) -> threading.Lock:
+    with _checkpoint_locks_lock:
+        return _checkpoint_locks.setdefault(os.path.abspath(file_path), threading.Lock())
+
+
+class Checkpoint:
+    """
+    The outputs of the completed stages of a task in a json file, with the
+    content hash of every file among them. A stage is restored only when its
+    files are unchanged and the stages it depends on were restored too.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = _checkpoint_lock(file_path)
+        self.data = self._load() or {}
+
+    def _load(self) -> Optional[dict]:
+        if not os.path.exists(self.file_path):
+            return None
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"invalid checkpoint: {self.file_path}, {str(e)}")
+            return None
+
+    def _save(self):
+        temp_file = f"{self.file_path}.{utils.get_uuid(True)}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.file_path)
+
+    def reset(self, **meta):
+        with self._lock:
+            self.data = {**meta, "stages": {}}
+            self._save()
+
+    def save_stage(self, stage: Stage, outputs: dict):
+        outputs = {key: outputs[key] for key in stage.outputs}
+        files = {}
+        for value in outputs.values():
+            for file_path in _output_files(value):
+                files[file_path] = cache.file_hash(file_path)
+        if stage.dump:
+            outputs = stage.dump(outputs)
+        with self._lock:
+            # stages saved by other Checkpoints of the task since it was loaded
+            self.data = self._load() or self.data
+            self.data.setdefault("stages", {})[stage.name] = {
+                "outputs": outputs,
+                "files": files,
+            }
+            self._save()
+
+    def restore(self, stages: List[Stage]) -> dict:
+        """
+        The outputs of the valid stages, stages are in declaration order so
+        that every stage comes after the stages it depends on.
+        """
+        records = self.data.get("stages", {})
+        producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                producers[output] = stage
+
+        context = {}
+        restored = set()
+        for stage in stages:
+            record = records.get(stage.name)
+            if not stage.checkpoint or not record:
+                continue
+            upstream = [producers[key] for key in stage.inputs if key in producers]
+            if any(s.checkpoint and s.name not in restored for s in upstream):
+                continue
+            changed = [
+                file_path
+                for file_path, digest in record.get("files", {}).items()
+                if not os.path.isfile(file_path) or cache.file_hash(file_path) != digest
+            ]
+            if changed:
+                logger.info(f"stage {stage.name} is invalid, changed files: {changed}")
+                continue
+            outputs = record["outputs"]
+            if stage.load:
+                outputs = stage.load(outputs)
+            context.update({key: outputs[key] for key in stage.outputs})
+            restored.add(stage.name)
+
+        if restored:
+            logger.info(f"restored stages: {', '.join(sorted(restored))}")
+        return context
+
+
+# measured wall time of every stage, smoothed over the tasks, used to weight
+# the progress of the stages
+_costs = None
+_costs_lock = threading.Lock()
+_smoothing = 0.3
+
+
+def _costs_file() -> str:
+    return os.path.join(utils.storage_dir(create=True), "stage_costs.json")
+
+
+def _load_costs() -> dict:
+    global _costs
+    if _costs is None:
+        try:
+            with open(_costs_file(), "r", encoding="utf-8") as f:
+                _costs = json.load(f)
+        except (OSError, ValueError):
+            _costs = {}
+    return _costs
+
+
+def estimate(name: str, default: float) -> float:
+    with _costs_lock:
+        return _load_costs().get(name, default)
+
+
+def record(wall_times: Dict[str, float]):
+    """
+    Add measured wall times, by stage name, to the smoothed stage costs.
+    """
+    with _costs_lock:
+        costs = _load_costs()
+        for name, wall_time in wall_times.items():
+            if name in costs:
+                costs[name] = round(costs[name] + _smoothing * (wall_time - costs[name]), 3)
+            else:
+                costs[name] = round(wall_time, 3)
+        try:
+            temp_file = f"{_costs_file()}.{utils.get_uuid(True)}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(costs, f, indent=2)
+            os.replace(temp_file, _costs_file())
+        except OSError as e:
+            logger.warning(f"failed to save stage costs: {str(e)}")
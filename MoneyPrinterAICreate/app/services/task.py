@@ -1,6 +1,10 @@
+import json
 import math
 import os.path
+import random
 import re
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
 from os import path
 
 from edge_tts import SubMaker
@@ -8,10 +12,11 @@ from loguru import logger
 
 from app.config import config
 from app.models import const
-from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.models.schema import VideoAspect, VideoConcatMode, VideoParams
+from app.services import bgm, cache, llm, material, pipeline, subtitle, video, voice
 from app.services import state as sm
 from app.utils import utils
+from app.utils.profiler import Profiler, mark_cached
 
 
 def generate_script(task_id, params):
@@ -71,12 +76,89 @@ def save_script_data(task_id, video_script, video_terms, params):
         f.write(utils.to_json(script_data))
 
 
+def _get_artifact_cache():
+    return cache.get_cache(
+        "artifacts",
+        int(config.app.get("artifact_cache_size_mb", 10240) or 0) * 1024 * 1024,
+    )
+
+
+def get_caches():
+    """
+    The file caches of the tasks, also when they are used only by the worker
+    processes and never by this one.
+    """
+    return [_get_artifact_cache(), video._get_clip_cache(), bgm.get_cache()]
+
+
+def _cached_artifact(key, output_file, create):
+    """
+    Link the artifact cached for key to output_file. On a miss create() writes
+    output_file, which is then added to the cache. Returns whether output_file
+    exists.
+    """
+    artifact_cache = _get_artifact_cache()
+    suffix = path.splitext(output_file)[1]
+    cached_file = artifact_cache.get(key, suffix) if artifact_cache.enabled else ""
+    if cached_file:
+        logger.info(f"reusing cached artifact: {cached_file} => {output_file}")
+        cache.link_file(cached_file, output_file)
+        mark_cached()
+        return True
+
+    # the previous output may be linked to a cache entry, never write through it
+    if path.exists(output_file):
+        os.remove(output_file)
+    create()
+    if not path.exists(output_file):
+        return False
+    if artifact_cache.enabled:
+        artifact_cache.put(key, output_file, suffix)
+    return True
+
+
+def _render_cached(render, inputs, key_parts, output_file, render_kwargs):
+    # the inputs are hashed when the stage runs, the combined video of the
+    # final stage only exists by then
+    key = cache.make_key(
+        render.__name__,
+        key_parts,
+        [cache.file_hash(file_path) if file_path else "" for file_path in inputs],
+    )
+    _cached_artifact(key, output_file, lambda: render(**render_kwargs))
+
+
+def _tts_sub_maker(sub_maker_file):
+    with open(sub_maker_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    sub_maker = SubMaker()
+    sub_maker.offset = [tuple(offset) for offset in data["offset"]]
+    sub_maker.subs = data["subs"]
+    return sub_maker
+
+
 def generate_audio(task_id, params, video_script):
     logger.info("\n\n## generating audio")
     audio_file = path.join(utils.task_dir(task_id), "audio.mp3")
+    voice_name = voice.parse_voice_name(params.voice_name)
+
+    # the voice and its word boundaries are cached together
+    artifact_cache = _get_artifact_cache()
+    key = cache.make_key("tts", video_script, voice_name, params.voice_rate)
+    cached_audio = artifact_cache.get(key, ".mp3") if artifact_cache.enabled else ""
+    cached_subs = artifact_cache.get(key, ".json") if cached_audio else ""
+    if cached_audio and cached_subs:
+        logger.info(f"reusing cached voice: {cached_audio}")
+        cache.link_file(cached_audio, audio_file)
+        mark_cached()
+        sub_maker = _tts_sub_maker(cached_subs)
+        return audio_file, math.ceil(voice.get_audio_duration(sub_maker)), sub_maker
+
+    if path.exists(audio_file):
+        os.remove(audio_file)
     sub_maker = voice.tts(
         text=video_script,
-        voice_name=voice.parse_voice_name(params.voice_name),
+        voice_name=voice_name,
         voice_rate=params.voice_rate,
         voice_file=audio_file,
     )
@@ -90,6 +172,13 @@ def generate_audio(task_id, params, video_script):
         )
         return None, None, None
 
+    if artifact_cache.enabled and path.exists(audio_file):
+        artifact_cache.put(key, audio_file, ".mp3")
+        sub_maker_file = path.join(utils.task_dir(task_id), "audio.json")
+        with open(sub_maker_file, "w", encoding="utf-8") as f:
+            json.dump({"offset": sub_maker.offset, "subs": sub_maker.subs}, f)
+        artifact_cache.put(key, sub_maker_file, ".json")
+
     audio_duration = math.ceil(voice.get_audio_duration(sub_maker))
     return audio_file, audio_duration, sub_maker
 
@@ -102,6 +191,30 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
     subtitle_provider = config.app.get("subtitle_provider", "").strip().lower()
     logger.info(f"\n\n## generating subtitle, provider: {subtitle_provider}")
 
+    key = cache.make_key(
+        "subtitle",
+        subtitle_provider,
+        cache.file_hash(audio_file),
+        video_script,
+        config.whisper.get("model_size", "large-v3"),
+    )
+    _cached_artifact(
+        key,
+        subtitle_path,
+        lambda: _create_subtitle(
+            subtitle_provider, video_script, sub_maker, audio_file, subtitle_path
+        ),
+    )
+
+    subtitle_lines = subtitle.file_to_subtitles(subtitle_path)
+    if not subtitle_lines:
+        logger.warning(f"subtitle file is invalid: {subtitle_path}")
+        return ""
+
+    return subtitle_path
+
+
+def _create_subtitle(subtitle_provider, video_script, sub_maker, audio_file, subtitle_path):
     subtitle_fallback = False
     if subtitle_provider == "edge":
         voice.create_subtitle(
@@ -116,13 +229,6 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
         logger.info("\n\n## correcting subtitle")
         subtitle.correct(subtitle_file=subtitle_path, video_script=video_script)
 
-    subtitle_lines = subtitle.file_to_subtitles(subtitle_path)
-    if not subtitle_lines:
-        logger.warning(f"subtitle file is invalid: {subtitle_path}")
-        return ""
-
-    return subtitle_path
-
 
 def get_video_materials(task_id, params):
     if params.video_source == "local" or "wan21":
@@ -157,75 +263,651 @@ def get_video_materials(task_id, params):
     #     return downloaded_videos
 
 
+def _render_key_params(params):
+    # the parameters that change the rendered video, the materials, the voice
+    # and the subtitles are keyed by the hash of their files
+    return params.model_dump(
+        mode="json",
+        exclude={"n_threads", "video_count", "video_materials", "video_script"},
+    )
+
+
+def _variant_key(task_id, index, params, video_concat_mode):
+    """
+    Random clip orders and random BGM are cached per task and video index:
+    the variants of a task differ from each other, a resumed task gets its
+    variants back and a repeated task gets new ones.
+    """
+    variant = []
+    if video_concat_mode == VideoConcatMode.random:
+        variant.extend([task_id, index])
+    if params.bgm_type == "random" and not params.bgm_file:
+        variant.extend([task_id, index, bgm.get_index().get("mtime_ns")])
+    return variant
+
+
+def _render_stages(
+    task_id, index, params, downloaded_videos, audio_file, subtitle_path, video_concat_mode
+):
+    """
+    The render stages of one output video as (stage, description, func, kwargs), to be run in order.
+    """
+    combined_video_path = path.join(utils.task_dir(task_id), f"combined-{index}.mp4")
+    final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
+
+    if params.video_single_pass:
+        if not params.video_save_combined:
+            combined_video_path = ""
+        render_kwargs = dict(
+            video_paths=downloaded_videos,
+            audio_path=audio_file,
+            subtitle_path=subtitle_path,
+            output_file=final_video_path,
+            params=params,
+            video_concat_mode=video_concat_mode,
+            combined_video_path=combined_video_path,
+        )
+        if combined_video_path:
+            # a cached final video comes without its combined video
+            func, kwargs = video.render_video, render_kwargs
+        else:
+            func, kwargs = _render_cached, dict(
+                render=video.render_video,
+                inputs=[*downloaded_videos, audio_file, subtitle_path],
+                key_parts=[
+                    _render_key_params(params),
+                    video_concat_mode,
+                    video._encoder_settings(),
+                    config.app.get("bgm_target_loudness", 0),
+                    _variant_key(task_id, index, params, video_concat_mode),
+                ],
+                output_file=final_video_path,
+                render_kwargs=render_kwargs,
+            )
+        stages = [
+            ("render", f"rendering video: {index} => {final_video_path}", func, kwargs)
+        ]
+        return final_video_path, combined_video_path, stages
+
+    stages = [
+        (
+            "combine",
+            f"combining video: {index} => {combined_video_path}",
+            _render_cached,
+            dict(
+                render=video.combine_videos,
+                inputs=[*downloaded_videos, audio_file],
+                key_parts=[
+                    params.video_aspect,
+                    video_concat_mode,
+                    params.video_clip_duration,
+                    params.video_backend,
+                    video._encoder_settings(),
+                    _variant_key(task_id, index, params, video_concat_mode),
+                ],
+                output_file=combined_video_path,
+                render_kwargs=dict(
+                    combined_video_path=combined_video_path,
+                    video_paths=downloaded_videos,
+                    audio_file=audio_file,
+                    video_aspect=params.video_aspect,
+                    video_concat_mode=video_concat_mode,
+                    max_clip_duration=params.video_clip_duration,
+                    threads=params.n_threads,
+                    backend=params.video_backend,
+                ),
+            ),
+        ),
+        (
+            "final",
+            f"generating video: {index} => {final_video_path}",
+            _render_cached,
+            dict(
+                render=video.generate_video,
+                inputs=[combined_video_path, audio_file, subtitle_path],
+                key_parts=[
+                    _render_key_params(params),
+                    video._encoder_settings(),
+                    config.app.get("bgm_target_loudness", 0),
+                    _variant_key(task_id, index, params, video_concat_mode),
+                ],
+                output_file=final_video_path,
+                render_kwargs=dict(
+                    video_path=combined_video_path,
+                    audio_path=audio_file,
+                    subtitle_path=subtitle_path,
+                    output_file=final_video_path,
+                    params=params,
+                ),
+            ),
+        ),
+    ]
+    return final_video_path, combined_video_path, stages
+
+
+def _run_render_stage(stage, description, func, kwargs):
+    # a worker process renders several videos, reseed so that every video
+    # gets its own clip order
+    random.seed()
+    logger.info(f"\n\n## {description}")
+    with Profiler().stage(stage) as measurement:
+        func(**kwargs)
+    return measurement.result
+
+
+def _peak_rss_mb(profiler):
+    # peak memory of every render, ffmpeg processes included
+    peaks = {}
+    for record in profiler.stages:
+        if "video" in record:
+            index = record["video"]
+            peaks[index] = max(peaks.get(index, 0), record["peak_rss_mb"])
+    return [peaks[index] for index in sorted(peaks)]
+
+
 def generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
+    task_id,
+    params,
+    downloaded_videos,
+    audio_file,
+    subtitle_path,
+    profiler=None,
+    progress=None,
 ):
+    """
+    progress, if given, is called with the completed fraction of the renders.
+    """
+    profiler = profiler or Profiler()
+    progress = progress or (lambda fraction: None)
     final_video_paths = []
     combined_video_paths = []
     video_concat_mode = (
         params.video_concat_mode if params.video_count == 1 else VideoConcatMode.random
     )
 
-    _progress = 50
+    render_workers = min(
+        int(config.app.get("max_render_workers", 0) or 0), params.video_count
+    )
+    if render_workers > 1 and video.worker_pool() is not None:
+        return _generate_final_videos_parallel(
+            task_id,
+            params,
+            downloaded_videos,
+            audio_file,
+            subtitle_path,
+            video_concat_mode,
+            render_workers,
+            profiler,
+            progress,
+        )
+
+    completed_stages = 0
     for i in range(params.video_count):
         index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
-        )
-        logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
-        video.combine_videos(
-            combined_video_path=combined_video_path,
-            video_paths=downloaded_videos,
-            audio_file=audio_file,
-            video_aspect=params.video_aspect,
-            video_concat_mode=video_concat_mode,
-            max_clip_duration=params.video_clip_duration,
-            threads=params.n_threads,
+        final_video_path, combined_video_path, stages = _render_stages(
+            task_id,
+            index,
+            params,
+            downloaded_videos,
+            audio_file,
+            subtitle_path,
+            video_concat_mode,
         )
+        for stage, description, func, kwargs in stages:
+            logger.info(f"\n\n## {description}")
+            with profiler.stage(stage, video=index):
+                func(**kwargs)
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+            completed_stages += 1
+            progress(completed_stages / params.video_count / len(stages))
 
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
+        final_video_paths.append(final_video_path)
+        if combined_video_path:
+            combined_video_paths.append(combined_video_path)
 
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
-        video.generate_video(
-            video_path=combined_video_path,
-            audio_path=audio_file,
-            subtitle_path=subtitle_path,
-            output_file=final_video_path,
-            params=params,
+    return final_video_paths, combined_video_paths, _peak_rss_mb(profiler)
+
+
+def _generate_final_videos_parallel(
+    task_id,
+    params,
+    downloaded_videos,
+    audio_file,
+    subtitle_path,
+    video_concat_mode,
+    render_workers,
+    profiler,
+    progress,
+):
+    # split the cores between the workers instead of every encoder using n_threads
+    threads = max(1, (os.cpu_count() or 1) // render_workers)
+    worker_params = params.model_copy(update={"n_threads": threads})
+    logger.info(
+        f"\n\n## rendering {params.video_count} videos in {render_workers} processes, "
+        f"{threads} threads each"
+    )
+
+    variants = {}
+    for index in range(1, params.video_count + 1):
+        variants[index] = _render_stages(
+            task_id,
+            index,
+            worker_params,
+            downloaded_videos,
+            audio_file,
+            subtitle_path,
+            video_concat_mode,
         )
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+    # the variants finish in any order, progress counts completed stages
+    total_stages = sum(len(stages) for _, _, stages in variants.values())
+    completed_stages = 0
+    # the pool is shared with the other tasks, the task renders at most
+    # render_workers videos at once
+    executor = video.worker_pool()
+    waiting = list(variants)
+    pending = {}
+
+    def submit(index, stage_index):
+        _, _, stages = variants[index]
+        future = executor.submit(_run_render_stage, *stages[stage_index])
+        pending[future] = (index, stage_index)
+
+    for index in waiting[:render_workers]:
+        submit(index, 0)
+    waiting = waiting[render_workers:]
+
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, stage_index = pending.pop(future)
+                stage = variants[index][2][stage_index][0]
+                profiler.add(stage, future.result(), video=index)
 
+                completed_stages += 1
+                progress(completed_stages / total_stages)
+
+                if stage_index + 1 < len(variants[index][2]):
+                    submit(index, stage_index + 1)
+                elif waiting:
+                    submit(waiting.pop(0), 0)
+    finally:
+        # a failed render fails the task, the other renders are not needed
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+    final_video_paths = []
+    combined_video_paths = []
+    for index in sorted(variants):
+        final_video_path, combined_video_path, _ = variants[index]
         final_video_paths.append(final_video_path)
-        combined_video_paths.append(combined_video_path)
+        if combined_video_path:
+            combined_video_paths.append(combined_video_path)
+    return final_video_paths, combined_video_paths, _peak_rss_mb(profiler)
 
-    return final_video_paths, combined_video_paths
 
+def save_profile(task_id, profile):
+    """
+    Add the stage measurements to script.json of the task, next to the script.
+    """
+    script_file = path.join(utils.task_dir(task_id), "script.json")
+    script_data = {}
+    if os.path.exists(script_file):
+        try:
+            with open(script_file, "r", encoding="utf-8") as f:
+                script_data = json.load(f)
+        except ValueError:
+            logger.warning(f"invalid script file: {script_file}")
 
-def start(task_id, params: VideoParams, stop_at: str = "video"):
-    logger.info(f"start task: {task_id}, stop_at: {stop_at}")
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
+    script_data["profile"] = profile
+    with open(script_file, "w", encoding="utf-8") as f:
+        f.write(utils.to_json(script_data))
 
-    if type(params.video_concat_mode) is str:
-        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
 
-    # 1. Generate script
-    video_script = generate_script(task_id, params)
-    if not video_script:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+def _log_profile(task_id, profile):
+    lines = [f"task {task_id} profile:"]
+    for record in profile["stages"]:
+        name = record["stage"]
+        if "video" in record:
+            name = f"{name}-{record['video']}"
+        lines.append(
+            f"  {name:<12} wall {record['wall_time']:>8.2f}s"
+            f"  cpu {record['cpu_time']:>8.2f}s"
+            f"  peak {record['peak_rss_mb']:>8.1f}MB"
+            f"  read {record['read_bytes'] / 1024 / 1024:>8.1f}MB"
+            f"  write {record['write_bytes'] / 1024 / 1024:>8.1f}MB"
+        )
+    lines.append(
+        f"  {'total':<12} wall {profile['wall_time']:>8.2f}s"
+        f"  cpu {profile['cpu_time']:>8.2f}s"
+    )
+    logger.info("\n".join(lines))
+
+
+def _end_task(task_id, profiler, **kwargs):
+    # final state update of the task, the stage measurements go with it
+    profile = profiler.report()
+    _log_profile(task_id, profile)
+    try:
+        save_profile(task_id, profile)
+    except OSError as e:
+        logger.warning(f"failed to save task profile: {str(e)}")
+    if kwargs.get("state") == const.TASK_STATE_COMPLETE:
+        wall_times = {}
+        for record in profile["stages"]:
+            # a stage served from a cache would drag its estimate towards zero
+            if record.get("cached"):
+                continue
+            wall_times.setdefault(record["stage"], []).append(record["wall_time"])
+        pipeline.record({k: sum(v) / len(v) for k, v in wall_times.items()})
+    sm.state.update_task(task_id, profile=profile, **kwargs)
+
+
+# outputs of the task for every stop_at, the stages are planned from them
+_stop_at_targets = {
+    "script": ("script",),
+    "audio": ("audio_file", "audio_duration"),
+    "subtitle": ("subtitle_path",),
+    "materials": ("materials",),
+    "video": ("videos", "combined_videos", "render_peak_rss_mb"),
+}
+
+# seconds, until a stage has been measured on this machine
+_default_costs = {
+    "script": 5,
+    "audio": 10,
+    "subtitle": 5,
+    "materials": 10,
+    "bgm": 1,
+    "fonts": 1,
+    "combine": 30,
+    "final": 30,
+    "render": 50,
+}
+
+
+def _cost(name):
+    return pipeline.estimate(name, _default_costs[name])
+
+
+# stages run for every stop_at, to estimate the cost of a task before it is planned
+_stop_at_stages = {
+    "script": ("script",),
+    "audio": ("script", "audio"),
+    "subtitle": ("script", "audio", "subtitle"),
+    "materials": ("materials",),
+}
+
+# script length, in characters, the stage costs are measured for on average
+_reference_script_length = 500
+
+
+# peak memory (MB) of a faster-whisper model by size, loaded for the subtitles
+_whisper_memory_mb = {
+    "tiny": 400,
+    "base": 500,
+    "small": 1000,
+    "medium": 2500,
+    "large": 4500,
+}
+
+
+def _footprint(name, params):
+    """
+    The cores and the memory (MB) a stage of the task uses at most.
+    """
+    if name == "subtitle":
+        provider = config.app.get("subtitle_provider", "").strip().lower()
+        if provider == "whisper":
+            model_size = config.whisper.get("model_size", "large-v3")
+            memory_mb = next(
+                (m for size, m in _whisper_memory_mb.items() if model_size.startswith(size)),
+                _whisper_memory_mb["large"],
+            )
+            # ctranslate2 runs on 4 threads by default
+            return 4, memory_mb
+        return 0.2, 100
+    if name == "materials":
+        return 1, 300
+    if name == "video":
+        aspect = VideoAspect(getattr(params, "video_aspect", None) or VideoAspect.portrait)
+        width, height = aspect.to_resolution()
+        # decoded frames of the clips, the subtitles and the encoder buffers
+        memory_mb = 500 + width * height / 2000
+        video_count = getattr(params, "video_count", 1) or 1
+        render_workers = min(int(config.app.get("max_render_workers", 0) or 0), video_count)
+        segment_workers = int(config.app.get("max_segment_workers", 0) or 0)
+        if render_workers > 1 or segment_workers > 1:
+            # the cores are split between the parallel renders or segments
+            workers = max(render_workers, segment_workers)
+            return utils.cpu_capacity(), memory_mb * workers
+        return getattr(params, "n_threads", 2) or 2, memory_mb
+    # script, voice, bgm and fonts: mostly waiting on the network or light work
+    return 0.2, 100
+
+
+def estimate_resources(params, stop_at: str = "video") -> dict:
+    """
+    The cores and memory (MB) a task needs at most: its heaviest stages, the
+    subtitles and the renders, do not overlap.
+    """
+    names = _stop_at_stages.get(stop_at) or (
+        "script",
+        "audio",
+        "subtitle",
+        "materials",
+        "bgm",
+        "fonts",
+        "video",
+    )
+    footprints = [_footprint(name, params) for name in names]
+    return {
+        "cpu": max(cpu for cpu, _ in footprints),
+        "memory_mb": max(memory_mb for _, memory_mb in footprints),
+    }
+
+
+def estimate_cost(params, stop_at: str = "video") -> float:
+    """
+    Estimated seconds of work of a task, from the measured stage costs. The
+    voice, the subtitles and the renders grow with the script, the renders
+    with the number of videos too.
+    """
+    if stop_at in _stop_at_stages:
+        names = _stop_at_stages[stop_at]
+    elif getattr(params, "video_single_pass", False):
+        names = ("script", "audio", "subtitle", "materials", "bgm", "fonts", "render")
+    else:
+        names = ("script", "audio", "subtitle", "materials", "bgm", "fonts", "combine", "final")
+
+    script = getattr(params, "video_script", "") or ""
+    length = len(script) / _reference_script_length if script else 1
+    length = max(length, 0.1)
+    video_count = max(getattr(params, "video_count", 1) or 1, 1)
+
+    cost = 0
+    for name in names:
+        stage_cost = _cost(name)
+        if name in ("audio", "subtitle"):
+            stage_cost *= length
+        elif name in ("combine", "final", "render"):
+            stage_cost *= length * video_count
+        cost += stage_cost
+    return round(cost, 3)
+
+
+def _prepare_bgm(params):
+    # load the bgm index, and decode a chosen track, while the voice is generated
+    if not params.bgm_type:
         return
+    bgm.get_index()
+    if params.bgm_file and os.path.exists(params.bgm_file):
+        try:
+            bgm.pcm_file(params.bgm_file)
+        except Exception as e:
+            logger.warning(f"failed to prepare bgm: {params.bgm_file}, {str(e)}")
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
 
-    if stop_at == "script":
-        sm.state.update_task(
-            task_id, state=const.TASK_STATE_COMPLETE, progress=100, script=video_script
-        )
+def _prepare_fonts(params, video_script):
+    # measure the glyphs of the script once, the subtitles are wrapped with them
+    if not params.subtitle_enabled:
+        return
+    font_path = video._get_font_path(params)
+    try:
+        metrics = video.get_font_metrics(font_path, params.font_size)
+    except OSError as e:
+        logger.warning(f"failed to load font: {font_path}, {str(e)}")
+        return
+    for char in set(video_script):
+        metrics.advance(char)
+
+
+def _dump_audio_outputs(outputs):
+    # the word boundaries of the voice are needed again for edge subtitles
+    sub_maker = outputs["sub_maker"]
+    return {
+        **outputs,
+        "sub_maker": {
+            "offset": list(getattr(sub_maker, "offset", [])),
+            "subs": list(getattr(sub_maker, "subs", [])),
+        },
+    }
+
+
+def _load_audio_outputs(outputs):
+    sub_maker = SubMaker()
+    sub_maker.offset = [tuple(offset) for offset in outputs["sub_maker"]["offset"]]
+    sub_maker.subs = list(outputs["sub_maker"]["subs"])
+    return {**outputs, "sub_maker": sub_maker}
+
+
+def _checkpoint(task_id):
+    return pipeline.Checkpoint(path.join(utils.task_dir(task_id), "checkpoint.json"))
+
+
+def _task_stages(task_id, params, profiler):
+    """
+    The stages of a task with their inputs and outputs. Stages without a
+    dependency between them, such as the voice and the materials, run
+    concurrently.
+    """
+
+    def script_stage():
+        video_script = generate_script(task_id, params)
+        if not video_script:
+            raise pipeline.StageFailed("script")
         return {"script": video_script}
+
+    def audio_stage(script):
+        audio_file, audio_duration, sub_maker = generate_audio(task_id, params, script)
+        if not audio_file:
+            raise pipeline.StageFailed("audio")
+        return {
+            "audio_file": audio_file,
+            "audio_duration": audio_duration,
+            "sub_maker": sub_maker,
+        }
+
+    def subtitle_stage(script, sub_maker, audio_file):
+        subtitle_path = generate_subtitle(task_id, params, script, sub_maker, audio_file)
+        return {"subtitle_path": subtitle_path}
+
+    def materials_stage():
+        downloaded_videos = get_video_materials(task_id, params)
+        if not downloaded_videos:
+            raise pipeline.StageFailed("materials")
+        return {"materials": downloaded_videos}
+
+    def bgm_stage():
+        _prepare_bgm(params)
+        return {"bgm_ready": True}
+
+    def fonts_stage(script):
+        _prepare_fonts(params, script)
+        return {"fonts_ready": True}
+
+    def video_stage(materials, audio_file, subtitle_path, bgm_ready, fonts_ready, progress):
+        final_video_paths, combined_video_paths, render_peak_rss_mb = (
+            generate_final_videos(
+                task_id,
+                params,
+                materials,
+                audio_file,
+                subtitle_path,
+                profiler,
+                progress,
+            )
+        )
+        if not final_video_paths:
+            raise pipeline.StageFailed("video")
+        return {
+            "videos": final_video_paths,
+            "combined_videos": combined_video_paths,
+            "render_peak_rss_mb": render_peak_rss_mb,
+        }
+
+    if params.video_single_pass:
+        render_cost = _cost("render")
+    else:
+        render_cost = _cost("combine") + _cost("final")
+
+    return [
+        pipeline.Stage("script", script_stage, (), ("script",), _cost("script")),
+        pipeline.Stage(
+            "audio",
+            audio_stage,
+            ("script",),
+            ("audio_file", "audio_duration", "sub_maker"),
+            _cost("audio"),
+            dump=_dump_audio_outputs,
+            load=_load_audio_outputs,
+        ),
+        pipeline.Stage(
+            "subtitle",
+            subtitle_stage,
+            ("script", "sub_maker", "audio_file"),
+            ("subtitle_path",),
+            _cost("subtitle"),
+        ),
+        pipeline.Stage("materials", materials_stage, (), ("materials",), _cost("materials")),
+        pipeline.Stage(
+            "bgm", bgm_stage, (), ("bgm_ready",), _cost("bgm"), checkpoint=False
+        ),
+        pipeline.Stage(
+            "fonts",
+            fonts_stage,
+            ("script",),
+            ("fonts_ready",),
+            _cost("fonts"),
+            checkpoint=False,
+        ),
+        pipeline.Stage(
+            "video",
+            video_stage,
+            ("materials", "audio_file", "subtitle_path", "bgm_ready", "fonts_ready"),
+            ("videos", "combined_videos", "render_peak_rss_mb"),
+            render_cost * params.video_count,
+            reports_progress=True,
+            # the renders of every video are profiled separately
+            profiled=False,
+        ),
+    ]
+
+
+def start(task_id, params: VideoParams, stop_at: str = "video", resume: bool = False):
+    """
+    Every completed stage is checkpointed in the task directory, with resume
+    the stages whose outputs are still valid are skipped.
+    """
+    logger.info(f"start task: {task_id}, stop_at: {stop_at}, resume: {resume}")
+    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=0)
+    profiler = Profiler()
+
+    if type(params.video_concat_mode) is str:
+        params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
+
     #
     # # 2. Generate terms
     # video_terms = ""
@@ -242,88 +924,383 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     #         task_id, state=const.TASK_STATE_COMPLETE, progress=100, terms=video_terms
     #     )
     #     return {"script": video_script, "terms": video_terms}
-    #
-    # sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
 
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(task_id, params, video_script)
-    if not audio_file:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+    all_stages = _task_stages(task_id, params, profiler)
+    checkpoint = _checkpoint(task_id)
+    context = {}
+    if resume:
+        context = checkpoint.restore(all_stages)
+    else:
+        checkpoint.reset(params=params.model_dump(mode="json"), stop_at=stop_at)
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
+    targets = _stop_at_targets.get(stop_at, _stop_at_targets["video"])
+    stages = pipeline.plan(all_stages, targets, available=context)
+    logger.info(f"task stages: {', '.join(stage.name for stage in stages)}")
 
-    if stop_at == "audio":
+    def on_progress(fraction):
+        # 100 is only reported once the task is complete
         sm.state.update_task(
-            task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            audio_file=audio_file,
+            task_id, state=const.TASK_STATE_PROCESSING, progress=min(fraction * 100, 99)
+        )
+
+    try:
+        context = pipeline.run(
+            stages,
+            context,
+            max_workers=int(config.app.get("max_stage_workers", 4) or 1),
+            on_progress=on_progress,
+            profiler=profiler,
+            checkpoint=checkpoint,
         )
-        return {"audio_file": audio_file, "audio_duration": audio_duration}
+    except pipeline.StageFailed as e:
+        logger.error(str(e))
+        _end_task(task_id, profiler, state=const.TASK_STATE_FAILED)
+        return
+    except Exception:
+        # the task can be resumed from the stages completed so far
+        _end_task(task_id, profiler, state=const.TASK_STATE_FAILED)
+        raise
 
-    # 4. Generate subtitle
-    subtitle_path = generate_subtitle(task_id, params, video_script, sub_maker, audio_file)
+    result = _task_result(task_id, stop_at, context)
+    _end_task(
+        task_id, profiler, state=const.TASK_STATE_COMPLETE, progress=100, **result
+    )
+    return result
 
-    if stop_at == "subtitle":
-        sm.state.update_task(
-            task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            subtitle_path=subtitle_path,
+
+def _task_result(task_id, stop_at, context):
+    if stop_at == "script":
+        result = {"script": context["script"]}
+    elif stop_at == "audio":
+        result = {
+            "audio_file": context["audio_file"],
+            "audio_duration": context["audio_duration"],
+        }
+    elif stop_at == "subtitle":
+        result = {"subtitle_path": context["subtitle_path"]}
+    elif stop_at == "materials":
+        result = {"materials": context["materials"]}
+    else:
+        logger.success(
+            f"task {task_id} finished, generated {len(context['videos'])} videos."
         )
-        return {"subtitle_path": subtitle_path}
+        result = {
+            "videos": context["videos"],
+            "combined_videos": context["combined_videos"],
+            "script": context["script"],
+            # "terms": video_terms,
+            "audio_file": context["audio_file"],
+            "audio_duration": context["audio_duration"],
+            "subtitle_path": context["subtitle_path"],
+            "materials": context["materials"],
+            "render_peak_rss_mb": context["render_peak_rss_mb"],
+        }
+    return result
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
 
-    # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params
-    )
-    if not downloaded_videos:
+def is_active(task_id, manager=None):
+    """
+    Whether the task is processing, or queued or running in manager. A
+    second run would share the task directory and checkpoint with it.
+    """
+    task = sm.state.get_task(task_id)
+    if task and task.get("state") == const.TASK_STATE_PROCESSING:
+        return True
+    return manager is not None and manager.has_task(task_id)
+
+
+def can_resume(task_id, manager=None):
+    if is_active(task_id, manager):
+        return False
+    if not path.exists(path.join(utils.task_dir(), task_id, "checkpoint.json")):
+        return False
+    return bool(_checkpoint(task_id).data.get("params"))
+
+
+def resume(task_id):
+    """
+    Run a task again with its original parameters, from the first stage
+    whose checkpoint is missing or invalid.
+    """
+    checkpoint = _checkpoint(task_id)
+    if not checkpoint.data.get("params"):
+        logger.error(f"no checkpoint to resume task {task_id} from")
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+        return None
+    params = VideoParams(**checkpoint.data["params"])
+    return start(
+        task_id, params, stop_at=checkpoint.data.get("stop_at", "video"), resume=True
+    )
+
+
+def estimate_batch_resources(params_list) -> dict:
+    """
+    The items of a batch render up to max_stage_workers videos at once.
+    """
+    footprints = [estimate_resources(params) for params in params_list]
+    parallel = min(len(footprints), int(config.app.get("max_stage_workers", 4) or 1))
+    return {
+        "cpu": max(f["cpu"] for f in footprints) * parallel,
+        "memory_mb": max(f["memory_mb"] for f in footprints) * parallel,
+    }
+
+
+def resume_resources(task_id) -> dict:
+    checkpoint = _checkpoint(task_id)
+    params = VideoParams(**checkpoint.data["params"])
+    return estimate_resources(params, checkpoint.data.get("stop_at", "video"))
+
+
+def resume_cost(task_id) -> float:
+    # the whole task, the stages still valid are not known before it runs
+    checkpoint = _checkpoint(task_id)
+    params = VideoParams(**checkpoint.data["params"])
+    return estimate_cost(params, checkpoint.data.get("stop_at", "video"))
+
+
+# parameters that decide the outputs of the shared stages, batch items with
+# the same values, and the same upstream stages, share the run of a stage
+_shared_stage_keys = {
+    "script": lambda p: [
+        p.video_subject,
+        p.video_script,
+        p.video_language,
+        p.paragraph_number,
+    ],
+    "audio": lambda p: [p.voice_name, p.voice_rate],
+    "subtitle": lambda p: [p.subtitle_enabled],
+    "materials": lambda p: [
+        p.video_source,
+        p.video_clip_duration,
+        [m.url for m in p.video_materials or []],
+    ],
+    "bgm": lambda p: [p.bgm_type, p.bgm_file],
+    "fonts": lambda p: [p.subtitle_enabled, p.font_name, p.font_size],
+}
+
+
+def _stage_units(task_id, params, stages):
+    """
+    The unit of every stage of a batch item. Stages of different items with
+    the same unit are run once, the render stages are never shared.
+    """
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage.name
+
+    units = {}
+    for stage in stages:
+        key_parts = _shared_stage_keys.get(stage.name)
+        if key_parts is None:
+            units[stage.name] = task_id
+            continue
+        upstream = sorted({units[producers[key]] for key in stage.inputs})
+        units[stage.name] = cache.make_key(stage.name, key_parts(params), upstream)
+    return units
+
+
+def _localize(task_id, outputs):
+    # files produced in the directory of another batch item are linked into
+    # the directory of this task, so every task stays complete on its own
+    outputs = dict(outputs)
+    for key in ("audio_file", "subtitle_path"):
+        file_path = outputs.get(key)
+        if file_path and path.dirname(file_path) != utils.task_dir(task_id):
+            local_file = path.join(utils.task_dir(task_id), path.basename(file_path))
+            cache.link_file(file_path, local_file)
+            outputs[key] = local_file
+    return outputs
+
+
+def plan_batch(params_list):
+    """
+    The number of runs of every stage for a batch, shared stages counted once.
+    """
+    runs = {}
+    for index, params in enumerate(params_list):
+        task_id = f"item-{index}"
+        stages = _task_stages(task_id, params, Profiler())
+        for name, unit in _stage_units(task_id, params, stages).items():
+            runs.setdefault(name, set()).add(unit)
+    return {name: len(units) for name, units in runs.items()}
+
 
-    if stop_at == "materials":
+def start_batch(batch_id, tasks):
+    """
+    Generate the videos of many tasks together. tasks are dicts with task_id
+    and params; the script, voice, subtitle, material and preparation stages
+    are run once for all items that share them and only the renders fan out.
+    A failed stage fails the items depending on it, the others go on.
+    """
+    started = time.time()
+    items = []
+    for task in tasks:
+        params = task["params"]
+        if isinstance(params, dict):
+            params = VideoParams(**params)
+        if type(params.video_concat_mode) is str:
+            params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
+        items.append((task["task_id"], params))
+    task_ids = [task_id for task_id, _ in items]
+    logger.info(f"start batch: {batch_id}, {len(items)} tasks")
+
+    profilers = {}
+    # batch stage name => (stage, [(task_id, stage of the task)])
+    batch_stages = {}
+    item_stages = 0
+    for task_id, params in items:
+        sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=0)
+        _checkpoint(task_id).reset(params=params.model_dump(mode="json"), stop_at="video")
+        profilers[task_id] = Profiler()
+        stages = _task_stages(task_id, params, profilers[task_id])
+        item_stages += len(stages)
+        units = _stage_units(task_id, params, stages)
+        names = {}
+        for stage in stages:
+            for output in stage.outputs:
+                names[output] = f"{units[stage.name]}/{output}"
+
+        for stage in stages:
+            name = f"{stage.name}/{units[stage.name]}"
+            if name not in batch_stages:
+                members = []
+                batch_stages[name] = (
+                    _batch_stage(name, stage, names, task_id, profilers[task_id], members),
+                    members,
+                )
+            batch_stages[name][1].append((task_id, stage))
+
+        finish = _batch_finish_stage(task_id, stages, names, profilers[task_id])
+        batch_stages[finish.name] = (finish, [])
+
+    runs = {}
+    for name in batch_stages:
+        stage_name = name.split("/")[0]
+        runs[stage_name] = runs.get(stage_name, 0) + 1
+    runs.pop("done", None)
+
+    def on_progress(fraction):
         sm.state.update_task(
-            task_id,
-            state=const.TASK_STATE_COMPLETE,
-            progress=100,
-            materials=downloaded_videos,
+            batch_id,
+            state=const.TASK_STATE_PROCESSING,
+            progress=min(fraction * 100, 99),
+            tasks=task_ids,
+            runs=runs,
         )
-        return {"materials": downloaded_videos}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
+    pipeline.run(
+        [stage for stage, _ in batch_stages.values()],
+        {},
+        max_workers=int(config.app.get("max_stage_workers", 4) or 1),
+        on_progress=on_progress,
+        keep_going=True,
+    )
 
-    # 5. Get video materials
+    completed = []
+    videos = 0
+    for task_id in task_ids:
+        task = sm.state.get_task(task_id) or {}
+        if task.get("state") == const.TASK_STATE_COMPLETE:
+            completed.append(task_id)
+            videos += len(task.get("videos", []))
+        else:
+            _end_task(task_id, profilers[task_id], state=const.TASK_STATE_FAILED)
 
-    # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
+    wall_time = time.time() - started
+    stage_runs = sum(runs.values())
+    metrics = {
+        "tasks": task_ids,
+        "completed": len(completed),
+        "failed": len(task_ids) - len(completed),
+        "videos": videos,
+        "runs": runs,
+        # stage runs saved by sharing them between the items
+        "runs_saved": item_stages - stage_runs,
+        "wall_time": round(wall_time, 3),
+        "tasks_per_minute": round(len(completed) / wall_time * 60, 2),
+        "videos_per_minute": round(videos / wall_time * 60, 2),
+    }
+    logger.success(f"batch {batch_id} finished: {utils.to_json(metrics)}")
+    sm.state.update_task(
+        batch_id,
+        state=const.TASK_STATE_COMPLETE if completed else const.TASK_STATE_FAILED,
+        progress=100,
+        **metrics,
     )
+    return metrics
 
-    if not final_video_paths:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
 
-    logger.success(
-        f"task {task_id} finished, generated {len(final_video_paths)} videos."
+def _batch_stage(name, stage, names, task_id, profiler, members):
+    """
+    stage of one batch item, run once for all members, the (task_id, stage)
+    of every item sharing it. The inputs and outputs are renamed to the
+    units that produce them.
+    """
+
+    def func(**kwargs):
+        batch_progress = kwargs.pop("progress", None)
+        args = {key: kwargs[names[key]] for key in stage.inputs}
+
+        def progress(fraction):
+            batch_progress(fraction)
+            sm.state.update_task(
+                task_id,
+                state=const.TASK_STATE_PROCESSING,
+                progress=min(fraction * 100, 99),
+            )
+
+        if stage.reports_progress:
+            args["progress"] = progress
+        if stage.profiled:
+            with profiler.stage(stage.name):
+                outputs = stage.func(**args) or {}
+        else:
+            outputs = stage.func(**args) or {}
+
+        if stage.checkpoint:
+            for member_id, member_stage in members:
+                try:
+                    _checkpoint(member_id).save_stage(
+                        member_stage, _localize(member_id, outputs)
+                    )
+                except (OSError, TypeError, ValueError) as e:
+                    logger.warning(f"failed to checkpoint stage {name}: {str(e)}")
+        return {names[key]: outputs[key] for key in stage.outputs if key in outputs}
+
+    return pipeline.Stage(
+        name,
+        func,
+        tuple(names[key] for key in stage.inputs),
+        tuple(names[key] for key in stage.outputs),
+        stage.cost,
+        reports_progress=stage.reports_progress,
+        profiled=False,
+        checkpoint=False,
     )
 
-    kwargs = {
-        "videos": final_video_paths,
-        "combined_videos": combined_video_paths,
-        "script": video_script,
-        # "terms": video_terms,
-        "audio_file": audio_file,
-        "audio_duration": audio_duration,
-        "subtitle_path": subtitle_path,
-        "materials": downloaded_videos,
-    }
-    sm.state.update_task(
-        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+
+def _batch_finish_stage(task_id, stages, names, profiler):
+    # completes one batch item as soon as its videos are rendered
+    keys = [key for stage in stages if stage.checkpoint for key in stage.outputs]
+
+    def func(**kwargs):
+        context = _localize(task_id, {key: kwargs[names[key]] for key in keys})
+        result = _task_result(task_id, "video", context)
+        _end_task(
+            task_id, profiler, state=const.TASK_STATE_COMPLETE, progress=100, **result
+        )
+        return {f"{task_id}/done": True}
+
+    return pipeline.Stage(
+        f"done/{task_id}",
+        func,
+        tuple(names[key] for key in keys),
+        (f"{task_id}/done",),
+        0,
+        profiled=False,
+        checkpoint=False,
     )
-    return kwargs
 
 
 if __name__ == "__main__":
@@ -1,16 +1,29 @@
-import glob
+import functools
+import math
+import multiprocessing
 import random
-from typing import List
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import List, Optional, Tuple
 
+import numpy as np
 from loguru import logger
 from moviepy.editor import *
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
+from app.config import config
 from app.models import const
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
+from app.services import bgm, cache, ffmpeg
 from app.utils import utils
 
+# the profile written by combine_videos, clips already encoded like this can be
+# joined without re-encoding
+_stream_copy_codec = "h264"
+_stream_copy_pix_fmt = "yuv420p"
+_stream_copy_fps = 30
+
 
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
     if not bgm_type:
@@ -20,14 +33,138 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
         return bgm_file
 
     if bgm_type == "random":
-        suffix = "*.mp3"
-        song_dir = utils.song_dir()
-        files = glob.glob(os.path.join(song_dir, suffix))
-        return random.choice(files)
+        return bgm.random_track()
 
     return ""
 
 
+class ClipRegistry:
+    """
+    Tracks the clips that own ffmpeg readers and closes them all on exit.
+    Subclips, resized and composite clips share the readers of their
+    sources, so closing the sources releases everything of a render.
+    """
+
+    def __init__(self):
+        self._clips = []
+
+    def add(self, clip):
+        self._clips.append(clip)
+        return clip
+
+    def video(self, video_path: str, **kwargs) -> VideoFileClip:
+        return self.add(VideoFileClip(video_path, **kwargs))
+
+    def audio(self, audio_path: str) -> AudioFileClip:
+        return self.add(AudioFileClip(audio_path))
+
+    def close(self):
+        while self._clips:
+            clip = self._clips.pop()
+            try:
+                clip.close()
+            except Exception as e:
+                logger.warning(f"failed to close clip: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _probe_stream_copy_clips(video_paths: List[str], video_width, video_height):
+    infos = []
+    for video_path in video_paths:
+        ext = utils.parse_extension(video_path)
+        if ext not in const.FILE_TYPE_VIDEOS:
+            logger.debug(f"stream copy disabled, not a video file: {video_path}")
+            return None
+        try:
+            info = ffmpeg.probe(video_path)
+        except Exception as e:
+            logger.warning(f"failed to probe video: {video_path}, {str(e)}")
+            return None
+
+        if (
+            info.video_codec != _stream_copy_codec
+            or info.pix_fmt != _stream_copy_pix_fmt
+            or (info.width, info.height) != (video_width, video_height)
+            or abs(info.fps - _stream_copy_fps) > 0.01
+        ):
+            logger.debug(
+                f"stream copy disabled, {video_path}: {info.video_codec}, {info.pix_fmt}, "
+                f"{info.width} x {info.height}, {info.fps} fps"
+            )
+            return None
+        infos.append(info)
+
+    # streams of different encoders can't be spliced even with the same
+    # codec and size, the decoder keeps the parameter sets of the first clip
+    reference = None
+    for video_path in video_paths:
+        try:
+            sets = ffmpeg.parameter_sets(video_path)
+        except Exception as e:
+            logger.warning(f"failed to read parameter sets: {video_path}, {str(e)}")
+            return None
+        if not sets.digest:
+            logger.debug(f"stream copy disabled, no extradata: {video_path}")
+            return None
+        reference = reference or sets
+        if sets != reference:
+            logger.debug(
+                f"stream copy disabled, {video_path}: profile {sets.profile}, "
+                f"level {sets.level}, extradata differs from {video_paths[0]}"
+            )
+            return None
+    return infos
+
+
+def _combine_videos_stream_copy(
+    combined_video_path: str,
+    video_paths: List[str],
+    infos: List[ffmpeg.MediaInfo],
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+) -> str:
+    req_dur = audio_duration / len(video_paths)
+    sources = list(zip(video_paths, infos))
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        random.shuffle(sources)
+
+    # without re-encoding a clip can only end right before a keyframe, so each clip
+    # runs until the first keyframe after the required duration instead of being retimed
+    keyframe_times = {}
+    segments = []
+    video_duration = 0
+    # a remainder shorter than one frame can't be shown anyway
+    frame_duration = 1 / _stream_copy_fps
+    while audio_duration - video_duration >= frame_duration:
+        for video_path, info in sources:
+            remaining = audio_duration - video_duration
+            if remaining < frame_duration:
+                break
+
+            required = min(req_dur, max_clip_duration, remaining)
+            if video_path not in keyframe_times:
+                keyframe_times[video_path] = ffmpeg.keyframes(video_path)
+            cut = next(
+                (t for t in keyframe_times[video_path] if required <= t < info.duration),
+                0,
+            )
+            segments.append((video_path, cut))
+            video_duration += cut or info.duration
+
+    logger.info(
+        f"stream copy {len(segments)} segments, duration: {video_duration:.2f} seconds"
+    )
+    ffmpeg.concat(segments, combined_video_path)
+    logger.success("completed")
+    return combined_video_path
+
+
 def combine_videos(
     combined_video_path: str,
     video_paths: List[str],
@@ -36,126 +173,661 @@ def combine_videos(
     video_concat_mode: VideoConcatMode = VideoConcatMode.random,
     max_clip_duration: int = 5,
     threads: int = 2,
+    backend: str = const.VIDEO_BACKEND_MOVIEPY,
 ) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+    aspect = VideoAspect(video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    infos = _probe_stream_copy_clips(video_paths, video_width, video_height)
+    if infos:
+        try:
+            audio_duration = ffmpeg.probe(audio_file).duration
+            logger.info(
+                f"all clips match {video_width} x {video_height} {_stream_copy_codec}, "
+                f"{_stream_copy_fps} fps, joining without re-encoding"
+            )
+            return _combine_videos_stream_copy(
+                combined_video_path=combined_video_path,
+                video_paths=video_paths,
+                infos=infos,
+                audio_duration=audio_duration,
+                video_concat_mode=video_concat_mode,
+                max_clip_duration=max_clip_duration,
+            )
+        except Exception as e:
+            logger.warning(f"stream copy failed, fallback to re-encoding: {str(e)}")
+
+    if _get_clip_cache().enabled:
+        return _combine_videos_cached(
+            combined_video_path=combined_video_path,
+            video_paths=video_paths,
+            audio_duration=ffmpeg.probe(audio_file).duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=max_clip_duration,
+            backend=backend,
+            threads=threads,
+        )
+
+    if backend == const.VIDEO_BACKEND_FFMPEG:
+        return _combine_videos_ffmpeg(
+            combined_video_path=combined_video_path,
+            video_paths=video_paths,
+            audio_duration=ffmpeg.probe(audio_file).duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=max_clip_duration,
+        )
+
+    audio_duration = ffmpeg.probe(audio_file).duration
     logger.info(f"max duration of audio: {audio_duration} seconds")
+
+    with ClipRegistry() as clips:
+        video_clip = _concatenate_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=max_clip_duration,
+            clips=clips,
+        )
+        logger.info("writing")
+        _write_clip(video_clip, combined_video_path, threads=threads)
+    logger.success("completed")
+    return combined_video_path
+
+
+def _encoder_settings():
+    return (
+        config.app.get("video_codec", "libx264"),
+        config.app.get("video_preset", "medium"),
+        int(config.app.get("video_crf", 23)),
+    )
+
+
+def _frame_index(t: float) -> int:
+    # the first output frame at or after t seconds, at 30 fps; the tolerance
+    # keeps float error from moving a boundary that falls on a frame
+    return math.ceil(t * 30 - 0.0001)
+
+
+def _write_clip(
+    clip,
+    output_file: str,
+    threads: int = 2,
+    audio: bool = True,
+    audio_file: str = "",
+    frame_count: Optional[int] = None,
+):
+    """
+    Encode a moviepy clip at 30 fps, frames are piped straight into ffmpeg.
+    The audio track, the clip's own or audio_file, is muxed without re-encoding.
+    frame_count defaults to the frames that start before the clip ends.
+    """
+    if frame_count is None:
+        frame_count = _frame_index(clip.duration)
+    codec, preset, crf = _encoder_settings()
+    temp_audio_file = ""
+    if audio and not audio_file and clip.audio is not None:
+        audio_file = temp_audio_file = f"{output_file}.audio.m4a"
+        clip.audio.write_audiofile(audio_file, fps=44100, codec="aac", logger=None)
+
+    width, height = clip.size
+    try:
+        with ffmpeg.PipeWriter(
+            output_file,
+            width,
+            height,
+            fps=30,
+            codec=codec,
+            preset=preset,
+            crf=crf,
+            threads=threads,
+            audio_file=audio_file,
+        ) as writer:
+            for frame_index in range(frame_count):
+                writer.write_frame(clip.get_frame(frame_index / 30))
+    finally:
+        if temp_audio_file and os.path.exists(temp_audio_file):
+            os.remove(temp_audio_file)
+
+
+def _clip_type(video_path: str) -> str:
+    ext = os.path.splitext(video_path)[1].lower()  # 获取文件扩展名
+    if ext in [".mp4", ".avi", ".mov", ".mkv"]:  # 视频文件
+        return "video"
+    if ext in [".png", ".jpg", ".jpeg"]:  # 图片文件
+        return "image"
+    return ""  # 忽略其他类型的文件
+
+
+def _plan_clips(
+    source_durations: List[float],
+    req_dur: float,
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+) -> List[Tuple[int, float]]:
+    """
+    The timeline shared by all render backends: (source index, duration) per clip.
+    Every source is retimed to req_dur, so each clip shows the first
+    duration / req_dur of its source.
+    """
+    order = list(range(len(source_durations)))
+    # random video_paths order
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        random.shuffle(order)
+
+    segments = []
+    video_duration = 0
+    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+    while order and audio_duration - video_duration > 0.001:
+        for index in order:
+            remaining = audio_duration - video_duration
+            if remaining <= 0.001:
+                break
+            duration = min(req_dur, remaining, max_clip_duration)
+            segments.append((index, duration))
+            video_duration += duration
+    return segments
+
+
+def _fit_size(clip_w: int, clip_h: int, video_width: int, video_height: int):
+    clip_ratio = clip_w / clip_h
+    video_ratio = video_width / video_height
+
+    if clip_ratio == video_ratio:
+        # 等比例缩放
+        return video_width, video_height
+
+    # 等比缩放视频
+    if clip_ratio > video_ratio:
+        # 按照目标宽度等比缩放
+        scale_factor = video_width / clip_w
+    else:
+        # 按照目标高度等比缩放
+        scale_factor = video_height / clip_h
+    return int(clip_w * scale_factor), int(clip_h * scale_factor)
+
+
+def _fit_clip(clip, video_width: int, video_height: int):
+    # Not all videos are same size, so we need to resize them
+    clip_w, clip_h = clip.size
+    if clip_w == video_width and clip_h == video_height:
+        return clip
+
+    new_width, new_height = _fit_size(clip_w, clip_h, video_width, video_height)
+    if (new_width, new_height) == (video_width, video_height):
+        clip = clip.resize((video_width, video_height))
+    else:
+        clip_resized = clip.resize(newsize=(new_width, new_height))
+
+        background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+        clip = CompositeVideoClip(
+            [
+                background.set_duration(clip.duration),
+                clip_resized.set_position("center"),
+            ]
+        )
+
+    logger.info(
+        f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
+    )
+    return clip
+
+
+def _concatenate_clips(
+    video_paths: List[str],
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+    clips: ClipRegistry,
+):
     # Required duration of each clip
     req_dur = audio_duration / len(video_paths)
     #req_dur = max_clip_duration
     logger.info(f"each clip will be maximum {req_dur} seconds long")
-    output_dir = os.path.dirname(combined_video_path)
-
-    aspect = VideoAspect(video_aspect)
-    video_width, video_height = aspect.to_resolution()
-
-    clips = []
-    video_duration = 0
 
     raw_clips = []
     for video_path in video_paths:
-        ext = os.path.splitext(video_path)[1].lower()  # 获取文件扩展名
-        if ext in ['.mp4', '.avi', '.mov', '.mkv']:  # 视频文件
-            clip = VideoFileClip(video_path).without_audio()
-        elif ext in ['.png', '.jpg', '.jpeg']:  # 图片文件
+        clip_type = _clip_type(video_path)
+        if clip_type == "video":
+            clip = clips.video(video_path, audio=False)
+        elif clip_type == "image":
             # 为图片设置一个固定持续时间，例如 5 秒
             clip = ImageClip(video_path, duration=5)
         else:
-            continue  # 忽略其他类型的文件
+            continue
 
         if clip.duration != req_dur:
             speed_factor = clip.duration / req_dur
             clip = clip.fx(vfx.speedx, speed_factor)
-            #clip = clip.set_duration(req_dur).set_fps(clip.fps * (clip.duration / req_dur))
-            #clip.write_videofile(f"local_videos\\{random.randint(1,1000)}.mp4")
         raw_clips.append(clip)
 
+    segments = _plan_clips(
+        source_durations=[clip.duration for clip in raw_clips],
+        req_dur=req_dur,
+        audio_duration=audio_duration,
+        video_concat_mode=video_concat_mode,
+        max_clip_duration=max_clip_duration,
+    )
 
-    # random video_paths order
-    if video_concat_mode.value == VideoConcatMode.random.value:
-        random.shuffle(raw_clips)
+    timeline = []
+    for index, duration in segments:
+        clip = raw_clips[index]
+        if duration < clip.duration:
+            clip = clip.subclip(0, duration)
+        clip = clip.set_fps(30)
+        timeline.append(_fit_clip(clip, video_width, video_height))
+
+    video_clip = concatenate_videoclips(timeline)
+    video_clip = video_clip.set_fps(30)
+    return video_clip
 
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    while video_duration < audio_duration:
-        for clip in raw_clips:
-            # Check if clip is longer than the remaining audio
-            if (audio_duration - video_duration) < clip.duration:
-                clip = clip.subclip(0, (audio_duration - video_duration))
-            # Only shorten clips if the calculated clip length (req_dur) is shorter than the actual clip to prevent still image
-            elif req_dur < clip.duration:
-                clip = clip.subclip(0, req_dur)
-            clip = clip.set_fps(30)
-
-            # Not all videos are same size, so we need to resize them
-            clip_w, clip_h = clip.size
-            if clip_w != video_width or clip_h != video_height:
-                clip_ratio = clip.w / clip.h
-                video_ratio = video_width / video_height
-
-                if clip_ratio == video_ratio:
-                    # 等比例缩放
-                    clip = clip.resize((video_width, video_height))
-                else:
-                    # 等比缩放视频
-                    if clip_ratio > video_ratio:
-                        # 按照目标宽度等比缩放
-                        scale_factor = video_width / clip_w
-                    else:
-                        # 按照目标高度等比缩放
-                        scale_factor = video_height / clip_h
-
-                    new_width = int(clip_w * scale_factor)
-                    new_height = int(clip_h * scale_factor)
-                    clip_resized = clip.resize(newsize=(new_width, new_height))
-
-                    background = ColorClip(
-                        size=(video_width, video_height), color=(0, 0, 0)
-                    )
-                    clip = CompositeVideoClip(
-                        [
-                            background.set_duration(clip.duration),
-                            clip_resized.set_position("center"),
-                        ]
-                    )
-
-                logger.info(
-                    f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}"
-                )
 
-            if clip.duration > max_clip_duration:
-                clip = clip.subclip(0, max_clip_duration)
+def _probe_sources(video_paths: List[str]):
+    """
+    (path, type, duration, width, height) of every usable material, images
+    last 5 seconds like in _concatenate_clips.
+    """
+    sources = []
+    for video_path in video_paths:
+        clip_type = _clip_type(video_path)
+        if not clip_type:
+            continue
+        info = ffmpeg.probe(video_path)
+        duration = info.duration if clip_type == "video" else 5
+        sources.append((video_path, clip_type, duration, info.width, info.height))
+    return sources
 
-            clips.append(clip)
-            video_duration += clip.duration
 
-    video_clip = concatenate_videoclips(clips)
-    video_clip = video_clip.set_fps(30)
-    logger.info("writing")
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/111#issuecomment-2032354030
-    video_clip.write_videofile(
-        filename=combined_video_path,
-        threads=threads,
-        logger=None,
-        temp_audiofile_path=output_dir,
-        audio_codec="aac",
-        fps=30,
+def _frame_counts(segments: List[Tuple[int, float]]) -> List[int]:
+    # frames per clip, so that clip boundaries fall on the same output frames as
+    # moviepy's continuous timeline
+    frame_counts = []
+    video_duration = 0
+    for _, duration in segments:
+        start_frame = _frame_index(video_duration)
+        video_duration += duration
+        frame_counts.append(_frame_index(video_duration) - start_frame)
+    return frame_counts
+
+
+def _ffmpeg_clip_filter(
+    source, req_dur: float, frame_count: int, video_width: int, video_height: int
+):
+    """
+    Input arguments and filter chain that turn a source into frame_count
+    normalized frames, the ffmpeg equivalent of the moviepy clip processing.
+    """
+    video_path, clip_type, source_duration, clip_w, clip_h = source
+    # one extra frame of input so that trim never runs short
+    duration = (frame_count + 1) / 30
+    if clip_type == "image":
+        input_args = ["-loop", "1", "-framerate", "30", "-t", f"{duration:.6f}"]
+        chain = ["setpts=PTS-STARTPTS"]
+    else:
+        speed_factor = source_duration / req_dur
+        input_args = ["-t", f"{duration * speed_factor:.6f}"]
+        chain = [f"setpts=(PTS-STARTPTS)/{speed_factor:.6f}"]
+    input_args += ["-i", video_path]
+    chain.append("fps=30:round=down")
+
+    if (clip_w, clip_h) != (video_width, video_height):
+        new_width, new_height = _fit_size(clip_w, clip_h, video_width, video_height)
+        # the same interpolation moviepy's opencv resizer picks
+        flags = "bilinear" if new_width > clip_w else "area"
+        chain.append(f"scale={new_width}:{new_height}:flags={flags}")
+        if (new_width, new_height) != (video_width, video_height):
+            x = int((video_width - new_width) / 2)
+            y = int((video_height - new_height) / 2)
+            chain.append(f"pad={video_width}:{video_height}:{x}:{y}:black")
+    chain += ["setsar=1", "format=yuv420p"]
+    chain.append(f"trim=end_frame={frame_count}")
+    chain.append("setpts=PTS-STARTPTS")
+    return input_args, chain
+
+
+def _ffmpeg_encode_args(output_file: str):
+    codec, preset, crf = _encoder_settings()
+    return [
+        "-r",
+        "30",
+        "-c:v",
+        codec,
+        "-preset",
+        preset,
+        "-crf",
+        str(crf),
+        "-pix_fmt",
+        "yuv420p",
+        "-an",
+        "-movflags",
+        "+faststart",
+        output_file,
+    ]
+
+
+# segments per ffmpeg invocation, every segment is a separate decoder
+_ffmpeg_chunk_size = 16
+
+
+def _combine_videos_ffmpeg(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+) -> str:
+    """
+    The same timeline as _concatenate_clips, compiled into an ffmpeg filtergraph
+    (setpts, scale, pad, fps, concat) so all pixel work runs natively.
+    """
+    req_dur = audio_duration / len(video_paths)
+    logger.info(f"each clip will be maximum {req_dur} seconds long")
+
+    sources = _probe_sources(video_paths)
+    segments = _plan_clips(
+        source_durations=[source[2] for source in sources],
+        req_dur=req_dur,
+        audio_duration=audio_duration,
+        video_concat_mode=video_concat_mode,
+        max_clip_duration=max_clip_duration,
     )
-    video_clip.close()
+    timeline = [
+        (index, frame_count)
+        for (index, _), frame_count in zip(segments, _frame_counts(segments))
+    ]
+
+    def render_chunk(chunk, output_file):
+        inputs = []
+        filters = []
+        for i, (index, frame_count) in enumerate(chunk):
+            input_args, chain = _ffmpeg_clip_filter(
+                sources[index], req_dur, frame_count, video_width, video_height
+            )
+            inputs += input_args
+            filters.append(f"[{i}:v]{','.join(chain)}[v{i}]")
+
+        labels = "".join(f"[v{i}]" for i in range(len(chunk)))
+        filters.append(f"{labels}concat=n={len(chunk)}:v=1:a=0[out]")
+        ffmpeg.run(
+            [
+                *inputs,
+                "-filter_complex",
+                ";".join(filters),
+                "-map",
+                "[out]",
+                *_ffmpeg_encode_args(output_file),
+            ]
+        )
+
+    logger.info(f"rendering {len(timeline)} clips with ffmpeg")
+    chunks = [
+        timeline[i : i + _ffmpeg_chunk_size]
+        for i in range(0, len(timeline), _ffmpeg_chunk_size)
+    ]
+    if len(chunks) == 1:
+        render_chunk(chunks[0], combined_video_path)
+    else:
+        # every chunk is encoded with the same settings, so the chunks can be
+        # joined without re-encoding
+        part_files = [f"{combined_video_path}.part{i}.mp4" for i in range(len(chunks))]
+        try:
+            for chunk, part_file in zip(chunks, part_files):
+                render_chunk(chunk, part_file)
+            ffmpeg.concat([(part_file, 0) for part_file in part_files], combined_video_path)
+        finally:
+            for part_file in part_files:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+
     logger.success("completed")
     return combined_video_path
 
 
-def wrap_text(text, max_width, font="Arial", fontsize=60):
-    # 创建字体对象
-    font = ImageFont.truetype(font, fontsize)
+def _get_clip_cache():
+    return cache.get_cache(
+        "clips", int(config.app.get("clip_cache_size_mb", 10240) or 0) * 1024 * 1024
+    )
+
+
+def _normalize_clip(
+    source,
+    req_dur: float,
+    frame_count: int,
+    video_width: int,
+    video_height: int,
+    backend: str,
+    threads: int,
+    output_file: str,
+):
+    if backend == const.VIDEO_BACKEND_FFMPEG:
+        input_args, chain = _ffmpeg_clip_filter(
+            source, req_dur, frame_count, video_width, video_height
+        )
+        ffmpeg.run(
+            [
+                *input_args,
+                "-filter_complex",
+                f"[0:v]{','.join(chain)}[out]",
+                "-map",
+                "[out]",
+                *_ffmpeg_encode_args(output_file),
+            ]
+        )
+        return
+
+    video_path, clip_type, source_duration, _, _ = source
+    with ClipRegistry() as clips:
+        if clip_type == "video":
+            clip = clips.video(video_path, audio=False)
+        else:
+            clip = ImageClip(video_path, duration=source_duration)
+        if clip.duration != req_dur:
+            clip = clip.fx(vfx.speedx, clip.duration / req_dur)
+        clip = clip.subclip(0, frame_count / 30).set_fps(30)
+        clip = _fit_clip(clip, video_width, video_height)
+        _write_clip(
+            clip, output_file, threads=threads, audio=False, frame_count=frame_count
+        )
+
+
+def _plan_cached_clips(
+    video_paths: List[str],
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+    backend: str,
+) -> List[Tuple[str, tuple, int]]:
+    """
+    The clips of the timeline as (cache key, source, frame count), keyed by
+    the content of the material and the normalization.
+    """
+    req_dur = audio_duration / len(video_paths)
+    sources = _probe_sources(video_paths)
+    segments = _plan_clips(
+        source_durations=[source[2] for source in sources],
+        req_dur=req_dur,
+        audio_duration=audio_duration,
+        video_concat_mode=video_concat_mode,
+        max_clip_duration=max_clip_duration,
+    )
+
+    clips = []
+    for (index, _), frame_count in zip(segments, _frame_counts(segments)):
+        source = sources[index]
+        key = cache.make_key(
+            cache.file_hash(source[0]),
+            video_width,
+            video_height,
+            30,
+            round(source[2] / req_dur, 6),
+            frame_count,
+            backend,
+            *_encoder_settings(),
+        )
+        clips.append((key, source, frame_count))
+    return clips
+
+
+def _plan_cached_clips_if_complete(
+    video_paths: List[str],
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+    backend: str,
+):
+    """
+    The timeline of _plan_cached_clips when every clip of it is cached, None
+    when the clip cache is disabled or a clip is missing.
+    """
+    clip_cache = _get_clip_cache()
+    if not clip_cache.enabled:
+        return None
+    try:
+        clips = _plan_cached_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=max_clip_duration,
+            backend=backend,
+        )
+    except Exception as e:
+        logger.warning(f"failed to plan the cached clips: {str(e)}")
+        return None
+    if not clips or not all(clip_cache.contains(key, ".mp4") for key, _, _ in clips):
+        return None
+    return clips
 
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
 
-    width, height = get_text_size(text)
-    if width <= max_width:
+def _combine_videos_cached(
+    combined_video_path: str,
+    video_paths: List[str],
+    audio_duration: float,
+    video_width: int,
+    video_height: int,
+    video_concat_mode: VideoConcatMode,
+    max_clip_duration: int,
+    backend: str,
+    threads: int,
+    clips: List[Tuple[str, tuple, int]] = None,
+) -> str:
+    """
+    Every clip of the timeline is normalized (retimed, resized, letterboxed,
+    30 fps) into its own file in the clip cache, keyed by the content of the
+    material and the normalization. The cached clips share one encoding profile
+    and are joined without re-encoding. clips is the timeline planned by
+    _plan_cached_clips, planned here when not given.
+    """
+    req_dur = audio_duration / len(video_paths)
+    logger.info(f"each clip will be maximum {req_dur} seconds long")
+
+    clip_cache = _get_clip_cache()
+    hits, misses = clip_cache.hits, clip_cache.misses
+
+    if clips is None:
+        clips = _plan_cached_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=max_clip_duration,
+            backend=backend,
+        )
+
+    clip_files = []
+    for key, source, frame_count in clips:
+        clip_files.append(
+            clip_cache.get_or_create(
+                key,
+                lambda output_file: _normalize_clip(
+                    source,
+                    req_dur,
+                    frame_count,
+                    video_width,
+                    video_height,
+                    backend,
+                    threads,
+                    output_file,
+                ),
+                suffix=".mp4",
+            )
+        )
+
+    logger.info(
+        f"clip cache: {clip_cache.hits - hits} hits, {clip_cache.misses - misses} misses, "
+        f"total {clip_cache.hits} hits, {clip_cache.misses} misses"
+    )
+    ffmpeg.concat([(clip_file, 0) for clip_file in clip_files], combined_video_path)
+    logger.success("completed")
+    return combined_video_path
+
+
+class FontMetrics:
+    """
+    Advance widths of one font at one size. Every character and kerning pair is
+    measured once, so the width of a string is a sum instead of a layout.
+    """
+
+    def __init__(self, font_path: str, font_size: int):
+        self.font = ImageFont.truetype(font_path, font_size)
+        self._advances = {}
+        self._kerning = {}
+
+    def advance(self, char: str) -> float:
+        advance = self._advances.get(char)
+        if advance is None:
+            advance = self._advances[char] = self.font.getlength(char)
+        return advance
+
+    def kerning(self, left: str, right: str) -> float:
+        # fonts without a kerning table always measure 0 here
+        pair = left + right
+        kerning = self._kerning.get(pair)
+        if kerning is None:
+            kerning = self.font.getlength(pair) - self.advance(left) - self.advance(right)
+            self._kerning[pair] = kerning
+        return kerning
+
+    def width(self, text: str, previous: str = "") -> float:
+        """
+        Width of text, including the kerning against the character before it.
+        """
+        width = 0
+        for char in text:
+            if previous:
+                width += self.kerning(previous, char)
+            width += self.advance(char)
+            previous = char
+        return width
+
+
+@functools.lru_cache(maxsize=32)
+def get_font_metrics(font_path: str, font_size: int) -> FontMetrics:
+    return FontMetrics(font_path, font_size)
+
+
+def wrap_text(text, max_width, font="Arial", fontsize=60):
+    metrics = get_font_metrics(font, fontsize)
+
+    left, top, right, bottom = metrics.font.getbbox(text.strip())
+    height = bottom - top
+    if metrics.width(text.strip()) <= max_width:
         return text, height
 
     # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
@@ -163,39 +835,49 @@ def wrap_text(text, max_width, font="Arial", fontsize=60):
     processed = True
 
     _wrapped_lines_ = []
-    words = text.split(" ")
+    words = [word for word in text.split(" ") if word]
     _txt_ = ""
+    _width = 0
     for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
+        if _txt_:
+            _word_width = metrics.width(f" {word}", _txt_[-1])
         else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
+            _word_width = metrics.width(word)
+        if _width + _word_width <= max_width:
+            _txt_ = f"{_txt_} {word}" if _txt_ else word
+            _width += _word_width
+            continue
+        if not _txt_:
+            processed = False
+            break
+        _wrapped_lines_.append(_txt_)
+        _txt_ = word
+        _width = metrics.width(word)
+        if _width > max_width:
+            processed = False
+            break
     _wrapped_lines_.append(_txt_)
     if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
         result = "\n".join(_wrapped_lines_).strip()
         height = len(_wrapped_lines_) * height
         # logger.warning(f"wrapped text: {result}")
         return result, height
 
     _wrapped_lines_ = []
-    chars = list(text)
     _txt_ = ""
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
+    _width = 0
+    for char in text:
+        # the width of the line without leading whitespace, only a visible
+        # character can push it over max_width
+        if _txt_.strip():
+            _width += metrics.width(char, _txt_[-1])
+        elif not char.isspace():
+            _width = metrics.width(char)
+        _txt_ += char
+        if not char.isspace() and _width > max_width:
             _wrapped_lines_.append(_txt_)
             _txt_ = ""
+            _width = 0
     _wrapped_lines_.append(_txt_)
     result = "\n".join(_wrapped_lines_).strip()
     height = len(_wrapped_lines_) * height
@@ -219,11 +901,130 @@ def generate_video(
     logger.info(f"  ③ subtitle: {subtitle_path}")
     logger.info(f"  ④ output: {output_file}")
 
-    # https://github.com/harry0703/MoneyPrinterTurbo/issues/217
-    # PermissionError: [WinError 32] The process cannot access the file because it is being used by another process: 'final-1.mp4.tempTEMP_MPY_wvf_snd.mp3'
-    # write into the same directory as the output file
-    output_dir = os.path.dirname(output_file)
+    # long videos are split into segments that are encoded in parallel, x264
+    # doesn't scale well across cores within one encode at this thread count
+    # in a render process the cores are already shared between the videos
+    segment_workers = int(config.app.get("max_segment_workers", 0) or 0)
+    if _in_pool:
+        segment_workers = 0
+    segment_min_duration = config.app.get("segment_min_duration", 60)
+    if segment_workers > 1:
+        duration = ffmpeg.probe(video_path).duration
+        segment_workers = min(segment_workers, int(duration // segment_min_duration))
+    if segment_workers > 1:
+        _generate_video_segmented(
+            video_path, audio_path, subtitle_path, output_file, params, segment_workers
+        )
+        logger.success("completed")
+        return
+
+    _finish_video(video_path, audio_path, subtitle_path, output_file, params)
+    logger.success("completed")
+
+
+def render_video(
+    video_paths: List[str],
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = None,
+    combined_video_path: str = "",
+):
+    """
+    combine_videos and generate_video in one pass: the concatenated clips, the
+    subtitles and the audio are composed together and encoded only once.
+    The combined video is only written when combined_video_path is given.
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    video_concat_mode = VideoConcatMode(video_concat_mode or params.video_concat_mode)
+
+    logger.info(f"start single pass, video size: {video_width} x {video_height}")
+    logger.info(f"  ① videos: {len(video_paths)}")
+    logger.info(f"  ② audio: {audio_path}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    # joining matching clips doesn't encode anything, so the final encode is
+    # still the only one. the ffmpeg backend and the cached clips encode the
+    # joined picture, it is final only without subtitles: burning them in
+    # would encode it a second time, the single pass below encodes it once.
+    # cached clips are only joined when all of them have been encoded before,
+    # normalizing the missing ones would be a second encode
+    infos = _probe_stream_copy_clips(video_paths, video_width, video_height)
+    encoded_join = not infos and not _load_subtitles(subtitle_path)
+    cached_clips = None
+    if encoded_join and params.video_backend != const.VIDEO_BACKEND_FFMPEG:
+        cached_clips = _plan_cached_clips_if_complete(
+            video_paths=video_paths,
+            audio_duration=ffmpeg.probe(audio_path).duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=params.video_clip_duration,
+            backend=params.video_backend,
+        )
+    ffmpeg_join = encoded_join and params.video_backend == const.VIDEO_BACKEND_FFMPEG
+    if infos or ffmpeg_join or cached_clips:
+        joined_video_path = combined_video_path or f"{output_file}.joined.mp4"
+        try:
+            if cached_clips:
+                _combine_videos_cached(
+                    combined_video_path=joined_video_path,
+                    video_paths=video_paths,
+                    audio_duration=ffmpeg.probe(audio_path).duration,
+                    video_width=video_width,
+                    video_height=video_height,
+                    video_concat_mode=video_concat_mode,
+                    max_clip_duration=params.video_clip_duration,
+                    backend=params.video_backend,
+                    threads=params.n_threads or 2,
+                    clips=cached_clips,
+                )
+            else:
+                combine_videos(
+                    combined_video_path=joined_video_path,
+                    video_paths=video_paths,
+                    audio_file=audio_path,
+                    video_aspect=params.video_aspect,
+                    video_concat_mode=video_concat_mode,
+                    max_clip_duration=params.video_clip_duration,
+                    threads=params.n_threads or 2,
+                    backend=params.video_backend,
+                )
+            _finish_video(
+                joined_video_path, audio_path, subtitle_path, output_file, params
+            )
+            logger.success("completed")
+            return output_file
+        except Exception as e:
+            logger.warning(f"failed to join clips, fallback to moviepy: {str(e)}")
+        finally:
+            if not combined_video_path and os.path.exists(joined_video_path):
+                os.remove(joined_video_path)
+
+    audio_duration = ffmpeg.probe(audio_path).duration
+    with ClipRegistry() as clips:
+        video_clip = _concatenate_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_width=video_width,
+            video_height=video_height,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=params.video_clip_duration,
+            clips=clips,
+        )
+        if combined_video_path:
+            logger.info(f"writing combined video: {combined_video_path}")
+            _write_clip(video_clip, combined_video_path, threads=params.n_threads or 2)
 
+        _write_final_video(video_clip, audio_path, subtitle_path, output_file, params)
+    logger.success("completed")
+    return output_file
+
+
+def _get_font_path(params: VideoParams) -> str:
     font_path = ""
     if params.subtitle_enabled:
         if not params.font_name:
@@ -233,77 +1034,514 @@ def generate_video(
             font_path = font_path.replace("\\", "/")
 
         logger.info(f"using font: {font_path}")
+    return font_path
+
+
+def _load_subtitles(subtitle_path: str):
+    if subtitle_path and os.path.exists(subtitle_path):
+        # SubtitlesClip would render a probe TextClip through ImageMagick,
+        # only the parsed ((start, end), text) items are needed
+        return file_to_subtitles(subtitle_path, encoding="utf-8")
+    return None
+
+
+def _parse_color(color: str):
+    if not color or color == "transparent":
+        return None
+    return ImageColor.getrgb(color)
+
+
+# rendered subtitle lines per process, subtitles repeat a lot across the
+# segments and videos of a task
+@functools.lru_cache(maxsize=512)
+def _render_text(
+    text: str,
+    font_path: str,
+    font_size: int,
+    fore_color: str,
+    bg_color: str,
+    stroke_color: str,
+    stroke_width: float,
+    max_width: float,
+) -> np.ndarray:
+    """
+    Rasterize a subtitle with Pillow into a read-only RGBA array, wrapped and
+    centered like ImageMagick's label: does for TextClip.
+    """
+    wrapped_txt, _ = wrap_text(
+        text, max_width=max_width, font=font_path, fontsize=font_size
+    )
+    font = ImageFont.truetype(font_path, font_size)
+    stroke_fill = _parse_color(stroke_color)
+    # ImageMagick centers the stroke on the outline while Pillow draws it
+    # outside, half the width keeps the glyphs the same weight
+    stroke = int(math.ceil(stroke_width / 2)) if stroke_fill and stroke_width else 0
+
+    lines = wrapped_txt.split("\n")
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
+    width = int(math.ceil(max(font.getlength(line) for line in lines))) + 2 * stroke
+    height = line_height * len(lines) + 2 * stroke
+
+    image = Image.new("RGBA", (max(width, 1), height), _parse_color(bg_color) or (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines):
+        draw.text(
+            (width / 2, stroke + i * line_height),
+            line,
+            font=font,
+            fill=_parse_color(fore_color),
+            anchor="ma",
+            stroke_width=stroke,
+            stroke_fill=stroke_fill,
+        )
+
+    frame = np.array(image)
+    frame.setflags(write=False)
+    return frame
+
+
+def _create_text_clip(subtitle_item, params: VideoParams, font_path: str):
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    phrase = subtitle_item[1]
+    max_width = video_width * 0.9
+    frame = _render_text(
+        phrase,
+        font_path,
+        params.font_size,
+        params.text_fore_color,
+        params.text_background_color,
+        params.stroke_color,
+        params.stroke_width,
+        max_width,
+    )
+    _clip = ImageClip(frame, transparent=True)
+    duration = subtitle_item[0][1] - subtitle_item[0][0]
+    _clip = _clip.set_start(subtitle_item[0][0])
+    _clip = _clip.set_end(subtitle_item[0][1])
+    _clip = _clip.set_duration(duration)
+    if params.subtitle_position == "bottom":
+        _clip = _clip.set_position(("center", video_height * 0.95 - _clip.h))
+    elif params.subtitle_position == "top":
+        _clip = _clip.set_position(("center", video_height * 0.05))
+    elif params.subtitle_position == "custom":
+        # 确保字幕完全在屏幕内
+        margin = 10  # 额外的边距，单位为像素
+        max_y = video_height - _clip.h - margin
+        min_y = margin
+        custom_y = (video_height - _clip.h) * (params.custom_position / 100)
+        custom_y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
+        _clip = _clip.set_position(("center", custom_y))
+    else:  # center
+        _clip = _clip.set_position(("center", "center"))
+    return _clip
+
+
+def _add_subtitles(video_clip, subtitles, params: VideoParams, font_path: str):
+    if subtitles is None:
+        return video_clip
+    text_clips = []
+    for item in subtitles:
+        clip = _create_text_clip(item, params, font_path)
+        text_clips.append(clip)
+    logger.debug(f"subtitle render cache: {_render_text.cache_info()}")
+    return CompositeVideoClip([video_clip, *text_clips])
 
-    def create_text_clip(subtitle_item):
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
+
+def _write_bgm_bed(bgm_file: str, volume: float, duration: float, output_file: str):
+    """
+    The BGM at volume, faded out over the last 3 seconds of the track and
+    looped to duration, encoded as AAC.
+    """
+    track_duration = bgm.get_track(bgm_file).get("duration")
+    if not track_duration:
+        track_duration = ffmpeg.probe(bgm_file).duration
+    fade_start = max(0.0, track_duration - 3)
+    faded_file = f"{output_file}.faded.wav"
+    try:
+        ffmpeg.run(
+            [
+                "-i",
+                bgm.pcm_file(bgm_file),
+                "-vn",
+                "-af",
+                f"volume={volume},afade=t=out:st={fade_start:.3f}:d=3",
+                "-ar",
+                "44100",
+                "-ac",
+                "2",
+                "-c:a",
+                "pcm_s16le",
+                faded_file,
+            ]
         )
-        _clip = TextClip(
-            wrapped_txt,
-            font=font_path,
-            fontsize=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
-            stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-            print_cmd=False,
+        ffmpeg.run(
+            [
+                "-stream_loop",
+                "-1",
+                "-i",
+                faded_file,
+                "-t",
+                f"{duration:.3f}",
+                "-c:a",
+                "aac",
+                output_file,
+            ]
         )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.set_start(subtitle_item[0][0])
-        _clip = _clip.set_end(subtitle_item[0][1])
-        _clip = _clip.set_duration(duration)
-        if params.subtitle_position == "bottom":
-            _clip = _clip.set_position(("center", video_height * 0.95 - _clip.h))
-        elif params.subtitle_position == "top":
-            _clip = _clip.set_position(("center", video_height * 0.05))
-        elif params.subtitle_position == "custom":
-            # 确保字幕完全在屏幕内
-            margin = 10  # 额外的边距，单位为像素
-            max_y = video_height - _clip.h - margin
-            min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
-            _clip = _clip.set_position(("center", custom_y))
-        else:  # center
-            _clip = _clip.set_position(("center", "center"))
-        return _clip
-
-    video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path).volumex(params.voice_volume)
+    finally:
+        if os.path.exists(faded_file):
+            os.remove(faded_file)
 
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding="utf-8")
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+
+def _mix_audio(audio_path: str, params: VideoParams, duration: float, output_file: str):
+    """
+    Mix the voice and the BGM into an AAC track of duration with ffmpeg. The
+    looped BGM bed is cached by (bgm, volume, duration).
+    """
+    inputs = ["-i", audio_path]
+    filters = [f"[0:a]volume={params.voice_volume},aresample=44100[voice]"]
+    output_label = "[voice]"
+    bed_file = ""
 
     bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
     if bgm_file:
         try:
-            bgm_clip = (
-                AudioFileClip(bgm_file).volumex(params.bgm_volume).audio_fadeout(3)
+            bgm_cache = bgm.get_cache()
+            bgm_volume = bgm.volume_for(bgm_file, params.bgm_volume)
+            if bgm_cache.enabled:
+                key = cache.make_key(
+                    cache.file_hash(bgm_file), round(bgm_volume, 6), round(duration, 3)
+                )
+                bgm_bed_file = bgm_cache.get_or_create(
+                    key,
+                    lambda temp_file: _write_bgm_bed(
+                        bgm_file, bgm_volume, duration, temp_file
+                    ),
+                    suffix=".m4a",
+                )
+            else:
+                bgm_bed_file = bed_file = f"{output_file}.bgm.m4a"
+                _write_bgm_bed(bgm_file, bgm_volume, duration, bed_file)
+            inputs += ["-i", bgm_bed_file]
+            # summed like moviepy's CompositeAudioClip, without amix's scaling
+            filters.append(
+                "[voice][1:a]amix=inputs=2:duration=longest"
+                ":dropout_transition=0:normalize=0[mix]"
             )
-            bgm_clip = afx.audio_loop(bgm_clip, duration=video_clip.duration)
-            audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
+            output_label = "[mix]"
         except Exception as e:
             logger.error(f"failed to add bgm: {str(e)}")
 
-    video_clip = video_clip.set_audio(audio_clip)
-    video_clip.write_videofile(
-        output_file,
-        audio_codec="aac",
-        temp_audiofile_path=output_dir,
-        threads=params.n_threads or 2,
-        logger=None,
-        fps=30,
+    try:
+        ffmpeg.run(
+            [
+                *inputs,
+                "-filter_complex",
+                ";".join(filters),
+                "-map",
+                output_label,
+                "-t",
+                f"{duration:.3f}",
+                "-c:a",
+                "aac",
+                output_file,
+            ]
+        )
+    finally:
+        if bed_file and os.path.exists(bed_file):
+            os.remove(bed_file)
+    return output_file
+
+
+def _write_final_video(
+    video_clip, audio_path: str, subtitle_path: str, output_file: str, params
+):
+    font_path = _get_font_path(params)
+
+    # stream-copied clips end on keyframes, so the combined video may run past the audio
+    audio_duration = ffmpeg.probe(audio_path).duration
+    if video_clip.duration > audio_duration:
+        video_clip = video_clip.subclip(0, audio_duration)
+
+    video_clip = _add_subtitles(
+        video_clip, _load_subtitles(subtitle_path), params, font_path
     )
-    video_clip.close()
-    del video_clip
-    logger.success("completed")
+
+    audio_file = _mix_audio(
+        audio_path, params, video_clip.duration, f"{output_file}.audio.m4a"
+    )
+    try:
+        _write_clip(
+            video_clip,
+            output_file,
+            threads=params.n_threads or 2,
+            audio_file=audio_file,
+        )
+    finally:
+        os.remove(audio_file)
+
+
+def _finish_video(
+    video_path: str, audio_path: str, subtitle_path: str, output_file: str, params
+):
+    """
+    Add the subtitles and the mixed audio to a combined video. Without
+    subtitles the picture is final already, so it is only muxed with the
+    audio instead of being encoded again.
+    """
+    if _load_subtitles(subtitle_path):
+        with ClipRegistry() as clips:
+            video_clip = clips.video(video_path, audio=False)
+            _write_final_video(
+                video_clip, audio_path, subtitle_path, output_file, params
+            )
+        return
+
+    duration = min(ffmpeg.probe(video_path).duration, ffmpeg.probe(audio_path).duration)
+    audio_file = _mix_audio(audio_path, params, duration, f"{output_file}.audio.m4a")
+    try:
+        ffmpeg.run(
+            [
+                "-i",
+                video_path,
+                "-i",
+                audio_file,
+                "-map",
+                "0:v:0",
+                "-map",
+                "1:a:0",
+                "-c",
+                "copy",
+                "-t",
+                f"{duration:.3f}",
+                "-movflags",
+                "+faststart",
+                output_file,
+            ]
+        )
+    finally:
+        os.remove(audio_file)
+
+
+def _segment_boundaries(video_path: str, duration: float, segment_count: int):
+    """
+    Split points for segmented encoding. Clip changes are encoded as keyframes,
+    so the keyframe closest to each even split point is used when there is one
+    nearby, the segments then start at clip boundaries.
+    """
+    try:
+        keyframe_times = ffmpeg.keyframes(video_path)
+    except Exception as e:
+        logger.warning(f"failed to read keyframes: {str(e)}")
+        keyframe_times = []
+
+    segment_duration = duration / segment_count
+    boundaries = [0.0]
+    for i in range(1, segment_count):
+        point = segment_duration * i
+        nearest = min(keyframe_times, key=lambda t: abs(t - point), default=point)
+        if abs(nearest - point) > segment_duration / 4:
+            nearest = point
+        # on a frame, so that no frame is encoded twice or skipped
+        nearest = round(nearest * 30) / 30
+        if nearest - boundaries[-1] >= 1:
+            boundaries.append(nearest)
+    boundaries.append(duration)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+# render processes of this process, shared by the tasks, their videos and
+# the segments of each video
+_pool = None
+_pool_lock = threading.Lock()
+# set in the render processes themselves
+_in_pool = False
+
+
+def _init_pool_process():
+    global _in_pool
+    _in_pool = True
+
+
+def worker_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    The long-lived render processes, started on first use and kept, so the
+    heavy imports are paid once per process instead of once per render.
+    None inside a render process: its work runs there, a pool of its own
+    would multiply the processes with every level.
+    """
+    global _pool
+    if _in_pool:
+        return None
+    with _pool_lock:
+        # a process killed while rendering breaks the pool for good
+        if _pool is None or getattr(_pool, "_broken", False):
+            max_workers = max(
+                int(config.app.get("max_render_workers", 0) or 0),
+                int(config.app.get("max_segment_workers", 0) or 0),
+                1,
+            )
+            # spawned, a forked worker could inherit a lock held by another
+            # thread of the task, such as a logging handler, and wait for it
+            # forever
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_pool_process,
+            )
+        return _pool
+
+
+def _render_segment(
+    video_path: str,
+    start: float,
+    end: float,
+    subtitles,
+    segment_file: str,
+    params: VideoParams,
+):
+    font_path = _get_font_path(params)
+
+    # the segment starts on the first frame at or after start and ends before
+    # the first frame of the next segment, the frames of the joined segments
+    # are the frames of the whole video
+    first_frame, end_frame = _frame_index(start), _frame_index(end)
+    start = first_frame / 30
+
+    # shift the subtitles onto the segment's own timeline
+    segment_subtitles = None
+    if subtitles is not None:
+        segment_subtitles = []
+        for (sub_start, sub_end), text in subtitles:
+            if sub_end <= start or sub_start >= end:
+                continue
+            segment_subtitles.append(
+                ((max(sub_start, start) - start, min(sub_end, end) - start), text)
+            )
+
+    with ClipRegistry() as clips:
+        video_clip = clips.video(video_path, audio=False).subclip(start, end)
+        video_clip = _add_subtitles(video_clip, segment_subtitles, params, font_path)
+        _write_clip(
+            video_clip,
+            segment_file,
+            threads=params.n_threads or 2,
+            audio=False,
+            frame_count=end_frame - first_frame,
+        )
+    return segment_file
+
+
+def _generate_video_segmented(
+    video_path: str,
+    audio_path: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    segment_workers: int,
+):
+    duration = min(
+        ffmpeg.probe(video_path).duration, ffmpeg.probe(audio_path).duration
+    )
+    segments = _segment_boundaries(video_path, duration, segment_workers)
+    logger.info(f"encoding {len(segments)} segments in {segment_workers} processes")
+
+    # the audio is mixed once and muxed into the joined segments as is
+    audio_file = _mix_audio(audio_path, params, duration, f"{output_file}.audio.m4a")
+
+    subtitles = _load_subtitles(subtitle_path)
+    segment_params = params.model_copy(
+        update={"n_threads": max(1, (os.cpu_count() or 1) // segment_workers)}
+    )
+    segment_files = [f"{output_file}.seg{i}.mp4" for i in range(len(segments))]
+    try:
+        executor = worker_pool()
+        futures = [
+            executor.submit(
+                _render_segment,
+                video_path,
+                start,
+                end,
+                subtitles,
+                segment_file,
+                segment_params,
+            )
+            for (start, end), segment_file in zip(segments, segment_files)
+        ]
+        # the segment files are removed below, none may still be written
+        wait(futures)
+        for future in futures:
+            future.result()
+
+        ffmpeg.concat(
+            [(segment_file, 0) for segment_file in segment_files],
+            output_file,
+            audio_file=audio_file,
+        )
+    finally:
+        for file_path in [audio_file, *segment_files]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def _zoom_boxes(width: int, height: int, duration: float):
+    """
+    Crop rectangles of the zoom effect, one per frame. The image grows from
+    100% by 3% per second around its center, so every frame shows the
+    centered 1/scale part of the image.
+    """
+    boxes = []
+    for frame_index in range(int(duration * 30)):
+        scale = 1 + 0.03 * (frame_index / 30)
+        crop_w, crop_h = width / scale, height / scale
+        x, y = (width - crop_w) / 2, (height - crop_h) / 2
+        boxes.append((x, y, x + crop_w, y + crop_h))
+    return boxes
+
+
+def _write_zoom_video(image_path: str, duration: float, output_file: str):
+    with Image.open(image_path) as img:
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            image = Image.new("RGB", img.size, (0, 0, 0))
+            image.paste(img, mask=img.getchannel("A"))
+        else:
+            image = img.convert("RGB")
+
+    # yuv420p needs even dimensions
+    width, height = image.width // 2 * 2, image.height // 2 * 2
+    codec, preset, crf = _encoder_settings()
+    with ffmpeg.PipeWriter(
+        output_file, width, height, fps=30, codec=codec, preset=preset, crf=crf
+    ) as writer:
+        # the image is decoded once, every frame is a single resize of a
+        # crop rectangle of it
+        for box in _zoom_boxes(image.width, image.height, duration):
+            frame = image.resize((width, height), Image.BILINEAR, box=box)
+            writer.write_frame(np.asarray(frame))
+
+
+def _render_image_video(image_path: str, duration: float, output_file: str):
+    """
+    Turn an image into a zooming video clip, rendered videos are cached by the
+    content of the image and the duration.
+    """
+    clip_cache = _get_clip_cache()
+    if not clip_cache.enabled:
+        _write_zoom_video(image_path, duration, output_file)
+        return
+
+    key = cache.make_key(
+        "zoom", cache.file_hash(image_path), duration, *_encoder_settings()
+    )
+    cached_file = clip_cache.get_or_create(
+        key,
+        lambda temp_file: _write_zoom_video(image_path, duration, temp_file),
+        suffix=".mp4",
+    )
+    cache.link_file(cached_file, output_file)
 
 
 def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
@@ -313,41 +1551,21 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
 
         ext = utils.parse_extension(material.url)
         try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
+            info = ffmpeg.probe(material.url)
+        except Exception as e:
+            logger.warning(f"failed to probe material: {material.url}, {str(e)}")
+            continue
 
-        width = clip.size[0]
-        height = clip.size[1]
+        width = info.width
+        height = info.height
         if width < 480 or height < 480:
             logger.warning(f"video is too small, width: {width}, height: {height}")
             continue
 
         if ext in const.FILE_TYPE_IMAGES:
             logger.info(f"processing image: {material.url}")
-            # 创建一个图片剪辑，并设置持续时间为3秒钟
-            clip = (
-                ImageClip(material.url)
-                .set_duration(clip_duration)
-                .set_position("center")
-            )
-            # 使用resize方法来添加缩放效果。这里使用了lambda函数来使得缩放效果随时间变化。
-            # 假设我们想要从原始大小逐渐放大到120%的大小。
-            # t代表当前时间，clip.duration为视频总时长，这里是3秒。
-            # 注意：1 表示100%的大小，所以1.2表示120%的大小
-            zoom_clip = clip.resize(
-                lambda t: 1 + (clip_duration * 0.03) * (t / clip.duration)
-            )
-
-            # 如果需要，可以创建一个包含缩放剪辑的复合视频剪辑
-            # （这在您想要在视频中添加其他元素时非常有用）
-            final_clip = CompositeVideoClip([zoom_clip])
-
-            # 输出视频
             video_file = f"{material.url}.mp4"
-            final_clip.write_videofile(video_file, fps=30, logger=None)
-            final_clip.close()
-            del final_clip
+            _render_image_video(material.url, clip_duration, video_file)
             material.url = video_file
             logger.success(f"completed: {video_file}")
     return materials
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+from loguru import logger
+
+from app.utils import utils
+
+
+def _cpu_time() -> float:
+    # user + system time of this process and of its reaped children (ffmpeg)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _io_bytes():
+    """
+    (read_bytes, write_bytes) that reached the storage layer, reaped children
+    included. (0, 0) where there is no /proc/self/io.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("read_bytes", 0), counters.get("write_bytes", 0)
+
+
+# the measurements running in the current thread, innermost last
+_local = threading.local()
+
+
+def mark_cached():
+    """
+    Mark the innermost measurement of this thread as served from a cache, its
+    wall time says nothing about the cost of the stage.
+    """
+    measurements = getattr(_local, "measurements", None)
+    if measurements:
+        measurements[-1].cached = True
+
+
+class Measurement:
+    """
+    Wall time, cpu time, peak rss and storage io of the enclosed block, in
+    result once the block exits. CPU time and io are process wide, so
+    concurrent blocks in the same process are counted in each other.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.result = {}
+        self.cached = False
+        self._sampler = utils.PeakRssSampler(interval)
+
+    def __enter__(self):
+        if not hasattr(_local, "measurements"):
+            _local.measurements = []
+        _local.measurements.append(self)
+        self._sampler.__enter__()
+        self._read_bytes, self._write_bytes = _io_bytes()
+        self._cpu = _cpu_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = _cpu_time() - self._cpu
+        read_bytes, write_bytes = _io_bytes()
+        self._sampler.__exit__(exc_type, exc_value, traceback)
+        _local.measurements.remove(self)
+        self.result = {
+            "wall_time": round(wall, 3),
+            "cpu_time": round(cpu, 3),
+            "peak_rss_mb": round(self._sampler.peak / 1024 / 1024, 1),
+            "read_bytes": read_bytes - self._read_bytes,
+            "write_bytes": write_bytes - self._write_bytes,
+        }
+        if self.cached:
+            self.result["cached"] = True
+
+
+class Profiler:
+    """
+    Per-stage measurements of a task. Stages measured in other processes are
+    added with add().
+    """
+
+    def __init__(self):
+        self.stages: List[dict] = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, **labels):
+        measurement = Measurement()
+        try:
+            with measurement:
+                yield measurement
+        finally:
+            self.add(name, measurement.result, **labels)
+
+    def add(self, name: str, result: dict, **labels):
+        record = {"stage": name, **labels, **result}
+        with self._lock:
+            self.stages.append(record)
+        logger.debug(f"stage {name} {labels or ''}: {result}")
+
+    def report(self) -> dict:
+        with self._lock:
+            stages = list(self.stages)
+        return {
+            "wall_time": round(time.perf_counter() - self._started, 3),
+            "cpu_time": round(sum(s["cpu_time"] for s in stages), 3),
+            "peak_rss_mb": max([s["peak_rss_mb"] for s in stages], default=0),
+            "read_bytes": sum(s["read_bytes"] for s in stages),
+            "write_bytes": sum(s["write_bytes"] for s in stages),
+            "stages": stages,
+        }
@@ -227,3 +227,144 @@ def load_locales(i18n_dir):
 
 def parse_extension(filename):
     return os.path.splitext(filename)[1].strip().lower().replace(".", "")
+
+
+def _read_proc_stat(pid):
+    # (ppid, name, rss pages) from /proc/<pid>/stat, the name may contain spaces
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        stat = f.read().decode("utf-8", errors="ignore")
+    name = stat[stat.index("(") + 1 : stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2 :].split()
+    return int(fields[1]), name, int(fields[21])
+
+
+def _process_tree(pid: int = None):
+    """
+    (pid, name, rss bytes) of a process and all its descendants. Read from
+    /proc, so it is empty where there is no /proc.
+    """
+    pid = pid or os.getpid()
+    if not os.path.isdir("/proc"):
+        return []
+
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            processes[int(entry)] = _read_proc_stat(entry)
+        except (OSError, ValueError, IndexError):
+            # exited while scanning
+            continue
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    tree = []
+    parents = {pid}
+    while parents:
+        children = set()
+        for child_pid, (ppid, name, rss) in processes.items():
+            if child_pid in parents:
+                tree.append((child_pid, name, rss * page_size))
+            if ppid in parents:
+                children.add(child_pid)
+        parents = children
+    return tree
+
+
+def child_processes(pid: int = None):
+    """
+    (pid, name) of all descendants of a process, the current one by default.
+    """
+    pid = pid or os.getpid()
+    return [(p, name) for p, name, _ in _process_tree(pid) if p != pid]
+
+
+def process_tree_rss(pid: int = None) -> int:
+    """
+    Resident memory in bytes of a process and its descendants, ffmpeg
+    readers and encoders included.
+    """
+    return sum(rss for _, _, rss in _process_tree(pid))
+
+
+def _read_cgroup(file_name):
+    # a cgroup v2 limit of this process, None when there is none
+    try:
+        with open(f"/sys/fs/cgroup/{file_name}", "r") as f:
+            value = f.read().split()
+    except OSError:
+        return None
+    if not value or value[0] == "max":
+        return None
+    return value
+
+
+def cpu_capacity() -> float:
+    """
+    Cores this process can use: the cores it may run on, capped by the
+    cgroup cpu quota of a container.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _read_cgroup("cpu.max")
+    if quota:
+        cores = min(cores, int(quota[0]) / int(quota[1]))
+    return float(cores)
+
+
+def memory_info():
+    """
+    (total, available) memory in bytes, from /proc/meminfo and capped by the
+    cgroup memory limit of a container. None where there is no /proc.
+    """
+    meminfo = {}
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    total = meminfo.get("MemTotal", 0)
+    available = meminfo.get("MemAvailable", meminfo.get("MemFree", 0))
+
+    limit = _read_cgroup("memory.max")
+    if limit:
+        usage = _read_cgroup("memory.current")
+        total = min(total, int(limit[0]))
+        if usage:
+            available = min(available, int(limit[0]) - int(usage[0]))
+    return total, max(available, 0)
+
+
+class PeakRssSampler:
+    """
+    Samples process_tree_rss in a background thread while in use, peak holds
+    the highest value seen.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.peak = max(self.peak, process_tree_rss())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
@@ -0,0 +1,165 @@
+"""
+独立的任务工作进程：从 Redis 队列中领取任务并执行，可以在多台机器上运行任意数量的工作进程
+
+Usage: python -m app.worker [--concurrency 2]
+"""
+
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+
+from loguru import logger
+
+from app.config import config
+from app.controllers.manager.process_executor import ProcessTaskExecutor
+from app.controllers.manager.base_manager import get_task_id
+from app.controllers.manager.redis_manager import RedisTaskManager
+from app.controllers.manager.resources import ResourceBudget
+
+
+class Worker:
+    def __init__(
+        self, manager: RedisTaskManager, concurrency: int, executor=None, budget=None
+    ):
+        self.manager = manager
+        self.concurrency = max(1, concurrency)
+        self.executor = executor
+        # 按 CPU 和内存占用执行任务，放不下的任务等待正在执行的任务结束
+        self.budget = budget
+        self.stopping = threading.Event()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def run_task(self, message: bytes, task_info: dict):
+        func = task_info["func"]
+        task_id = get_task_id(task_info["kwargs"])
+        done = threading.Event()
+
+        # 任务执行期间定期续约，工作进程退出后租约过期，任务由其他工作进程重新领取
+        def heartbeat():
+            interval = max(1, self.manager.visibility_timeout / 3)
+            while not done.wait(interval):
+                try:
+                    self.manager.extend(task_info)
+                except Exception as e:
+                    logger.warning(f"failed to extend the lease of task {task_id}: {str(e)}")
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        if self.budget is not None:
+            if not self.budget.acquire(task_id, task_info.get("resources"), self.stopping):
+                done.set()
+                self.manager.release(message, task_info)
+                return
+        logger.info(f"run task: {func.__name__}, {task_id}, attempts: {task_info.get('attempts', 0)}")
+        try:
+            if self.executor:
+                self.executor.run(func, *task_info["args"], **task_info["kwargs"])
+            else:
+                func(*task_info["args"], **task_info["kwargs"])
+        except Exception as e:
+            # 任务自身的失败已记录在任务状态中，不再重试
+            logger.error(f"task failed: {task_id}, {str(e)}")
+        finally:
+            done.set()
+            if self.budget is not None:
+                self.budget.release(task_id)
+            self.manager.ack(message, task_info)
+
+    def consume(self):
+        while not self.stopping.is_set():
+            try:
+                reserved = self.manager.reserve(timeout=5)
+            except Exception as e:
+                logger.error(f"failed to reserve a task: {str(e)}")
+                time.sleep(5)
+                continue
+            if reserved:
+                self.run_task(*reserved)
+
+    def reap(self):
+        interval = max(1, self.manager.visibility_timeout / 2)
+        while not self.stopping.wait(interval):
+            try:
+                self.manager.requeue_expired()
+            except Exception as e:
+                logger.error(f"failed to requeue expired tasks: {str(e)}")
+
+    def heartbeat(self):
+        # API 按各工作进程上报的并发数估计排队时间
+        interval = max(1, self.manager.visibility_timeout / 3)
+        while True:
+            try:
+                self.manager.register_worker(self.worker_id, self.concurrency)
+            except Exception as e:
+                logger.warning(f"failed to send the worker heartbeat: {str(e)}")
+            if self.stopping.wait(interval):
+                break
+
+    def run(self):
+        logger.info(f"worker started: {self.worker_id}, concurrency: {self.concurrency}")
+        threading.Thread(target=self.reap, daemon=True).start()
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        consumers = [
+            threading.Thread(target=self.consume) for _ in range(self.concurrency)
+        ]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+        try:
+            self.manager.unregister_worker(self.worker_id)
+        except Exception as e:
+            logger.warning(f"failed to unregister the worker: {str(e)}")
+        logger.info("worker stopped")
+
+    def stop(self, *args):
+        # 不再领取新任务，等待正在执行的任务结束
+        logger.info("stopping worker, waiting for the running tasks")
+        self.stopping.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run tasks from the Redis queue")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=config.app.get("max_concurrent_tasks", 5),
+        help="tasks run at the same time by this worker",
+    )
+    args = parser.parse_args()
+
+    if not config.app.get("enable_redis", False):
+        raise SystemExit("the worker needs enable_redis = true in config.toml")
+
+    redis_host = config.app.get("redis_host", "localhost")
+    redis_port = config.app.get("redis_port", 6379)
+    redis_db = config.app.get("redis_db", 0)
+    redis_password = config.app.get("redis_password", None)
+    redis_url = f"redis://:{redis_password}@{redis_host}:{redis_port}/{redis_db}"
+
+    executor = None
+    if config.app.get("task_executor", "thread") == "process":
+        executor = ProcessTaskExecutor(max_workers=args.concurrency)
+
+    manager = RedisTaskManager(
+        max_concurrent_tasks=args.concurrency,
+        redis_url=redis_url,
+        visibility_timeout=config.app.get("task_visibility_timeout", 60),
+        max_attempts=config.app.get("task_max_attempts", 3),
+    )
+    budget = None
+    if config.app.get("resource_scheduling", False):
+        budget = ResourceBudget(
+            cpu_overcommit=config.app.get("cpu_overcommit", 1.0),
+            reserve_mb=config.app.get("memory_reserve_mb", 1024),
+        )
+    worker = Worker(manager, args.concurrency, executor=executor, budget=budget)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+渲染流水线端到端性能测试
+在本地生成合成素材（视频片段、图片、类 TTS 音频、字幕），无需网络，
+分别测量 preprocess_video、combine_videos、generate_video、subtitle.correct
+和 voice.create_subtitle 在不同规模下的耗时，结果写入 JSON 文件，便于跨提交对比
+
+用法:
+    python benchmark/bench_pipeline.py [--clips 10,50,200] [--audio 30,180]
+        [--backend moviepy] [--repeat 1] [--cache] [--output 结果文件]
+    python benchmark/bench_pipeline.py --compare 旧结果.json [--output 新结果.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edge_tts import SubMaker
+from PIL import Image, ImageDraw
+
+from app.config import config
+from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
+from app.services import ffmpeg, subtitle, video, voice
+from app.utils import utils
+from app.utils.profiler import Measurement
+
+# 素材尺寸：竖屏、横屏、方形，都不小于 preprocess_video 要求的 480
+CLIP_SIZES = [(540, 960), (960, 540), (720, 720), (1080, 1920)]
+# 每 10 个素材中有 1 张图片
+IMAGE_EVERY = 10
+# 类 TTS 语速，每秒词数
+WORDS_PER_SECOND = 2.5
+WORDS = (
+    "money travel budget flight hotel ticket market coffee morning city river "
+    "mountain friend family saving plan weekend habit simple guide local street"
+).split()
+
+
+def git_commit():
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_clip(file_path, width, height, duration, fps):
+    ffmpeg.run(
+        [
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=s={width}x{height}:r={fps}:d={duration}",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-pix_fmt",
+            "yuv420p",
+            file_path,
+        ]
+    )
+
+
+def make_image(file_path, width, height, seed):
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse(
+            (x, y, x + width // 4, y + height // 4),
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    image.save(file_path, quality=90)
+
+
+def make_materials(media_dir, count):
+    """生成 count 个素材，文件名固定，已存在的直接复用"""
+    paths = []
+    for index in range(count):
+        # 按序号取随机数，不同规模共用同一批素材
+        rng = random.Random(index)
+        width, height = CLIP_SIZES[index % len(CLIP_SIZES)]
+        if index % IMAGE_EVERY == IMAGE_EVERY - 1:
+            file_path = os.path.join(media_dir, f"image-{index:03d}-{width}x{height}.jpg")
+            if not os.path.exists(file_path):
+                make_image(file_path, width, height, index)
+        else:
+            duration = rng.choice([3, 4, 5, 6])
+            fps = rng.choice([25, 30])
+            file_path = os.path.join(
+                media_dir, f"clip-{index:03d}-{width}x{height}-{duration}s-{fps}.mp4"
+            )
+            if not os.path.exists(file_path):
+                make_clip(file_path, width, height, duration, fps)
+        paths.append(file_path)
+    return paths
+
+
+def make_script(duration):
+    """按语速生成句子，长度与音频时长对应"""
+    rng = random.Random(duration)
+    sentences = []
+    words = int(duration * WORDS_PER_SECOND)
+    while words > 0:
+        length = min(words, rng.randint(5, 12))
+        sentence = " ".join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence.capitalize() + rng.choice([",", ".", "."]))
+        words -= length
+    return " ".join(sentences)
+
+
+def make_audio(file_path, duration):
+    """类 TTS 音频：24kHz 单声道 mp3，音量按音节节奏起伏"""
+    if os.path.exists(file_path):
+        return
+    ffmpeg.run(
+        [
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=180:sample_rate=24000:duration={duration}",
+            "-af",
+            "tremolo=f=4:d=0.9",
+            "-ac",
+            "1",
+            "-c:a",
+            "libmp3lame",
+            "-b:a",
+            "48k",
+            file_path,
+        ]
+    )
+
+
+def make_sub_maker(script, duration):
+    """与 edge-tts 一样逐词给出时间戳（100 纳秒为单位）"""
+    sub_maker = SubMaker()
+    words = script.split(" ")
+    step = duration / len(words) * 10000000
+    for index, word in enumerate(words):
+        sub_maker.create_sub((index * step, step * 0.9), word)
+    return sub_maker
+
+
+def make_whisper_srt(file_path, script, duration):
+    """类 whisper 的识别结果：句子偶尔被拆成两行，需要 subtitle.correct 合并"""
+    rng = random.Random(duration)
+    lines = []
+    for line in utils.split_string_by_punctuations(script):
+        words = line.split(" ")
+        if len(words) > 6 and rng.random() < 0.3:
+            half = len(words) // 2
+            lines.append(" ".join(words[:half]))
+            lines.append(" ".join(words[half:]))
+        else:
+            lines.append(line)
+
+    step = duration / len(lines)
+    with open(file_path, "w", encoding="utf-8") as f:
+        for index, line in enumerate(lines):
+            f.write(
+                utils.text_to_srt(
+                    index + 1, line, index * step, (index + 1) * step
+                ).strip()
+                + "\n\n"
+            )
+
+
+def measure(name, func, repeat, **labels):
+    """重复 repeat 次，取墙钟时间最短的一次"""
+    best = None
+    for _ in range(repeat):
+        with Measurement() as measurement:
+            func()
+        if best is None or measurement.result["wall_time"] < best["wall_time"]:
+            best = measurement.result
+    record = {"name": name, **labels, **best}
+    print(
+        f"{name:<24}{json.dumps(labels):<28}"
+        f"{best['wall_time']:>10.3f}s{best['cpu_time']:>10.2f}s{best['peak_rss_mb']:>10.1f}MB"
+    )
+    return record
+
+
+def run(args):
+    # 默认关闭缓存，测量冷启动；--cache 时沿用配置
+    if not args.cache:
+        config.app["clip_cache_size_mb"] = 0
+        config.app["bgm_cache_size_mb"] = 0
+
+    work_dir = args.work_dir
+    media_dir = os.path.join(work_dir, "media")
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(media_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    clip_counts = [int(c) for c in args.clips.split(",")]
+    audio_durations = [int(d) for d in args.audio.split(",")]
+    fonts = sorted(os.listdir(utils.font_dir()))
+    songs = sorted(f for f in os.listdir(utils.song_dir()) if f.endswith(".mp3"))
+
+    print("generating synthetic media...")
+    started = time.perf_counter()
+    materials = {count: make_materials(media_dir, count) for count in clip_counts}
+    audios = {}
+    for duration in audio_durations:
+        script = make_script(duration)
+        audio_file = os.path.join(media_dir, f"voice-{duration}s.mp3")
+        make_audio(audio_file, duration)
+        srt_file = os.path.join(media_dir, f"whisper-{duration}s.srt")
+        make_whisper_srt(srt_file, script, duration)
+        audios[duration] = (script, audio_file, srt_file)
+    print(f"done in {time.perf_counter() - started:.1f}s\n")
+
+    print(f"{'name':<24}{'case':<28}{'wall':>11}{'cpu':>11}{'peak rss':>12}")
+    results = []
+    for count in clip_counts:
+
+        def preprocess():
+            # 删除上一次生成的图片视频，保证每次都重新渲染
+            for file_path in materials[count]:
+                if os.path.exists(f"{file_path}.mp4"):
+                    os.remove(f"{file_path}.mp4")
+            video.preprocess_video(
+                [MaterialInfo(provider="local", url=u) for u in materials[count]],
+                clip_duration=4,
+            )
+
+        results.append(measure("preprocess_video", preprocess, args.repeat, clips=count))
+
+    for duration in audio_durations:
+        script, audio_file, srt_file = audios[duration]
+        subtitle_file = os.path.join(output_dir, f"subtitle-{duration}s.srt")
+
+        def correct():
+            # correct 会改写字幕文件，每次从原始识别结果开始
+            with open(srt_file, "r", encoding="utf-8") as f:
+                content = f.read()
+            with open(subtitle_file, "w", encoding="utf-8") as f:
+                f.write(content)
+            subtitle.correct(subtitle_file=subtitle_file, video_script=script)
+
+        results.append(measure("subtitle.correct", correct, args.repeat, audio=duration))
+
+        sub_maker = make_sub_maker(script, duration)
+        results.append(
+            measure(
+                "voice.create_subtitle",
+                lambda: voice.create_subtitle(
+                    sub_maker=sub_maker, text=script, subtitle_file=subtitle_file
+                ),
+                args.repeat,
+                audio=duration,
+            )
+        )
+
+        # generate_video 使用素材最多的那个合成视频
+        for count in clip_counts:
+            # 图片已在 preprocess_video 中转成视频
+            video_paths = [
+                f"{p}.mp4" if os.path.exists(f"{p}.mp4") else p for p in materials[count]
+            ]
+            combined_file = os.path.join(output_dir, f"combined-{count}-{duration}s.mp4")
+            results.append(
+                measure(
+                    "combine_videos",
+                    lambda: video.combine_videos(
+                        combined_video_path=combined_file,
+                        video_paths=video_paths,
+                        audio_file=audio_file,
+                        video_aspect=VideoAspect.portrait,
+                        video_concat_mode=VideoConcatMode.sequential,
+                        max_clip_duration=5,
+                        threads=args.threads,
+                        backend=args.backend,
+                    ),
+                    args.repeat,
+                    clips=count,
+                    audio=duration,
+                )
+            )
+
+        params = VideoParams(
+            video_subject="benchmark",
+            video_style="benchmark",
+            video_aspect=VideoAspect.portrait,
+            video_backend=args.backend,
+            bgm_type="custom" if songs else "",
+            bgm_file=os.path.join(utils.song_dir(), songs[0]) if songs else "",
+            font_name=fonts[0] if fonts else "",
+            subtitle_enabled=True,
+            n_threads=args.threads,
+        )
+        results.append(
+            measure(
+                "generate_video",
+                lambda: video.generate_video(
+                    video_path=combined_file,
+                    audio_path=audio_file,
+                    subtitle_path=subtitle_file,
+                    output_file=os.path.join(output_dir, f"final-{duration}s.mp4"),
+                    params=params,
+                ),
+                args.repeat,
+                audio=duration,
+            )
+        )
+
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "backend": args.backend,
+        "cache": args.cache,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def _case_key(record):
+    return (record["name"], record.get("clips"), record.get("audio"))
+
+
+def compare(base, current):
+    """按用例对比两次结果的墙钟时间"""
+    base_results = {_case_key(r): r for r in base["results"]}
+    print(f"\n{base['commit']} -> {current['commit']}")
+    print(f"{'name':<24}{'clips':>6}{'audio':>6}{'base':>10}{'current':>10}{'change':>9}")
+    for record in current["results"]:
+        key = _case_key(record)
+        if key not in base_results:
+            continue
+        before = base_results[key]["wall_time"]
+        after = record["wall_time"]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+        print(
+            f"{key[0]:<24}{key[1] or '-':>6}{key[2] or '-':>6}"
+            f"{before:>9.3f}s{after:>9.3f}s{change:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="rendering pipeline benchmark")
+    parser.add_argument("--clips", default="10,50,200", help="material counts")
+    parser.add_argument("--audio", default="30,180", help="audio durations in seconds")
+    parser.add_argument("--backend", default="moviepy", choices=["moviepy", "ffmpeg"])
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--cache", action="store_true", help="keep the clip and bgm caches")
+    parser.add_argument("--work-dir", default=utils.storage_dir("benchmark"))
+    parser.add_argument("--output", default="", help="result file, json")
+    parser.add_argument("--compare", default="", help="result file to compare with")
+    args = parser.parse_args()
+
+    current = run(args)
+    output = args.output or os.path.join(
+        args.work_dir, f"pipeline-{current['commit']}.json"
+    )
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"\nresults: {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), current)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+字幕换行性能测试
+对比旧版 wrap_text（每追加一个词或字符都重新测量整行）与基于字形宽度表的新版实现
+
+用法: python benchmark/bench_wrap_text.py [--font 字体文件] [--repeat 次数]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import ImageFont
+
+from app.services import video
+from app.utils import utils
+
+PARAGRAPH_EN = (
+    "Here's your guide to travel hacks for budget-friendly adventures, "
+    "from booking flights on the right weekday to packing light, "
+    "finding free walking tours and eating where the locals eat. "
+)
+PARAGRAPH_ZH = "测试长字段这是您的旅行技巧指南帮助您进行预算友好的冒险，从选择合适的日子订机票到轻装出行，"
+
+
+def legacy_wrap_text(text, max_width, font="Arial", fontsize=60):
+    """旧版实现，保留用于对比"""
+    font = ImageFont.truetype(font, fontsize)
+
+    def get_text_size(inner_text):
+        inner_text = inner_text.strip()
+        left, top, right, bottom = font.getbbox(inner_text)
+        return right - left, bottom - top
+
+    width, height = get_text_size(text)
+    if width <= max_width:
+        return text, height
+
+    processed = True
+
+    _wrapped_lines_ = []
+    words = text.split(" ")
+    _txt_ = ""
+    for word in words:
+        _before = _txt_
+        _txt_ += f"{word} "
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            if _txt_.strip() == word.strip():
+                processed = False
+                break
+            _wrapped_lines_.append(_before)
+            _txt_ = f"{word} "
+    _wrapped_lines_.append(_txt_)
+    if processed:
+        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
+        result = "\n".join(_wrapped_lines_).strip()
+        height = len(_wrapped_lines_) * height
+        return result, height
+
+    _wrapped_lines_ = []
+    chars = list(text)
+    _txt_ = ""
+    for word in chars:
+        _txt_ += word
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            _wrapped_lines_.append(_txt_)
+            _txt_ = ""
+    _wrapped_lines_.append(_txt_)
+    result = "\n".join(_wrapped_lines_).strip()
+    height = len(_wrapped_lines_) * height
+    return result, height
+
+
+def measure(func, text, font, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result, _ = func(text, max_width=1080 * 0.9, font=font, fontsize=60)
+    return (time.perf_counter() - started) / repeat, result
+
+
+def main():
+    fonts_dir = utils.font_dir()
+    default_font = os.path.join(fonts_dir, sorted(os.listdir(fonts_dir))[0])
+
+    parser = argparse.ArgumentParser(description="wrap_text benchmark")
+    parser.add_argument("--font", default=default_font)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"font: {args.font}")
+    print(f"{'text':<12}{'chars':>8}{'legacy ms':>12}{'new ms':>10}{'speedup':>10}{'lines':>12}")
+    for name, paragraph in [("english", PARAGRAPH_EN), ("chinese", PARAGRAPH_ZH)]:
+        for times in [1, 4, 16]:
+            text = (paragraph * times).strip()
+            legacy_time, legacy_result = measure(
+                legacy_wrap_text, text, args.font, args.repeat
+            )
+            # 首次调用会加载字体并测量字形，单独预热，只比较稳定状态
+            video.wrap_text(text, max_width=1080 * 0.9, font=args.font, fontsize=60)
+            new_time, new_result = measure(video.wrap_text, text, args.font, args.repeat)
+            lines = f"{legacy_result.count(chr(10)) + 1}/{new_result.count(chr(10)) + 1}"
+            print(
+                f"{name + ' x' + str(times):<12}{len(text):>8}"
+                f"{legacy_time * 1000:>12.2f}{new_time * 1000:>10.2f}"
+                f"{legacy_time / new_time:>9.1f}x{lines:>12}"
+            )
+
+
+if __name__ == "__main__":
+    main()
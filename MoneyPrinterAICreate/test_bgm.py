@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+背景音乐索引测试脚本
+扫描音乐目录（测量响度）时不阻塞读取索引：扫描期间返回上一次的索引，没有索引时等待扫描完成
+"""
+
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.services import bgm
+from app.utils import utils
+
+
+def test_scan_does_not_block_readers():
+    song_dir = utils.song_dir()
+    started, release = threading.Event(), threading.Event()
+    scans = []
+
+    def slow_scan(song_dir, previous):
+        scans.append(song_dir)
+        started.set()
+        release.wait(5)
+        return {"new.mp3": {"name": "new.mp3", "file": "new.mp3"}}
+
+    saved = bgm._index, bgm._scan, bgm._save_index
+    bgm._scan, bgm._save_index = slow_scan, lambda index: None
+    try:
+        # 音乐目录已变化的旧索引
+        stale = {"song_dir": song_dir, "mtime_ns": -1, "tracks": {"old.mp3": {}}}
+        bgm._index = stale
+        scanner = threading.Thread(target=bgm.get_index)
+        scanner.start()
+        assert started.wait(5)
+
+        # 扫描期间返回旧索引，不重复扫描
+        assert bgm.get_index() is stale
+        assert list(bgm.get_index()["tracks"]) == ["old.mp3"]
+
+        # 没有索引时等待扫描完成
+        bgm._index = {}
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(bgm.get_index()))
+        waiter.start()
+        waiter.join(0.2)
+        assert waiter.is_alive()
+
+        release.set()
+        scanner.join(5)
+        waiter.join(5)
+        assert list(results[0]["tracks"]) == ["new.mp3"]
+        assert len(scans) == 1
+    finally:
+        release.set()
+        bgm._index, bgm._scan, bgm._save_index = saved
+
+
+if __name__ == "__main__":
+    test_scan_does_not_block_readers()
+    print("✅ 扫描音乐目录时不阻塞读取索引")
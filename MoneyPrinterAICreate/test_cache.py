@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+文件缓存测试脚本
+同一条目并发生成时只生成一次，生成结束后不保留按条目创建的锁
+命中和未命中次数保存在存储目录中，各进程共享
+"""
+
+import os
+import shutil
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.services import cache
+
+
+def test_concurrent_creates_run_once():
+    file_cache = cache.FileCache("test_locks", 1024 * 1024)
+    created = []
+
+    def create(file_path):
+        created.append(file_path)
+        with open(file_path, "w") as f:
+            f.write("cached")
+
+    try:
+        threads = [
+            threading.Thread(target=file_cache.get_or_create, args=(f"key-{i % 5}", create))
+            for i in range(50)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(created) == 5
+        # 常驻进程生成的条目越来越多，锁不能随之累积
+        assert file_cache._key_locks == {}
+    finally:
+        shutil.rmtree(file_cache.cache_dir, ignore_errors=True)
+        if os.path.exists(file_cache.stats_file):
+            os.remove(file_cache.stats_file)
+
+
+def test_stats_count_every_process():
+    # 渲染在工作进程中执行，API 进程的缓存统计包括它们的命中和未命中
+    worker_cache = cache.FileCache("test_stats", 1024 * 1024)
+    api_cache = cache.FileCache("test_stats", 1024 * 1024)
+    try:
+        worker_cache.get_or_create("key", lambda file_path: open(file_path, "w").close())
+        worker_cache.get("key")
+        worker_cache.get("missing")
+
+        stats = api_cache.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 2)
+        assert stats["hit_rate"] == 0.3333
+        assert stats["entries"] == 1
+    finally:
+        shutil.rmtree(worker_cache.cache_dir, ignore_errors=True)
+        if os.path.exists(worker_cache.stats_file):
+            os.remove(worker_cache.stats_file)
+
+
+if __name__ == "__main__":
+    test_concurrent_creates_run_once()
+    test_stats_count_every_process()
+    print("✅ 文件缓存并发生成只执行一次，统计包括所有进程")
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+视频渲染资源释放测试脚本
+渲染结束后不应残留任何 ffmpeg 子进程（素材读取器、音频读取器、编码器）
+"""
+
+import gc
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+
+from app.config import config
+from app.models import const
+from app.models.schema import VideoAspect, VideoConcatMode, VideoParams
+from app.services import ffmpeg, video
+from app.utils import utils
+
+
+def make_materials(work_dir):
+    """生成合成素材：两段不同尺寸的视频（带音轨）和一张图片"""
+    video_paths = []
+    for name, size in [("a.mp4", "720x1280"), ("b.mp4", "1280x720")]:
+        file_path = os.path.join(work_dir, name)
+        ffmpeg.run(
+            [
+                "-f",
+                "lavfi",
+                "-i",
+                f"testsrc=s={size}:r=25:d=3",
+                "-f",
+                "lavfi",
+                "-i",
+                "sine=frequency=220:duration=3",
+                "-c:v",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                "-shortest",
+                file_path,
+            ]
+        )
+        video_paths.append(file_path)
+
+    image_path = os.path.join(work_dir, "c.png")
+    Image.new("RGB", (900, 900), (0, 128, 255)).save(image_path)
+    video_paths.append(image_path)
+
+    audio_path = os.path.join(work_dir, "audio.mp3")
+    ffmpeg.run(["-f", "lavfi", "-i", "sine=frequency=440:duration=4", audio_path])
+    return video_paths, audio_path
+
+
+def ffmpeg_children():
+    return [(pid, name) for pid, name in utils.child_processes() if "ffmpeg" in name]
+
+
+def test_no_ffmpeg_processes_after_render():
+    params = VideoParams(
+        video_subject="test",
+        video_style="test",
+        video_aspect=VideoAspect.portrait,
+        video_backend=const.VIDEO_BACKEND_MOVIEPY,
+        bgm_type="",
+        subtitle_enabled=False,
+    )
+    # 关闭垃圾回收，确认读取器是被主动关闭而不是被回收的
+    gc.disable()
+    # 只验证 moviepy 路径，关闭缓存避免直接命中已归一化的片段
+    clip_cache_size_mb = config.app.get("clip_cache_size_mb")
+    config.app["clip_cache_size_mb"] = 0
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            video_paths, audio_path = make_materials(work_dir)
+            assert not ffmpeg_children()
+
+            combined_file = os.path.join(work_dir, "combined.mp4")
+            video.combine_videos(
+                combined_video_path=combined_file,
+                video_paths=video_paths,
+                audio_file=audio_path,
+                video_aspect=VideoAspect.portrait,
+                video_concat_mode=VideoConcatMode.sequential,
+                max_clip_duration=5,
+            )
+            assert not ffmpeg_children(), ffmpeg_children()
+
+            video.generate_video(
+                video_path=combined_file,
+                audio_path=audio_path,
+                subtitle_path="",
+                output_file=os.path.join(work_dir, "final.mp4"),
+                params=params,
+            )
+            assert not ffmpeg_children(), ffmpeg_children()
+
+            video.render_video(
+                video_paths=video_paths,
+                audio_path=audio_path,
+                subtitle_path="",
+                output_file=os.path.join(work_dir, "final-single.mp4"),
+                params=params,
+            )
+            assert not ffmpeg_children(), ffmpeg_children()
+    finally:
+        gc.enable()
+        # 恢复配置，避免影响其他测试
+        if clip_cache_size_mb is None:
+            config.app.pop("clip_cache_size_mb", None)
+        else:
+            config.app["clip_cache_size_mb"] = clip_cache_size_mb
+
+
+if __name__ == "__main__":
+    test_no_ffmpeg_processes_after_render()
+    print("✅ 渲染结束后没有残留的 ffmpeg 进程")
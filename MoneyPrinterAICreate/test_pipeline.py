@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+任务阶段图测试脚本
+按输出规划所需阶段，按依赖并发执行，阶段失败时停止或只停止依赖它的阶段
+检查点只恢复文件未改变、且依赖的阶段也已恢复的阶段
+"""
+
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.controllers.manager.memory_manager import InMemoryTaskManager
+from app.models import const
+from app.services import pipeline
+from app.services import state as sm
+from app.services import task as tm
+from app.utils.profiler import Profiler, mark_cached
+
+
+def make_stages(calls):
+    def stage(name, outputs):
+        def func(**kwargs):
+            calls.append(name)
+            return {key: f"{name}:{key}" for key in outputs}
+
+        return func
+
+    return [
+        pipeline.Stage("script", stage("script", ["script"]), (), ("script",)),
+        pipeline.Stage(
+            "audio", stage("audio", ["audio_file"]), ("script",), ("audio_file",)
+        ),
+        pipeline.Stage("materials", stage("materials", ["materials"]), (), ("materials",)),
+        pipeline.Stage(
+            "video",
+            stage("video", ["videos"]),
+            ("audio_file", "materials"),
+            ("videos",),
+            cost=3,
+        ),
+    ]
+
+
+def test_plan_only_needed_stages():
+    stages = make_stages([])
+    assert [s.name for s in pipeline.plan(stages, ["audio_file"])] == ["script", "audio"]
+    assert [s.name for s in pipeline.plan(stages, ["videos"])] == [
+        "script",
+        "audio",
+        "materials",
+        "video",
+    ]
+    # 已有的输出不需要再生成
+    planned = pipeline.plan(stages, ["videos"], available=["audio_file"])
+    assert [s.name for s in planned] == ["materials", "video"]
+
+    try:
+        pipeline.plan(stages, ["unknown"])
+    except ValueError:
+        pass
+    else:
+        assert False, "planning an unknown output should fail"
+
+
+def test_run_in_dependency_order():
+    calls = []
+    fractions = []
+    stages = make_stages(calls)
+    context = pipeline.run(stages, {}, max_workers=2, on_progress=fractions.append)
+
+    assert context["videos"] == "video:videos"
+    assert calls.index("script") < calls.index("audio") < calls.index("video")
+    assert calls.index("materials") < calls.index("video")
+    # 进度按阶段耗时加权，最终为 1
+    assert fractions == sorted(fractions)
+    assert fractions[-1] == 1
+    assert abs(fractions[0] - 1 / 6) < 1e-9
+
+
+def test_independent_stages_run_concurrently():
+    # 两个阶段都在执行时才能通过
+    both_running = threading.Barrier(2, timeout=5)
+    stages = [
+        pipeline.Stage("a", lambda: (both_running.wait(), {"a": 1})[1], (), ("a",)),
+        pipeline.Stage("b", lambda: (both_running.wait(), {"b": 2})[1], (), ("b",)),
+    ]
+    context = pipeline.run(stages, {}, max_workers=2)
+    assert context == {"a": 1, "b": 2}
+
+
+def test_failed_stage_stops_dependents():
+    calls = []
+    stages = make_stages(calls)
+
+    def fail():
+        raise pipeline.StageFailed("materials")
+
+    stages[2] = pipeline.Stage("materials", fail, (), ("materials",))
+    try:
+        pipeline.run(stages, {}, max_workers=1)
+    except pipeline.StageFailed as e:
+        assert e.stage == "materials"
+    else:
+        assert False, "a failed stage should be raised"
+    assert "video" not in calls
+
+    # keep_going 时只有依赖失败阶段的阶段不执行
+    calls.clear()
+    context = pipeline.run(stages, {}, max_workers=1, keep_going=True)
+    assert context["audio_file"] == "audio:audio_file"
+    assert "videos" not in context
+    assert "video" not in calls
+
+
+def test_missing_output_fails_stage():
+    stages = [pipeline.Stage("script", lambda: {}, (), ("script",))]
+    try:
+        pipeline.run(stages, {})
+    except pipeline.StageFailed as e:
+        assert e.stage == "script"
+    else:
+        assert False, "a stage without its outputs should fail"
+
+
+def test_cached_stages_do_not_update_costs():
+    profiler = Profiler()
+    with profiler.stage("audio"):
+        mark_cached()
+    with profiler.stage("subtitle"):
+        pass
+
+    # 不写入 storage 中的任务目录和阶段耗时
+    recorded = []
+    record, save_profile = pipeline.record, tm.save_profile
+    pipeline.record = recorded.append
+    tm.save_profile = lambda task_id, profile: None
+    try:
+        tm._end_task("test-pipeline-costs", profiler, state=const.TASK_STATE_COMPLETE)
+    finally:
+        pipeline.record, tm.save_profile = record, save_profile
+        sm.state.delete_task("test-pipeline-costs")
+
+    # 命中缓存的阶段耗时不计入阶段耗时估计
+    assert profiler.stages[0]["cached"] is True
+    assert "cached" not in profiler.stages[1]
+    assert list(recorded[0]) == ["subtitle"]
+
+
+def test_checkpoint_restores_unchanged_stages():
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_file = os.path.join(work_dir, "audio.mp3")
+        with open(audio_file, "wb") as f:
+            f.write(b"voice")
+        stages = make_stages([])
+        stages[1] = pipeline.Stage(
+            "audio",
+            lambda script: {"audio_file": audio_file},
+            ("script",),
+            ("audio_file",),
+            dump=lambda outputs: {"audio_file": outputs["audio_file"] + "|dumped"},
+            load=lambda outputs: {"audio_file": outputs["audio_file"].split("|")[0]},
+        )
+
+        checkpoint_file = os.path.join(work_dir, "checkpoint.json")
+        checkpoint = pipeline.Checkpoint(checkpoint_file)
+        checkpoint.reset(params={"video_subject": "test"})
+        pipeline.run(pipeline.plan(stages, ["audio_file"]), {}, checkpoint=checkpoint)
+
+        # 重新读取检查点，各阶段的输出可以恢复
+        checkpoint = pipeline.Checkpoint(checkpoint_file)
+        assert checkpoint.data["params"] == {"video_subject": "test"}
+        context = checkpoint.restore(stages)
+        assert context == {"script": "script:script", "audio_file": audio_file}
+        assert [s.name for s in pipeline.plan(stages, ["audio_file"], context)] == []
+
+
+def test_checkpoint_skips_changed_files_and_dependents():
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_file = os.path.join(work_dir, "audio.mp3")
+        with open(audio_file, "wb") as f:
+            f.write(b"voice")
+        stages = [
+            pipeline.Stage("audio", lambda: {"audio_file": audio_file}, (), ("audio_file",)),
+            pipeline.Stage(
+                "subtitle",
+                lambda audio_file: {"subtitle_path": "subtitle.srt"},
+                ("audio_file",),
+                ("subtitle_path",),
+            ),
+            pipeline.Stage(
+                "bgm", lambda: {"bgm_ready": True}, (), ("bgm_ready",), checkpoint=False
+            ),
+        ]
+        checkpoint = pipeline.Checkpoint(os.path.join(work_dir, "checkpoint.json"))
+        checkpoint.reset()
+        pipeline.run(stages, {}, checkpoint=checkpoint)
+        assert set(checkpoint.data["stages"]) == {"audio", "subtitle"}
+
+        # 文件内容改变后该阶段失效，依赖它的阶段也不再恢复
+        with open(audio_file, "wb") as f:
+            f.write(b"another voice")
+        assert checkpoint.restore(stages) == {}
+
+        os.remove(audio_file)
+        assert checkpoint.restore(stages) == {}
+
+
+def test_invalid_checkpoint_is_ignored():
+    with tempfile.TemporaryDirectory() as work_dir:
+        checkpoint_file = os.path.join(work_dir, "checkpoint.json")
+        with open(checkpoint_file, "w", encoding="utf-8") as f:
+            f.write("{not json")
+        checkpoint = pipeline.Checkpoint(checkpoint_file)
+        assert checkpoint.data == {}
+        assert checkpoint.restore(make_stages([])) == {}
+
+
+def test_concurrent_checkpoints_keep_every_stage():
+    # 批量任务中同一任务的阶段在不同线程中完成，各自创建 Checkpoint 保存
+    with tempfile.TemporaryDirectory() as work_dir:
+        checkpoint_file = os.path.join(work_dir, "checkpoint.json")
+        pipeline.Checkpoint(checkpoint_file).reset()
+        stages = [
+            pipeline.Stage(f"stage-{i}", lambda: {}, (), (f"out-{i}",)) for i in range(20)
+        ]
+        checkpoints = [pipeline.Checkpoint(checkpoint_file) for _ in stages]
+        threads = [
+            threading.Thread(
+                target=checkpoint.save_stage, args=(stage, {stage.outputs[0]: i})
+            )
+            for i, (checkpoint, stage) in enumerate(zip(checkpoints, stages))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        context = pipeline.Checkpoint(checkpoint_file).restore(stages)
+        assert context == {f"out-{i}": i for i in range(20)}
+
+
+def test_active_tasks_cannot_resume():
+    task_id = "test-pipeline-active"
+    release = threading.Event()
+    manager = InMemoryTaskManager(max_concurrent_tasks=1)
+    try:
+        # 执行中的任务再次恢复，两次执行会互相覆盖任务目录和检查点
+        sm.state.update_task(task_id)
+        assert tm.is_active(task_id)
+        assert not tm.can_resume(task_id)
+
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        assert not tm.is_active(task_id, manager)
+        manager.add_task(lambda task_id: release.wait(5), task_id="running")
+        manager.add_task(lambda task_id: None, task_id=task_id)
+        assert manager.has_task("running")
+        assert tm.is_active(task_id, manager)
+        assert not tm.can_resume(task_id, manager)
+    finally:
+        release.set()
+        sm.state.delete_task(task_id)
+
+
+if __name__ == "__main__":
+    test_plan_only_needed_stages()
+    test_run_in_dependency_order()
+    test_independent_stages_run_concurrently()
+    test_failed_stage_stops_dependents()
+    test_missing_output_fails_stage()
+    test_cached_stages_do_not_update_costs()
+    test_checkpoint_restores_unchanged_stages()
+    test_checkpoint_skips_changed_files_and_dependents()
+    test_invalid_checkpoint_is_ignored()
+    test_concurrent_checkpoints_keep_every_stage()
+    test_active_tasks_cannot_resume()
+    print("✅ 阶段按依赖规划、执行并从检查点恢复")
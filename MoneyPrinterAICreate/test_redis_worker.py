@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Redis 工作进程模式测试脚本（使用 fakeredis 代替 Redis 服务）
+任务只入队不在本地执行，由工作进程领取、执行并确认；租约过期的任务重新入队
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from app.controllers.manager import redis_manager
+from app.controllers.manager.base_manager import QueueFull
+from app.controllers.manager.redis_manager import RedisTaskManager
+from app.models import const
+from app.models.schema import SubtitleRequest
+from app.services import state as sm
+from app.worker import Worker
+
+calls = []
+
+
+def record_task(task_id, params=None):
+    calls.append((task_id, params))
+
+
+def create_manager(**kwargs):
+    redis_manager.FUNC_MAP["record_task"] = record_task
+    return RedisTaskManager(
+        max_concurrent_tasks=1,
+        redis_url="",
+        standalone_workers=True,
+        redis_client=fakeredis.FakeRedis(),
+        **kwargs,
+    )
+
+
+def test_worker_runs_and_acks_tasks():
+    calls.clear()
+    manager = create_manager()
+    params = SubtitleRequest(video_script="hello")
+    manager.add_task(record_task, task_id="t1", params=params)
+    manager.add_task(record_task, task_id="t2")
+    # 独立工作进程模式下 API 只入队
+    assert calls == []
+    assert manager.redis_client.llen(manager.queue) == 2
+
+    worker = Worker(manager, concurrency=1)
+    for _ in range(2):
+        worker.run_task(*manager.reserve(timeout=1))
+
+    assert calls == [("t1", params), ("t2", None)]
+    assert manager.redis_client.llen(manager.queue) == 0
+    assert manager.redis_client.llen(manager.processing_queue) == 0
+    assert manager.redis_client.hlen(manager.leases) == 0
+
+
+def test_expired_lease_requeues_task():
+    calls.clear()
+    manager = create_manager(visibility_timeout=1, max_attempts=2)
+    manager.add_task(record_task, task_id="t3")
+
+    # 模拟工作进程领取任务后异常退出：不确认，也不续约
+    manager.reserve(timeout=1)
+    assert manager.requeue_expired() == 0
+    time.sleep(1.1)
+    assert manager.requeue_expired() == 1
+    assert manager.redis_client.llen(manager.processing_queue) == 0
+
+    message, task_info = manager.reserve(timeout=1)
+    assert task_info["attempts"] == 1
+    assert task_info["kwargs"]["task_id"] == "t3"
+
+    # 达到最大执行次数后不再入队，任务标记为失败
+    time.sleep(1.1)
+    assert manager.requeue_expired() == 1
+    assert manager.redis_client.llen(manager.queue) == 0
+    assert sm.state.get_task("t3")["state"] == const.TASK_STATE_FAILED
+
+
+def test_running_task_keeps_its_lease():
+    calls.clear()
+    manager = create_manager(visibility_timeout=1)
+    release = threading.Event()
+
+    def slow_task(task_id):
+        release.wait(5)
+        calls.append((task_id, None))
+
+    redis_manager.FUNC_MAP["slow_task"] = slow_task
+    manager.add_task(slow_task, task_id="t4")
+    worker = Worker(manager, concurrency=1)
+    thread = threading.Thread(target=worker.run_task, args=manager.reserve(timeout=1))
+    thread.start()
+
+    # 执行中的任务定期续约，不会被重新入队
+    time.sleep(1.5)
+    assert manager.requeue_expired() == 0
+    release.set()
+    thread.join()
+    assert calls == [("t4", None)]
+    assert manager.redis_client.llen(manager.queue) == 0
+
+
+def test_retry_after_uses_worker_capacity():
+    manager = create_manager(max_queue_depth=2, visibility_timeout=1)
+    for i in range(2):
+        manager.add_task(record_task, task_id=f"q{i}", cost=80)
+
+    # API 进程的 max_concurrent_tasks 为 1，排队时间按工作进程上报的并发数估计
+    manager.register_worker("worker-a", 4)
+    manager.register_worker("worker-b", 4)
+    assert manager.slots() == 8
+    assert manager.stats()["max_running"] == 8
+    try:
+        manager.add_task(record_task, task_id="q2", cost=80)
+    except QueueFull as e:
+        assert e.retry_after == 10
+    else:
+        assert False, "the queue should be full"
+
+    # 停止心跳的工作进程不再计入
+    manager.unregister_worker("worker-a")
+    assert manager.slots() == 4
+    time.sleep(1.1)
+    assert manager.slots() == 0
+    assert manager.redis_client.hlen(manager.workers) == 0
+
+
+if __name__ == "__main__":
+    test_worker_runs_and_acks_tasks()
+    test_expired_lease_requeues_task()
+    test_running_task_keeps_its_lease()
+    test_retry_after_uses_worker_capacity()
+    print("✅ 工作进程领取、确认并重新入队任务")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+按 CPU 和内存占用接纳任务的测试脚本
+放得下的任务立即执行，放不下的排队；小任务可以越过等待资源的大任务，直到大任务等待超过 backfill_timeout
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.controllers.manager.base_manager import QueueFull
+from app.controllers.manager.memory_manager import InMemoryTaskManager
+from app.controllers.manager.resources import ResourceBudget
+
+
+class FixedBudget(ResourceBudget):
+    # 固定的机器容量，不读取 /proc 和 cgroup
+    def capacity(self):
+        return {"cpu": 4, "memory_mb": 8000, "available_memory_mb": 6000}
+
+
+class Tasks:
+    def __init__(self):
+        self.started = []
+        self.events = {}
+
+    def run(self, task_id):
+        self.started.append(task_id)
+        self.events.setdefault(task_id, threading.Event()).wait(5)
+
+    def finish(self, task_id):
+        self.events.setdefault(task_id, threading.Event()).set()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_budget_fits_reserve_release():
+    budget = FixedBudget()
+    budget.reserve("a", {"cpu": 3, "memory_mb": 4000})
+    assert budget.reserved() == {"cpu": 3, "memory_mb": 4000}
+    assert budget.fits({"cpu": 1, "memory_mb": 1000})
+    # CPU 超出
+    assert not budget.fits({"cpu": 2, "memory_mb": 1000})
+    # 内存超出未预留的部分
+    assert not budget.fits({"cpu": 1, "memory_mb": 4500})
+
+    budget.release("a")
+    assert budget.reserved() == {"cpu": 0, "memory_mb": 0}
+    assert budget.fits({"cpu": 4, "memory_mb": 6000})
+    # 内存超出机器实际可用的部分
+    budget.reserve("b", {"cpu": 0.5, "memory_mb": 100})
+    assert not budget.fits({"cpu": 1, "memory_mb": 7000})
+
+
+def test_oversized_task_runs_alone():
+    budget = FixedBudget()
+    oversized = {"cpu": 16, "memory_mb": 64000}
+    # 没有其他任务时，超出整个预算的任务也可以执行，而不是永远等待
+    assert budget.fits(oversized)
+    budget.reserve("small", {"cpu": 0.2, "memory_mb": 100})
+    assert not budget.fits(oversized)
+    budget.release("small")
+    assert budget.acquire("oversized", oversized)
+    assert not budget.fits({"cpu": 0.2, "memory_mb": 100})
+
+
+def test_small_tasks_backfill_until_timeout():
+    tasks = Tasks()
+    manager = InMemoryTaskManager(max_concurrent_tasks=10, budget=FixedBudget())
+    manager.add_task(tasks.run, task_id="running", resources={"cpu": 3})
+    manager.add_task(tasks.run, task_id="big", resources={"cpu": 4})
+    # 大任务等待资源时，放得下的小任务先执行
+    manager.add_task(tasks.run, task_id="small", resources={"cpu": 1})
+    wait_until(lambda: "small" in tasks.started)
+    assert "big" not in tasks.started
+
+    # 大任务等待超过 backfill_timeout 后，小任务不再越过它
+    manager.backfill_timeout = 0
+    time.sleep(0.01)
+    manager.add_task(tasks.run, task_id="later", resources={"cpu": 0})
+    assert "later" not in tasks.started
+    assert [t["kwargs"]["task_id"] for t in manager.queued_tasks()] == ["big", "later"]
+
+    tasks.finish("running")
+    tasks.finish("small")
+    wait_until(lambda: "big" in tasks.started)
+    assert tasks.started.index("big") < tasks.started.index("later")
+    tasks.finish("big")
+    tasks.finish("later")
+    wait_until(lambda: manager.running_count() == 0)
+
+
+def test_full_queue_rejects_with_retry_after():
+    tasks = Tasks()
+    manager = InMemoryTaskManager(max_concurrent_tasks=1, max_queue_depth=1)
+    manager.add_task(tasks.run, task_id="running", cost=10)
+    manager.add_task(tasks.run, task_id="queued", cost=30)
+    try:
+        manager.add_task(tasks.run, task_id="rejected", cost=10)
+    except QueueFull as e:
+        assert e.depth == 1
+        # 还没有完成的任务：按排队任务的平均耗时估计
+        assert e.retry_after == 30
+    else:
+        assert False, "the queue should be full"
+
+    tasks.finish("running")
+    tasks.finish("queued")
+    wait_until(lambda: manager.running_count() == 0)
+    assert tasks.started == ["running", "queued"]
+
+
+if __name__ == "__main__":
+    test_budget_fits_reserve_release()
+    test_oversized_task_runs_alone()
+    test_small_tasks_backfill_until_timeout()
+    test_full_queue_rejects_with_retry_after()
+    print("✅ 任务按 CPU 和内存占用接纳")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+排队任务调度测试脚本
+按优先级取任务，同一优先级内各租户按赤字轮转（DRR）公平分享，等待过久的任务逐级提升优先级
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.controllers.manager.scheduler import FairQueue
+from app.models import const
+
+
+def task(name, tenant="", cost=1, priority=const.TASK_PRIORITY_NORMAL):
+    return {"name": name, "tenant": tenant, "cost": cost, "priority": priority}
+
+
+def names(tasks):
+    return [t["name"] for t in tasks]
+
+
+def test_priority_classes_go_first():
+    queue = FairQueue(aging=0)
+    queue.put(task("low", priority=const.TASK_PRIORITY_LOW))
+    queue.put(task("normal"))
+    queue.put(task("high", priority=const.TASK_PRIORITY_HIGH))
+
+    assert names(queue.order()) == ["high", "normal", "low"]
+    assert names(queue.get() for _ in range(3)) == ["high", "normal", "low"]
+    assert queue.empty()
+
+
+def test_tenants_share_by_cost():
+    # 租户 a 的短任务在租户 b 的一个长任务的时间内执行多个
+    queue = FairQueue(quantum=10, aging=0)
+    for i in range(3):
+        queue.put(task(f"b{i}", "b", cost=30))
+    for i in range(9):
+        queue.put(task(f"a{i}", "a", cost=10))
+
+    order = names(queue.get() for _ in range(12))
+    for i in range(0, 12, 4):
+        turn = order[i : i + 4]
+        assert sum(name.startswith("a") for name in turn) == 3, order
+        assert sum(name.startswith("b") for name in turn) == 1, order
+
+
+def test_many_tasks_do_not_delay_other_tenants():
+    queue = FairQueue(quantum=60, aging=0)
+    for i in range(20):
+        queue.put(task(f"a{i}", "a", cost=60))
+    queue.put(task("b0", "b", cost=60))
+
+    # 租户 b 最晚入队，仍在租户 a 的第二个任务之后执行
+    assert names(queue.order()).index("b0") == 1
+
+
+def test_weights_scale_the_share():
+    queue = FairQueue(quantum=10, aging=0, weights={"a": 2})
+    for i in range(4):
+        queue.put(task(f"a{i}", "a", cost=10))
+        queue.put(task(f"b{i}", "b", cost=10))
+
+    # 租户 a 的权重为 2，执行的任务是租户 b 的两倍
+    order = names(queue.get() for _ in range(6))
+    assert sum(name.startswith("a") for name in order) == 4, order
+    assert sum(name.startswith("b") for name in order) == 2, order
+
+
+def test_expensive_task_is_taken_at_once():
+    # 赤字按所需轮数一次性计算，不随任务耗时逐轮累加
+    queue = FairQueue(quantum=60, aging=0, weights={"a": 0.001})
+    queue.put(task("huge", "a", cost=1e9))
+    queue.put(task("small", "b", cost=1))
+
+    started = time.time()
+    assert names(queue.get() for _ in range(2)) == ["small", "huge"]
+    assert time.time() - started < 1
+
+
+def test_aging_promotes_waiting_tasks():
+    queue = FairQueue(aging=0.05)
+    queue.put(task("low", priority=const.TASK_PRIORITY_LOW))
+    time.sleep(0.12)
+    queue.put(task("normal"))
+
+    # 低优先级任务已等待两个 aging 周期，提升到高于普通优先级
+    assert names(queue.order()) == ["low", "normal"]
+    assert queue.get()["name"] == "low"
+
+
+def test_remove_charges_the_tenant():
+    queue = FairQueue(quantum=10, aging=0)
+    a0, a1 = task("a0", "a", cost=10), task("a1", "a", cost=10)
+    b0 = task("b0", "b", cost=10)
+    for t in (a0, a1, b0):
+        queue.put(t)
+
+    queue.remove(a0)
+    assert queue.qsize() == 2
+    # 提前取走的任务计入租户 a 的用量，轮到租户 b
+    assert names(queue.order()) == ["b0", "a1"]
+
+    try:
+        queue.remove(a0)
+    except ValueError:
+        pass
+    else:
+        assert False, "removing a task twice should fail"
+
+
+def test_order_follows_changes():
+    queue = FairQueue(aging=0)
+    queue.put(task("first"))
+    assert names(queue.order()) == ["first"]
+    queue.put(task("second"))
+    assert names(queue.order()) == ["first", "second"]
+    queue.get()
+    assert names(queue.order()) == ["second"]
+
+
+if __name__ == "__main__":
+    test_priority_classes_go_first()
+    test_tenants_share_by_cost()
+    test_many_tasks_do_not_delay_other_tenants()
+    test_weights_scale_the_share()
+    test_expensive_task_is_taken_at_once()
+    test_aging_promotes_waiting_tasks()
+    test_remove_charges_the_tenant()
+    test_order_follows_changes()
+    print("✅ 排队任务按优先级和租户公平调度")
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+拼接视频渲染后端测试脚本
+用合成素材分别通过 moviepy 和 ffmpeg 后端拼接视频，逐帧比较像素差异
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from imageio_ffmpeg import count_frames_and_secs
+from moviepy.editor import ColorClip, VideoFileClip
+from PIL import Image
+
+from app.config import config
+from app.models import const
+from app.models.schema import VideoAspect, VideoConcatMode, VideoParams
+from app.services import ffmpeg, video
+
+# 平均像素差异阈值（0-255），两个后端的缩放和编码存在细微差别
+MAX_MEAN_DIFF = 6.0
+
+
+def make_materials(work_dir):
+    """生成合成素材：尺寸、比例、帧率各不相同的纯色视频和一张图片"""
+    sources = [
+        ("red.mp4", "red", "1080x1920", 30, 4),  # 与输出完全一致
+        ("green.mp4", "green", "720x1280", 25, 3),  # 同比例，需要缩放
+        ("blue.mp4", "blue", "1280x720", 30, 5),  # 横屏，需要加黑边
+    ]
+    video_paths = []
+    for name, color, size, fps, duration in sources:
+        file_path = os.path.join(work_dir, name)
+        ffmpeg.run(
+            [
+                "-f",
+                "lavfi",
+                "-i",
+                f"color=c={color}:s={size}:r={fps}:d={duration}",
+                "-c:v",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                file_path,
+            ]
+        )
+        video_paths.append(file_path)
+
+    image_path = os.path.join(work_dir, "yellow.png")
+    Image.new("RGB", (900, 900), (255, 255, 0)).save(image_path)
+    video_paths.append(image_path)
+
+    audio_path = os.path.join(work_dir, "audio.mp3")
+    ffmpeg.run(["-f", "lavfi", "-i", "sine=frequency=440:duration=10", audio_path])
+    return video_paths, audio_path
+
+
+def render(work_dir, video_paths, audio_path, backend):
+    output_file = os.path.join(work_dir, f"combined-{backend}.mp4")
+    video.combine_videos(
+        combined_video_path=output_file,
+        video_paths=video_paths,
+        audio_file=audio_path,
+        video_aspect=VideoAspect.portrait,
+        video_concat_mode=VideoConcatMode.sequential,
+        max_clip_duration=5,
+        backend=backend,
+    )
+    return output_file
+
+
+def test_ffmpeg_backend_matches_moviepy():
+    # 关闭素材片段缓存，直接比较两个后端的拼接结果
+    clip_cache_size_mb = config.app.get("clip_cache_size_mb")
+    config.app["clip_cache_size_mb"] = 0
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            video_paths, audio_path = make_materials(work_dir)
+            moviepy_file = render(work_dir, video_paths, audio_path, const.VIDEO_BACKEND_MOVIEPY)
+            ffmpeg_file = render(work_dir, video_paths, audio_path, const.VIDEO_BACKEND_FFMPEG)
+
+            moviepy_info = ffmpeg.probe(moviepy_file)
+            ffmpeg_info = ffmpeg.probe(ffmpeg_file)
+            assert (ffmpeg_info.width, ffmpeg_info.height) == (1080, 1920)
+            assert abs(ffmpeg_info.fps - moviepy_info.fps) < 0.01
+            assert abs(ffmpeg_info.duration - moviepy_info.duration) <= 2 / 30
+
+            # 每个素材片段时长相同，避开片段边界取样
+            clip_duration = ffmpeg.probe(audio_path).duration / len(video_paths)
+            moviepy_clip = VideoFileClip(moviepy_file)
+            ffmpeg_clip = VideoFileClip(ffmpeg_file)
+            try:
+                for t in np.arange(0, moviepy_clip.duration, 0.25):
+                    offset = t % clip_duration
+                    if offset < 0.1 or clip_duration - offset < 0.1:
+                        continue
+                    expected = moviepy_clip.get_frame(t).astype(np.float32)
+                    actual = ffmpeg_clip.get_frame(t).astype(np.float32)
+                    diff = float(np.mean(np.abs(expected - actual)))
+                    assert diff < MAX_MEAN_DIFF, f"frame at {t:.2f}s differs: {diff:.2f}"
+            finally:
+                moviepy_clip.close()
+                ffmpeg_clip.close()
+    finally:
+        # 恢复配置，避免影响其他测试
+        if clip_cache_size_mb is None:
+            config.app.pop("clip_cache_size_mb", None)
+        else:
+            config.app["clip_cache_size_mb"] = clip_cache_size_mb
+
+
+def test_write_clip_keeps_the_last_frame():
+    # n / 30 * 30 略小于 n 时，截断取整会丢掉最后一帧
+    with tempfile.TemporaryDirectory() as work_dir:
+        for frame_count in (123, 245):
+            output_file = os.path.join(work_dir, f"clip-{frame_count}.mp4")
+            clip = ColorClip((64, 64), color=(255, 0, 0), duration=frame_count / 30)
+            video._write_clip(clip, output_file, audio=False)
+            assert count_frames_and_secs(output_file)[0] == frame_count
+
+        # 按视频时间轴上的帧切分的片段，拼接后帧数与整段视频一致
+        boundaries = [0, 65.333, 130.667, 196]
+        counts = [
+            video._frame_index(end) - video._frame_index(start)
+            for start, end in zip(boundaries, boundaries[1:])
+        ]
+        assert sum(counts) == video._frame_index(196) == 5880
+
+
+def test_subtitles_are_encoded_once():
+    # 有字幕时 ffmpeg 后端拼接后还要再编码一次烧录字幕，改为单次合成
+    params = VideoParams(
+        video_subject="test",
+        video_style="test",
+        video_aspect=VideoAspect.portrait,
+        video_concat_mode=VideoConcatMode.sequential,
+        video_backend=const.VIDEO_BACKEND_FFMPEG,
+        bgm_type="",
+        subtitle_enabled=True,
+        font_name="UTM Kabel KT.ttf",
+    )
+    encodes = []
+    pipe_writer, combine_videos = ffmpeg.PipeWriter, video.combine_videos
+
+    def counting_writer(*args, **kwargs):
+        encodes.append(args[0])
+        return pipe_writer(*args, **kwargs)
+
+    def counting_combine(**kwargs):
+        encodes.append(kwargs["combined_video_path"])
+        return combine_videos(**kwargs)
+
+    ffmpeg.PipeWriter, video.combine_videos = counting_writer, counting_combine
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            video_paths, _ = make_materials(work_dir)
+            audio_path = os.path.join(work_dir, "short.mp3")
+            ffmpeg.run(["-f", "lavfi", "-i", "sine=frequency=440:duration=2", audio_path])
+            subtitle_path = os.path.join(work_dir, "subtitle.srt")
+            with open(subtitle_path, "w", encoding="utf-8") as f:
+                f.write("1\n00:00:00,000 --> 00:00:01,500\nhello\n\n")
+
+            output_file = os.path.join(work_dir, "final.mp4")
+            # 绿色素材需要缩放，不能直接拼接
+            video.render_video(
+                video_paths=video_paths[1:2],
+                audio_path=audio_path,
+                subtitle_path=subtitle_path,
+                output_file=output_file,
+                params=params,
+            )
+            assert encodes == [output_file]
+    finally:
+        ffmpeg.PipeWriter, video.combine_videos = pipe_writer, combine_videos
+
+
+def test_segments_share_the_render_pool():
+    params = VideoParams(
+        video_subject="test",
+        video_style="test",
+        video_aspect=VideoAspect.portrait,
+        bgm_type="",
+        subtitle_enabled=False,
+    )
+    saved = {k: config.app.get(k) for k in ("max_segment_workers", "segment_min_duration")}
+    config.app.update(max_segment_workers=3, segment_min_duration=1)
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            video_path = os.path.join(work_dir, "combined.mp4")
+            ffmpeg.run(
+                ["-f", "lavfi", "-i", "testsrc=s=108x192:r=30:d=3.1", "-g", "30", video_path]
+            )
+            audio_path = os.path.join(work_dir, "audio.m4a")
+            ffmpeg.run(["-f", "lavfi", "-i", "sine=frequency=440:duration=4", audio_path])
+
+            outputs = []
+            for i in range(2):
+                output_file = os.path.join(work_dir, f"final-{i}.mp4")
+                video.generate_video(video_path, audio_path, "", output_file, params)
+                outputs.append(output_file)
+                # 渲染进程常驻，后续渲染复用同一组进程
+                if i == 0:
+                    pool = video.worker_pool()
+                assert video.worker_pool() is pool
+
+            # 分段编码后拼接，帧数与整段视频一致
+            for output_file in outputs:
+                assert count_frames_and_secs(output_file)[0] == 93
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                config.app.pop(key, None)
+            else:
+                config.app[key] = value
+
+
+if __name__ == "__main__":
+    test_ffmpeg_backend_matches_moviepy()
+    test_write_clip_keeps_the_last_frame()
+    test_subtitles_are_encoded_once()
+    test_segments_share_the_render_pool()
+    print("✅ ffmpeg 后端与 moviepy 后端输出一致")